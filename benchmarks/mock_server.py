@@ -0,0 +1,457 @@
+# -----------------------------------------------------------------------------
+# FortiTopology - mock FortiGate / FortiManager server
+# Copyright (c) 2026 Michael Schmerbeck
+# Licensed under the MIT License.
+# See LICENSE file in the project root for full license information.
+# -----------------------------------------------------------------------------
+
+"""
+Local stand-in for a FortiGate (/api/v2/...) and a FortiManager (/jsonrpc)
+with synthetic data from synth.py. Latency, error rate and payload size can
+be injected, so concurrency, pooling and retries can be tested offline.
+With --vdoms the switches and APs are spread over several VDOMs (the FortiLink
+switches are visible in all of them), --ha adds a secondary unit to every gate.
+
+    python benchmarks/mock_server.py --port 8443 --devices 1000 --gates 50 --latency 40 --error-rate 0.02
+    python fortitopology.py direct --host 127.0.0.1 --port 8443 --token mock
+    python fortitopology.py fmg --host 127.0.0.1 --port 8443 --token mock --all
+
+GET /mock/stats returns the request, connection and error counters.
+"""
+
+import os
+import sys
+import ssl
+import json
+import gzip
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fortitopology as ft
+from synth import generate_site
+
+# Accepted forms of the /sys/proxy/json target, in the order fetch_data probes them
+TARGET_VARIANTS = ("adom-string", "adom-list", "device-list", "name-list", "name")
+
+DEFAULT_TOKEN = "mock"
+FMG_VERSION = "v7.4.3"
+
+
+class MockState:
+    """Settings and synthetic data shared by all request handlers."""
+
+    def __init__(self, devices=100, gates=10, latency=0, jitter=0, error_rate=0.0, error_status=503,
+                 padding=0, target_variant="any", token=DEFAULT_TOKEN, user="admin", password="admin",
+                 session_ttl=0, vdoms=1, ha=False, seed=1):
+        self.devices = devices              # Switches + APs per FortiGate
+        self.gates = gates                  # FortiGates managed by the mock FMG
+        self.latency = latency              # ms added to every answer
+        self.jitter = jitter                # ms, random extra latency 0..jitter
+        self.error_rate = error_rate        # Share of requests answered with error_status
+        self.error_status = error_status
+        self.padding = padding              # Extra bytes per record, for unprojected payload sizes
+        self.target_variant = target_variant
+        self.token = token
+        self.user = user
+        self.password = password
+        self.session_ttl = session_ttl      # Seconds until a JSON-RPC session expires (0 = never)
+        self.vdoms = ["root"] + [f"vdom{i}" for i in range(1, max(1, vdoms))]
+        self.ha = ha                        # Every gate is an active-passive cluster
+        self.seed = seed
+
+        self.rnd = random.Random(seed)
+        self.lock = threading.Lock()
+        self.sites = {}
+        self.sessions = {}
+        self.names = {self.gate(i)['name']: i for i in range(gates)}
+        self.stats = {'requests': 0, 'connections': 0, 'errors': 0, 'bytes': 0, 'paths': {}}
+
+    # --- Data ---
+    def gate(self, index):
+        return {
+            'name': f"FGT-{index:04d}",
+            'serial': f"FG100FTK{index:08d}",
+            'adom': f"ADOM-{index % 5}" if index % 3 else "root",
+            'oid': 100 + index,
+        }
+
+    def ha_members(self, gate):
+        """Primary and secondary unit of a gate, empty without --ha."""
+        if not self.ha:
+            return []
+        return [{'serial': gate['serial'], 'name': gate['name'], 'role': "primary"},
+                {'serial': gate['serial'].replace("FG100FTK", "FG100FTL"), 'name': f"{gate['name']}-B",
+                 'role': "secondary"}]
+
+    def gate_by_name(self, name):
+        index = self.names.get(name)
+        return None if index is None else self.gate(index)
+
+    def site(self, gate):
+        with self.lock:
+            site = self.sites.get(gate['serial'])
+            if site is None:
+                site = generate_site(self.devices, seed=self.seed + gate['oid'],
+                                     serial=gate['serial'], hostname=gate['name'])
+                if self.padding:
+                    for key in ('switches', 'aps'):
+                        for record in site[key]['results']:
+                            record['description'] = "x" * self.padding
+                site['vdoms'] = self.split_vdoms(site)
+                self.sites[gate['serial']] = site
+            return site
+
+    def split_vdoms(self, site):
+        """{vdom: {'switches': [...], 'aps': [...]}}, round robin, FortiLink switches in every VDOM."""
+        split = {vdom: {'switches': [], 'aps': []} for vdom in self.vdoms}
+        for key in ('switches', 'aps'):
+            for i, record in enumerate(site[key]['results']):
+                fortilink = key == 'switches' and any('fgt-peer-device-name' in p for p in record['ports'])
+                for vdom in (self.vdoms if fortilink else [self.vdoms[i % len(self.vdoms)]]):
+                    split[vdom][key].append(record)
+        return split
+
+    def dvmdb_devices(self):
+        devices = []
+        for i in range(self.gates):
+            gate = self.gate(i)
+            devices.append({
+                'hostname': gate['name'], 'name': gate['name'], 'sn': gate['serial'],
+                'mgt_vdom': gate['adom'], 'oid': gate['oid'], 'conn_status': 1,
+                'platform_str': "FortiGate-100F", 'os_ver': 7, 'mr': 4, 'patch': 3,
+                'ip': f"10.{i // 250}.{i % 250}.1", 'description': "x" * self.padding,
+                'ha_slave': [{'name': m['name'], 'sn': m['serial'], 'role': 1 if m['role'] == "primary" else 0,
+                              'idx': n} for n, m in enumerate(self.ha_members(gate))] or None,
+            })
+        return devices
+
+    # --- Faults ---
+    def delay(self):
+        ms = self.latency + (self.rnd.uniform(0, self.jitter) if self.jitter else 0)
+        if ms > 0:
+            time.sleep(ms / 1000.0)
+
+    def fail(self):
+        return self.error_rate > 0 and self.rnd.random() < self.error_rate
+
+    def count(self, path, size=0, error=False):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['bytes'] += size
+            if error: self.stats['errors'] += 1
+            self.stats['paths'][path] = self.stats['paths'].get(path, 0) + 1
+
+
+def api_answer(state, gate, path, query):
+    """FortiOS answer of one /api/v2 resource, None if unknown."""
+    site = state.site(gate)
+    vdom = query.get('vdom', ["root"])[0]
+    if vdom not in site['vdoms']:
+        return None
+    if path == ft.EP_LICENSE:
+        return dict(site['license'], http_method="GET", version=FMG_VERSION)
+    if path == ft.EP_SYSTEM:
+        return dict(site['system'], http_method="GET", status="success", vdom="root", version=FMG_VERSION)
+    if path == ft.EP_VDOMS:
+        results = [{'name': name, 'short-name': name, 'vcluster-id': 0} for name in state.vdoms]
+    elif path == ft.EP_HA_PEERS:
+        results = [{'serial_no': m['serial'], 'hostname': m['name'], 'priority': 200 - n * 100, 'vcluster_id': 1}
+                   for n, m in enumerate(state.ha_members(gate))]
+    elif path == ft.EP_SWITCHES:
+        results = site['vdoms'][vdom]['switches']
+    elif path in (ft.EP_APS, "/monitor/wifi/managed_ap"):
+        results = site['vdoms'][vdom]['aps']
+    else:
+        return None
+
+    # FortiOS field filter and paging
+    fields = query.get('format', [None])[0]
+    if fields:
+        keep = fields.split('|')
+        results = [{k: r[k] for k in keep if k in r} for r in results]
+    if 'count' in query:
+        start = int(query.get('start', ['0'])[0])
+        results = results[start:start + int(query['count'][0])]
+
+    return {'http_method': "GET", 'results': results, 'vdom': vdom,
+            'path': path, 'status': "success", 'serial': gate['serial'], 'version': FMG_VERSION}
+
+
+def parse_target(target):
+    """Returns (variant, device name) of one proxy target entry."""
+    is_list = isinstance(target, list)
+    if is_list:
+        target = target[0] if target else ""
+    parts = str(target).split('/')
+    if len(parts) == 4 and parts[0] == "adom" and parts[2] == "device":
+        return ("adom-list" if is_list else "adom-string"), parts[3]
+    if len(parts) == 2 and parts[0] == "device":
+        return ("device-list" if is_list else None), parts[1]
+    return ("name-list" if is_list else "name"), parts[-1]
+
+
+def proxy_answer(state, data):
+    """Answer of one /sys/proxy/json param: (status, data)."""
+    targets = data.get('target') or []
+    if not isinstance(targets, list):
+        targets = [targets]
+
+    resource = urlsplit(data.get('resource', ""))
+    path = resource.path[len("/api/v2"):] if resource.path.startswith("/api/v2") else resource.path
+    query = parse_qs(resource.query)
+
+    entries = []
+    for target in targets:
+        variant, name = parse_target(target)
+        if state.target_variant != "any" and variant != state.target_variant:
+            continue
+        gate = state.gate_by_name(name)
+        if gate is None:
+            entries.append({'target': name, 'status': {'code': -3, 'message': "Object does not exist"}})
+            continue
+        answer = api_answer(state, gate, path, query)
+        if answer is None:
+            entries.append({'target': name, 'status': {'code': -6, 'message': "Invalid url"}})
+            continue
+        entries.append({'target': name, 'response': answer, 'status': {'code': 0, 'message': "OK"}})
+
+    if not entries:
+        return {'code': -3, 'message': "Object does not exist"}, None
+    return {'code': 0, 'message': "OK"}, entries
+
+
+def dvmdb_answer(state, data):
+    """Answer of /dvmdb/device with optional 'fields' projection and 'range' [start, count]."""
+    devices = state.dvmdb_devices()
+    fields = data.get('fields')
+    if fields:
+        devices = [{k: d[k] for k in fields if k in d} for d in devices]
+    if data.get('range'):
+        start, count = data['range'][0], data['range'][1]
+        devices = devices[start:start + count]
+    return {'code': 0, 'message': "OK"}, devices
+
+
+def dvmdb_vdom_answer(state, url):
+    """Answer of /dvmdb/[adom/<adom>/]device/<name>/vdom."""
+    gate = state.gate_by_name(url.rstrip('/').split('/')[-2])
+    if gate is None:
+        return {'code': -3, 'message': "Object does not exist"}, None
+    return {'code': 0, 'message': "OK"}, [{'name': name, 'opmode': 1, 'vdom_type': 1} for name in state.vdoms]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None
+    verbose = False
+
+    def setup(self):
+        super().setup()
+        with self.state.lock:
+            self.state.stats['connections'] += 1
+
+    def log_message(self, format, *args):
+        if self.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if 'gzip' in self.headers.get('Accept-Encoding', ""):
+            body = gzip.compress(body, 5)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return len(body)
+
+    def injected_error(self, path):
+        self.state.delay()
+        if self.state.fail():
+            size = self.send_json(self.state.error_status, {'status': "error", 'http_status': self.state.error_status})
+            self.state.count(path, size, error=True)
+            return True
+        return False
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/mock/stats":
+            with self.state.lock:
+                stats = json.loads(json.dumps(self.state.stats))
+            self.send_json(200, stats)
+            return
+
+        if self.injected_error(url.path):
+            return
+        if self.headers.get('Authorization') != f"Bearer {self.state.token}":
+            self.state.count(url.path, self.send_json(401, {'status': "error", 'http_status': 401}), error=True)
+            return
+        if not url.path.startswith("/api/v2"):
+            self.state.count(url.path, self.send_json(404, {'status': "error", 'http_status': 404}), error=True)
+            return
+
+        answer = api_answer(self.state, self.state.gate(0), url.path[len("/api/v2"):], parse_qs(url.query))
+        if answer is None:
+            self.state.count(url.path, self.send_json(404, {'status': "error", 'http_status': 404}), error=True)
+            return
+        self.state.count(url.path, self.send_json(200, answer))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self.state.count("/jsonrpc", self.send_json(400, {'error': "invalid json"}), error=True)
+            return
+
+        if urlsplit(self.path).path != "/jsonrpc":
+            self.state.count(self.path, self.send_json(404, {'error': "not found"}), error=True)
+            return
+        if self.injected_error("/jsonrpc"):
+            return
+
+        params = body.get('params') or []
+        answer = {'id': body.get('id'), 'result': []}
+
+        # Login / logout
+        if params and params[0].get('url') == "/sys/login/user":
+            data = params[0].get('data') or {}
+            if data.get('user') == self.state.user and data.get('passwd') == self.state.password:
+                session = "%032x" % self.state.rnd.getrandbits(128)
+                with self.state.lock:
+                    self.state.sessions[session] = time.time()
+                answer['session'] = session
+                answer['result'].append({'url': "/sys/login/user", 'status': {'code': 0, 'message': "OK"}})
+            else:
+                answer['result'].append({'url': "/sys/login/user", 'status': {'code': -22, 'message': "Login fail"}})
+            self.state.count("/sys/login/user", self.send_json(200, answer))
+            return
+        if params and params[0].get('url') == "/sys/logout":
+            with self.state.lock:
+                self.state.sessions.pop(body.get('session'), None)
+            answer['result'].append({'url': "/sys/logout", 'status': {'code': 0, 'message': "OK"}})
+            self.state.count("/sys/logout", self.send_json(200, answer))
+            return
+
+        # Auth: Bearer token or a valid session
+        authorized = self.headers.get('Authorization') == f"Bearer {self.state.token}"
+        if not authorized:
+            with self.state.lock:
+                opened = self.state.sessions.get(body.get('session'))
+            if opened is not None and (not self.state.session_ttl or time.time() - opened < self.state.session_ttl):
+                authorized = True
+            else:
+                status = {'code': -11, 'message': "No permission for the resource"}
+                answer['result'] = [{'url': p.get('url'), 'status': status} for p in params]
+                self.state.count("/jsonrpc", self.send_json(200, answer), error=True)
+                return
+
+        for param in params:
+            url = param.get('url')
+            data = param.get('data') or {}
+            if url == "/dvmdb/device":
+                status, result = dvmdb_answer(self.state, data)
+            elif str(url).startswith("/dvmdb/") and str(url).endswith("/vdom"):
+                status, result = dvmdb_vdom_answer(self.state, url)
+            elif url == "/sys/proxy/json":
+                status, result = proxy_answer(self.state, data)
+            else:
+                status, result = {'code': -6, 'message': "Invalid url"}, None
+            entry = {'url': url, 'status': status}
+            if result is not None:
+                entry['data'] = result
+            answer['result'].append(entry)
+
+        paths = ",".join(sorted({str(p.get('url')) for p in params})) or "/jsonrpc"
+        self.state.count(paths, self.send_json(200, answer))
+
+
+def self_signed_cert():
+    """Creates a throwaway certificate with openssl. Returns (certfile, keyfile) or (None, None)."""
+    folder = tempfile.mkdtemp(prefix="fortitopology_mock_")
+    cert, key = os.path.join(folder, "cert.pem"), os.path.join(folder, "key.pem")
+    try:
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "2",
+                        "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+                       check=True, capture_output=True, timeout=60)
+        return cert, key
+    except Exception as e:
+        print(f"No certificate: {e}")
+        return None, None
+
+
+def start_server(state, host="127.0.0.1", port=0, certfile=None, keyfile=None, verbose=False):
+    """Starts the mock server in a background thread. Returns the server, its port is server.server_port."""
+    handler = type("BoundMockHandler", (MockHandler,), {'state': state, 'verbose': verbose})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    if certfile:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mock FortiGate / FortiManager for load and latency tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--tls-cert", help="Certificate file (default: self-signed via openssl)")
+    parser.add_argument("--tls-key", help="Key file of the certificate")
+    parser.add_argument("--devices", type=int, default=100, help="Switches + APs per FortiGate")
+    parser.add_argument("--gates", type=int, default=10, help="FortiGates managed by the mock FortiManager")
+    parser.add_argument("--latency", type=float, default=0, help="ms added to every answer")
+    parser.add_argument("--jitter", type=float, default=0, help="Random extra ms (0..jitter)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests that fail (0..1)")
+    parser.add_argument("--error-status", type=int, default=503, help="HTTP status of injected errors")
+    parser.add_argument("--padding", type=int, default=0, help="Extra bytes per record")
+    parser.add_argument("--target-variant", choices=("any",) + TARGET_VARIANTS, default="any",
+                        help="Only accept this /sys/proxy/json target form, like some FMG versions")
+    parser.add_argument("--token", default=DEFAULT_TOKEN)
+    parser.add_argument("--user", default="admin")
+    parser.add_argument("--password", default="admin")
+    parser.add_argument("--session-ttl", type=float, default=0, help="Seconds until a JSON-RPC session expires")
+    parser.add_argument("--vdoms", type=int, default=1, help="VDOMs per FortiGate")
+    parser.add_argument("--ha", action="store_true", help="Every FortiGate is an HA cluster of two units")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log every request")
+    args = parser.parse_args(argv)
+
+    state = MockState(devices=args.devices, gates=args.gates, latency=args.latency, jitter=args.jitter,
+                      error_rate=args.error_rate, error_status=args.error_status, padding=args.padding,
+                      target_variant=args.target_variant, token=args.token, user=args.user,
+                      password=args.password, session_ttl=args.session_ttl, vdoms=args.vdoms, ha=args.ha,
+                      seed=args.seed)
+    certfile, keyfile = args.tls_cert, args.tls_key
+    # fortitopology only speaks HTTPS, so there is no plain HTTP fallback
+    if not certfile:
+        certfile, keyfile = self_signed_cert()
+    if not certfile:
+        print("Pass --tls-cert and --tls-key or install openssl")
+        return 1
+    server = start_server(state, args.host, args.port, certfile, keyfile, args.verbose)
+    print(f"Mock FortiGate/FortiManager on https://{args.host}:{server.server_port} (token '{args.token}')")
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        print(json.dumps(state.stats, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+# -----------------------------------------------------------------------------
+# FortiTopology - benchmark suite
+# Copyright (c) 2026 Michael Schmerbeck
+# Licensed under the MIT License.
+# See LICENSE file in the project root for full license information.
+# -----------------------------------------------------------------------------
+
+"""
+Times and memory-profiles the offline stages on synthetic sites:
+link inference (build_topology), clean_id and create_drawio_xml.
+
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --sizes 100 1000 --compare benchmarks/results/old.json
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fortitopology as ft
+from synth import generate_site
+
+DEFAULT_SIZES = (10, 100, 1000, 10000, 100000)
+DEFAULT_REPEAT = 3
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+REGRESSION_FACTOR = 1.25    # --compare flags stages slower than this ratio
+
+
+def measure(func, repeat):
+    """Best wall time of `repeat` runs, then one extra run under tracemalloc for the peak."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds': round(best, 6), 'peak_bytes': peak}
+
+
+def bench_size(devices, repeat, seed):
+    site = generate_site(devices, seed=seed)
+    serial, hostname = ft.get_gate_details(ft.Target("bench"), site['license'], site['system'])
+    switches, aps = ft.extract_results(site['switches']), ft.extract_results(site['aps'])
+
+    names = [sw['switch-id'] for sw in switches] + [sw['name'] for sw in switches]
+    names += [ap['serial'] for ap in aps] + [ap['name'] for ap in aps]
+
+    graph = ft.build_topology(serial, hostname, switches, aps)
+
+    stages = {
+        'link_inference': measure(lambda: ft.build_topology(serial, hostname, switches, aps), repeat),
+        'clean_id': measure(lambda: [ft.clean_id(n) for n in names], repeat),
+        'create_drawio_xml': measure(lambda: ft.create_drawio_xml(graph), repeat),
+    }
+    return {
+        'devices': devices,
+        'switches': len(switches),
+        'aps': len(aps),
+        'nodes': len(graph.nodes),
+        'edges': len(graph.edges),
+        'stages': stages,
+    }
+
+
+def git_revision():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def compare(results, old_path):
+    """Prints the time ratio per size and stage against an older result file."""
+    with open(old_path, 'r', encoding='utf-8') as f:
+        old = {r['devices']: r for r in json.load(f).get('results', [])}
+
+    regressions = 0
+    print(f"\nCompared to {old_path}:")
+    for r in results:
+        before = old.get(r['devices'])
+        if not before:
+            continue
+        for stage, now in r['stages'].items():
+            then = before['stages'].get(stage)
+            if not then or not then['seconds']:
+                continue
+            ratio = now['seconds'] / then['seconds']
+            flag = "  <-- slower" if ratio > REGRESSION_FACTOR else ""
+            if flag: regressions += 1
+            print(f"  {r['devices']:>7} {stage:<18} {then['seconds']:>9.4f}s -> {now['seconds']:>9.4f}s  x{ratio:.2f}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="FortiTopology benchmarks on synthetic topologies")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="Devices per site (switches + APs)")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="Timed runs per stage, the best one counts")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-o", "--output", help="Result file (default: benchmarks/results/bench_<time>.json)")
+    parser.add_argument("--compare", help="Older result file to compare against")
+    args = parser.parse_args(argv)
+
+    ft.LOG_STREAM = None
+
+    results = []
+    for devices in args.sizes:
+        r = bench_size(devices, max(1, args.repeat), args.seed)
+        results.append(r)
+        line = "  ".join(f"{k}={v['seconds']:.4f}s/{v['peak_bytes'] / 1048576:.1f}MB" for k, v in r['stages'].items())
+        print(f"{devices:>7} devices ({r['nodes']} nodes, {r['edges']} edges): {line}")
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, time.strftime("bench_%Y%m%d_%H%M%S.json"))
+
+    report = {
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'seed': args.seed,
+        'results': results,
+    }
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        return 1 if compare(results, args.compare) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
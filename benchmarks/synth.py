@@ -0,0 +1,107 @@
+# -----------------------------------------------------------------------------
+# FortiTopology - synthetic topology generator
+# Copyright (c) 2026 Michael Schmerbeck
+# Licensed under the MIT License.
+# See LICENSE file in the project root for full license information.
+# -----------------------------------------------------------------------------
+
+"""
+Generates FortiOS-shaped API answers for sites of any size:
+managed-switch (FortiLink and ISL peers on both sides) and managed_ap
+(LLDP neighbors by name, by chassis MAC only, or only connected_switch_serial).
+Used by the benchmarks and the mock server.
+"""
+
+import random
+
+FG_SERIAL = "FG100FTK00000001"
+FG_HOSTNAME = "FGT-Synthetic"
+
+SWITCH_MODELS = ("S124FP", "S148FP", "S224EP", "S448EP", "S1E48T")
+AP_MODELS = ("FP231F", "FP431F", "FP231G", "FP441K")
+
+SWITCH_FANOUT = 8           # Access switches per distribution switch
+CORE_SWITCHES = 2           # Switches connected to the FortiGate via FortiLink
+
+
+def switch_mac(i):
+    return "e8:1c:ba:%02x:%02x:%02x" % ((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+
+
+def ap_mac(i):
+    return "04:d5:90:%02x:%02x:%02x" % ((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+
+
+def generate_site(devices, seed=1, ap_ratio=0.85, buildings=10, serial=FG_SERIAL, hostname=FG_HOSTNAME):
+    """
+    Returns the API answers of one FortiGate with about `devices` switches + APs:
+    {'license': ..., 'system': ..., 'switches': {'results': [...]}, 'aps': {'results': [...]}}
+    """
+    rnd = random.Random(seed)
+    devices = max(2, int(devices))
+    n_switches = max(1, int(round(devices * (1 - ap_ratio))))
+    n_aps = max(0, devices - n_switches)
+
+    switches = []
+    for i in range(n_switches):
+        model = SWITCH_MODELS[i % len(SWITCH_MODELS)]
+        switches.append({
+            'switch-id': f"{model}{i:010d}",
+            'name': f"B{i % buildings:02d}-SW-{i:05d}",
+            'mac': switch_mac(i),
+            'ports': [],
+            # Fields the collector does not use, to get realistic payload sizes
+            'fsw-wan1-admin': "enable",
+            'max-allowed-trunk-members': 8,
+            'poe-detection-type': 1,
+        })
+
+    def port(sw, name, **peer):
+        entry = {'port-name': name, 'vlan': "default", 'poe-status': "enable", 'allowed-vlans': []}
+        entry.update(peer)
+        sw['ports'].append(entry)
+
+    # Core switches on FortiLink, the rest as a tree of ISL links
+    for i, sw in enumerate(switches):
+        if i < CORE_SWITCHES:
+            port(sw, "port49", **{'fgt-peer-device-name': hostname, 'fgt-peer-port-name': f"fortilink{i}"})
+            continue
+        parent_index = (i - CORE_SWITCHES) // SWITCH_FANOUT if i >= CORE_SWITCHES + SWITCH_FANOUT else i % CORE_SWITCHES
+        parent = switches[parent_index]
+        down_port = f"port{25 + len(parent['ports']) % 24}"
+        port(sw, "port48", **{'isl-peer-device-name': parent['name'], 'isl-peer-port-name': down_port})
+        port(parent, down_port, **{'isl-peer-device-name': sw['name'], 'isl-peer-port-name': "port48"})
+
+    aps = []
+    for i in range(n_aps):
+        model = AP_MODELS[i % len(AP_MODELS)]
+        sw_index = rnd.randrange(n_switches)
+        sw = switches[sw_index]
+        ap = {
+            'serial': f"{model}{i:010d}",
+            'name': f"B{sw_index % buildings:02d}-AP-{i:06d}",
+            'model': f"FAP-{model[2:]}",
+            'board_mac': ap_mac(i),
+            'status': "connected",
+            'clients': rnd.randrange(40),
+            'radio': [{'radio_id': 1, 'band': "2.4GHz"}, {'radio_id': 2, 'band': "5GHz"}],
+            'lldp': [],
+        }
+        kind = rnd.random()
+        if kind < 0.7:
+            ap['lldp'].append({'system_name': sw['name'], 'port_id': f"port{1 + i % 24}",
+                               'local_port': "lan1", 'chassis_id': sw['mac'], 'ttl': 120})
+        elif kind < 0.8:
+            # Neighbor reports an unknown name, but the chassis MAC matches
+            ap['lldp'].append({'system_name': f"unknown-{sw_index}", 'port_id': f"port{1 + i % 24}",
+                               'local_port': "lan1", 'chassis_id': sw['mac'], 'ttl': 120})
+        elif kind < 0.95:
+            ap['connected_switch_serial'] = sw['switch-id']
+        aps.append(ap)
+
+    return {
+        'license': {'serial': serial, 'status': "success"},
+        'system': {'serial': serial, 'results': {'hostname': hostname, 'model': "FGT100F"}},
+        'switches': {'results': switches},
+        'aps': {'results': aps},
+    }
@@ -5,33 +5,167 @@
 # See LICENSE file in the project root for full license information.
 # -----------------------------------------------------------------------------
 
+import os
+import sys
+import json
+import gzip
+import hashlib
+import base64
+import zlib
+import math
+import gc
+import io
+import re
+from collections import deque
+from bisect import bisect_left
+from urllib.parse import unquote, quote, urlencode
+import csv
+import sqlite3
+import queue
+import argparse
 import requests
 import urllib3
-import xml.etree.ElementTree as ET
-import tkinter as tk
-from tkinter import ttk, scrolledtext, messagebox, filedialog
 import threading
+import time
+import random
+import asyncio
+import multiprocessing
+from contextlib import contextmanager, closing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeout, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+import xml.etree.ElementTree as ET
+
+# tkinter is imported in run_gui(), so the CLI also works on headless hosts
+tk = ttk = scrolledtext = messagebox = filedialog = None
 
 # Surpress warnings
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-# --- GLOBALE VARIABLES ---
-CONNECTION_MODE = "DIRECT"  # 'DIRECT' or 'FMG'
-CURRENT_IP = ""             # IP Adress (Gate or FMG)
-CURRENT_PORT = ""           # Port (Gate or FMG)
-CURRENT_TOKEN = ""          # API Token
-CURRENT_SESSION = ""        # Session
-SELECTED_DEVICE_DATA = {}   # List with Fortigate data
-SELECTED_DEVICE_SERIAL = "" # Necessary for FMG mode
-SELECTED_DEVICE_NAME = ""   # Necessary for FMG mode
-BASE_URL = ""               # created dynamically
-GUI_DEVICE_MAP = {}         # List to find device data from Combo Box
+# --- TRANSPORT SETTINGS ---
+HTTP_POOL_SIZE = 10         # Keep-alive connections per target
+HTTP_SESSIONS = {}          # Pooled requests.Session per (host, port)
+HTTP_SESSIONS_LOCK = threading.Lock()
+
+# --- REQUEST POLICY SETTINGS ---
+TIMEOUT_DEFAULTS = {'GET': 8, 'POST': 15}   # Seconds, until an endpoint has LATENCY_MIN_SAMPLES
+TIMEOUT_FACTOR = 3.0        # Adaptive timeout = factor * p99 latency of the endpoint
+TIMEOUT_MIN = 2.0           # Bounds of the adaptive timeout
+TIMEOUT_MAX = 60.0
+LATENCY_WINDOW = 200        # Latest latencies kept per host and endpoint
+LATENCY_MIN_SAMPLES = 10    # Samples before the timeout adapts
+RETRY_ATTEMPTS = 3          # Tries of idempotent requests (GET, FMG get/proxy get), 1 = no retry
+RETRY_BACKOFF = 0.5         # Seconds before the first retry, doubled per retry, full jitter
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+HEDGE_PROXY = False         # Send a duplicate of FMG proxy calls slower than their p95
+HEDGE_MIN_DELAY = 0.5       # Seconds before a duplicate is sent at the earliest
+HEDGE_WORKERS = 16
+BREAKER_FAILURES = 5        # Failures in a row that open the circuit of a host
+BREAKER_COOLDOWN = 30       # Seconds until an open circuit lets one trial request through
+
+# --- COLLECTION SETTINGS ---
+COLLECT_WORKERS = 6         # Parallel endpoint requests per target
+ENDPOINT_DEADLINE = 30      # Seconds until an endpoint is given up
+
+EP_LICENSE = "/monitor/license/status"
+EP_SYSTEM = "/monitor/system/status"
+EP_SWITCHES = "/cmdb/switch-controller/managed-switch"
+EP_APS = "/monitor/wifi/managed_ap/select"
+EP_VDOMS = "/cmdb/system/vdom"
+EP_HA_PEERS = "/monitor/system/ha-peer"
+VDOM_WORKERS = 8            # VDOMs of one gate collected at the same time
+
+# Only the fields the link inference uses are requested and kept
+PAGE_SIZE = 500             # Records per paged request, 0 = no paging
+SWITCH_FIELDS = ('switch-id', 'name', 'mac', 'ports')
+SWITCH_PORT_FIELDS = ('port-name', 'isl-peer-device-name', 'isl-peer-port-name', 'fgt-peer-device-name', 'fgt-peer-port-name')
+AP_FIELDS = ('serial', 'name', 'model', 'board_mac', 'connected_switch_serial', 'lldp')
+AP_LLDP_FIELDS = ('system_name', 'port_id', 'local_port', 'chassis_id')
+ENDPOINT_FIELDS = {
+    EP_SWITCHES: (SWITCH_FIELDS, 'ports', SWITCH_PORT_FIELDS),
+    EP_APS: (AP_FIELDS, 'lldp', AP_LLDP_FIELDS)
+}
+
+# --- FLEET SETTINGS ---
+FLEET_BATCH_SIZE = 50       # Devices per batched FMG proxy call
+FLEET_ENDPOINTS = (EP_SWITCHES, EP_APS)
+CRAWL_WORKERS = 16          # FortiGates collected at the same time (direct fleet crawler)
+HOST_RATE_LIMIT = 0         # Max. requests per second per host, 0 = unlimited
+HOST_RATE_STATE = {}        # host -> earliest time for the next request
+HOST_RATE_LOCK = threading.Lock()
+
+# --- WATCH SETTINGS ---
+WATCH_INTERVAL = 300        # Seconds between two polls of one gate
+WATCH_JITTER = 0.1          # Random share of the interval added or removed, spreads the polls
+WATCH_CONCURRENCY = 8       # Gates polled at the same time
+WATCH_DETAILS_EVERY = 12    # Polls between two refreshes of hostname and serial
+
+# --- CACHE SETTINGS ---
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".fortitopology")
+FMG_TARGET_CACHE_FILE = os.path.join(CACHE_DIR, "fmg_targets.json")
+FMG_TARGET_CACHE = None     # {"fmg|adom|device": variant index}, loaded on first use
+FMG_TARGET_CACHE_LOCK = threading.Lock()
+RESPONSE_CACHE_DIR = os.path.join(CACHE_DIR, "responses")
+RESPONSE_CACHE_MODE = "off" # 'off', 'record', 'replay' or 'refresh-if-stale'
+RESPONSE_CACHE_TTL = 3600   # Seconds until a cached response is stale
+RESPONSE_CACHE_MODES = ("off", "record", "replay", "refresh-if-stale")
+DEVICE_CACHE_DIR = os.path.join(CACHE_DIR, "devices")  # Last FMG device list per FortiManager
+DEVICE_PAGE_SIZE = 1000     # Devices per paged /dvmdb/device request, 0 = no paging
+DEVICE_FIELDS = ('name', 'hostname', 'sn', 'mgt_vdom', 'oid', 'conn_status', 'ha_slave')
+HISTORY_DB = os.path.join(CACHE_DIR, "history.sqlite")  # Snapshot of every collection, '' = off
+HISTORY_LOCK = threading.Lock()
+
+# --- DRAWIO SETTINGS ---
+DRAWIO_INCREMENTAL = False  # Update existing .drawio files instead of replacing them
+DRAWIO_COMPRESSED = False   # Write the diagram page deflated + base64 (diagrams.net format)
+AGGREGATE_THRESHOLD = 0    # Collapse leaf APs of one parent from this count on, 0 = off
+AGGREGATE_SWITCHES = False # Also collapse leaf switches
+PARTITION_MODE = "none"    # Pages per 'stack' or hostname 'prefix', 'none' = one page
+PARTITION_MODES = ("none", "stack", "prefix")
+PARTITION_SEPARATOR = "-"  # Hostname prefix separator for 'prefix'
+RENDER_WORKERS = os.cpu_count() or 1    # Processes building pages in parallel
+PARALLEL_RENDER_MIN_NODES = 5000        # Smaller diagrams are rendered in-process
+LAYOUT_X_SPACING = 140     # Pixels between devices of one row
+LAYOUT_Y_SPACING = 200     # Pixels between tiers
+LAYOUT_ROW_SPACING = 110   # Pixels between wrapped rows of one tier
+LAYOUT_MAX_ROW = 40        # Devices per row before a tier wraps
+LAYOUT_SWEEPS = 4          # Barycenter sweeps for crossing reduction
+DRAWIO_MODEL_ATTRS = (('dx', "1422"), ('dy', "794"), ('grid', "1"), ('gridSize', "10"), ('guides', "1"),
+                      ('tooltips', "1"), ('connect', "1"), ('arrows', "1"), ('fold', "1"), ('page', "1"),
+                      ('pageScale', "1"), ('pageWidth', "827"), ('pageHeight', "1169"), ('math', "0"), ('shadow', "0"))
+
+# --- EXPORT SETTINGS ---
+ARTIFACT_FORMAT = "fortitopology"
+ARTIFACT_VERSION = 1        # Bumped on incompatible changes of the artifact layout
+ARTIFACT_SUFFIX = ".topo.json.gz"
+WRITE_ARTIFACT = True       # Store the collected topology next to the diagram
+EXPORT_FORMATS = ("drawio",)            # Exporters run after every collection
+EXPORT_WORKERS = 4          # Processes running the other exporters while drawio renders
+PARALLEL_EXPORT_MIN_NODES = 5000        # Smaller topologies are exported in-process
+
+# --- METRICS SETTINGS ---
+METRICS_JSON_FILE = ""      # Write the run metrics as JSON here
+METRICS_PROM_FILE = ""      # Write the run metrics as Prometheus textfile here
+ENDPOINT_PHASES = {EP_LICENSE: "gate_details", EP_SYSTEM: "gate_details", EP_VDOMS: "gate_details",
+                   EP_HA_PEERS: "gate_details", EP_SWITCHES: "switches", EP_APS: "aps"}
+
+# --- GUI SETTINGS ---
+GUI_LOG_INTERVAL_MS = 100   # The main loop writes queued log lines this often
+GUI_LOG_BATCH = 500         # Max. log lines written per interval
+GUI_LOG_QUEUE_SIZE = 20000  # Queued log lines, more are dropped and counted
+GUI_LOG_MAX_LINES = 5000    # Scrollback of the log window
+PICKER_MAX_RESULTS = 200    # Devices shown in the FMG device list
+PICKER_DELAY_MS = 150       # Type-ahead waits this long after the last key
 
 # Callback for GUI Logs
 gui_log_callback = None
-
-def log(message):
-    print(message)
+LOG_STREAM = sys.stdout     # Console output of log(), None = silent
+ERROR_STREAM = None         # Errors still go here while LOG_STREAM is None (quiet CLI runs)
+
+def log(message, error=False):
+    if LOG_STREAM:
+        print(message, file=LOG_STREAM)
+    elif error and ERROR_STREAM:
+        print(message, file=ERROR_STREAM)
     if gui_log_callback:
         gui_log_callback(message)
 
@@ -40,17 +174,636 @@ def clean_id(text):
     if not text: return "unknown"
     return str(text).strip().replace(" ", "_").replace(":", "").replace(".", "").replace("-", "_")
 
+# --- METRICS ---
+def percentile(values, q):
+    """q-th percentile (0..1) of a sorted list, nearest rank."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))]
+
+def prom_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class RunMetrics:
+    """
+    Phase timings and per-request transfer stats of one run or one target.
+    Filled from all worker threads, exported as JSON, Prometheus textfile or table.
+    A parent receives every record too, e.g. the run totals of all targets.
+    """
+    def __init__(self, parent=None):
+        self.lock = threading.Lock()
+        self.parent = parent
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.phases = []        # (phase, seconds, label)
+            self.requests = []      # (method, endpoint, host, status, seconds, bytes)
+            self.retries = {}       # endpoint -> retries
+            self.hedges = {}        # endpoint -> duplicate requests sent
+            self.failures = []      # (endpoint, host, reason) of data given up on
+
+    @contextmanager
+    def phase(self, name, label=""):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start, label)
+
+    def add_phase(self, name, seconds, label=""):
+        with self.lock:
+            self.phases.append((name, seconds, label))
+        if self.parent is not None:
+            self.parent.add_phase(name, seconds, label)
+
+    def add_request(self, method, endpoint, host, status, seconds, size=0):
+        with self.lock:
+            self.requests.append((method, endpoint, host, status, seconds, size))
+        if self.parent is not None:
+            self.parent.add_request(method, endpoint, host, status, seconds, size)
+
+    def add_retry(self, endpoint):
+        with self.lock:
+            self.retries[endpoint] = self.retries.get(endpoint, 0) + 1
+        if self.parent is not None:
+            self.parent.add_retry(endpoint)
+
+    def add_hedge(self, endpoint):
+        with self.lock:
+            self.hedges[endpoint] = self.hedges.get(endpoint, 0) + 1
+        if self.parent is not None:
+            self.parent.add_hedge(endpoint)
+
+    def add_failure(self, endpoint, host, reason):
+        with self.lock:
+            self.failures.append((endpoint, host, str(reason)))
+        if self.parent is not None:
+            self.parent.add_failure(endpoint, host, reason)
+
+    def phase_summary(self):
+        """{phase: {'count', 'seconds', 'max'}} in the order the phases first ran."""
+        summary = {}
+        with self.lock:
+            phases = list(self.phases)
+        for name, seconds, _ in phases:
+            entry = summary.setdefault(name, {'count': 0, 'seconds': 0.0, 'max': 0.0})
+            entry['count'] += 1
+            entry['seconds'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+        return summary
+
+    def request_summary(self):
+        """{endpoint: {'count', 'errors', 'retries', 'hedges', 'bytes', 'status', 'seconds', 'p50', 'p95', 'max'}}"""
+        with self.lock:
+            requests_ = list(self.requests)
+            retries = dict(self.retries)
+            hedges = dict(self.hedges)
+        latencies = {}
+        summary = {}
+
+        def entry_of(endpoint):
+            return summary.setdefault(endpoint, {'count': 0, 'errors': 0, 'retries': 0, 'hedges': 0, 'bytes': 0,
+                                                 'status': {}})
+
+        for method, endpoint, host, status, seconds, size in requests_:
+            entry = entry_of(endpoint)
+            entry['count'] += 1
+            entry['bytes'] += size
+            entry['status'][str(status)] = entry['status'].get(str(status), 0) + 1
+            if status != 200: entry['errors'] += 1
+            latencies.setdefault(endpoint, []).append(seconds)
+        for endpoint, count in retries.items():
+            entry_of(endpoint)['retries'] = count
+        for endpoint, count in hedges.items():
+            entry_of(endpoint)['hedges'] = count
+        for endpoint, entry in summary.items():
+            values = sorted(latencies.get(endpoint, []))
+            entry['seconds'] = sum(values)
+            entry['p50'] = percentile(values, 0.5)
+            entry['p95'] = percentile(values, 0.95)
+            entry['max'] = values[-1] if values else 0.0
+        return summary
+
+    def to_dict(self):
+        with self.lock:
+            requests_ = [{'method': m, 'endpoint': e, 'host': h, 'status': st, 'seconds': round(sec, 6), 'bytes': b}
+                         for m, e, h, st, sec, b in self.requests]
+            phases = [{'phase': n, 'seconds': round(sec, 6), 'label': l} for n, sec, l in self.phases]
+            failures = [{'endpoint': e, 'host': h, 'reason': r} for e, h, r in self.failures]
+        return {
+            'started': self.started,
+            'duration': round(time.time() - self.started, 6),
+            'phases': self.phase_summary(),
+            'endpoints': self.request_summary(),
+            'phase_spans': phases,
+            'requests': requests_,
+            'failures': failures,
+        }
+
+    def to_prometheus(self):
+        lines = [
+            "# HELP fortitopology_run_timestamp_seconds Start of the last run",
+            "# TYPE fortitopology_run_timestamp_seconds gauge",
+            f"fortitopology_run_timestamp_seconds {self.started:.3f}",
+            "# HELP fortitopology_run_duration_seconds Duration of the last run",
+            "# TYPE fortitopology_run_duration_seconds gauge",
+            f"fortitopology_run_duration_seconds {time.time() - self.started:.6f}",
+            "# HELP fortitopology_phase_seconds Time spent per phase, summed over all threads",
+            "# TYPE fortitopology_phase_seconds gauge",
+        ]
+        phases = self.phase_summary()
+        for name, entry in phases.items():
+            lines.append(f'fortitopology_phase_seconds{{phase="{prom_label(name)}"}} {entry["seconds"]:.6f}')
+        endpoints = self.request_summary()
+        for metric, key, help_text in (
+            ("fortitopology_request_seconds", None, "Request latency per endpoint"),
+            ("fortitopology_response_bytes_total", 'bytes', "Response bytes per endpoint"),
+            ("fortitopology_retries_total", 'retries', "Retries per endpoint"),
+            ("fortitopology_hedges_total", 'hedges', "Hedged duplicate requests per endpoint"),
+            ("fortitopology_requests_total", 'status', "Requests per endpoint and status"),
+        ):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {'summary' if key is None else 'counter'}")
+            for endpoint, entry in endpoints.items():
+                label = f'endpoint="{prom_label(endpoint)}"'
+                if key is None:
+                    for q, key_q in (("0.5", 'p50'), ("0.95", 'p95'), ("1", 'max')):
+                        lines.append(f'{metric}{{{label},quantile="{q}"}} {entry[key_q]:.6f}')
+                    lines.append(f"{metric}_sum{{{label}}} {entry['seconds']:.6f}")
+                    lines.append(f"{metric}_count{{{label}}} {entry['count']}")
+                elif key == 'status':
+                    for status, count in entry['status'].items():
+                        lines.append(f'{metric}{{{label},status="{prom_label(status)}"}} {count}')
+                else:
+                    lines.append(f"{metric}{{{label}}} {entry[key]}")
+        with self.lock:
+            failures = len(self.failures)
+        lines += [
+            "# HELP fortitopology_failed_fetches Endpoints given up on after all retries",
+            "# TYPE fortitopology_failed_fetches gauge",
+            f"fortitopology_failed_fetches {failures}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def summary_table(self):
+        """Text table of phases and endpoints for the end of a run."""
+        lines = [f"{'Phase':<28}{'Count':>7}{'Total s':>10}{'Max s':>9}"]
+        for name, entry in self.phase_summary().items():
+            lines.append(f"{name:<28}{entry['count']:>7}{entry['seconds']:>10.3f}{entry['max']:>9.3f}")
+        endpoints = self.request_summary()
+        if endpoints:
+            lines.append("")
+            lines.append(f"{'Endpoint':<60}{'Req':>5}{'Err':>5}{'Retry':>6}{'Hedge':>6}{'KB':>9}"
+                         f"{'p50 s':>8}{'p95 s':>8}{'Max s':>8}")
+            for endpoint, e in sorted(endpoints.items()):
+                name = endpoint if len(endpoint) <= 59 else endpoint[:56] + "..."
+                lines.append(f"{name:<60}{e['count']:>5}{e['errors']:>5}{e['retries']:>6}{e['hedges']:>6}"
+                             f"{e['bytes'] / 1024:>9.1f}{e['p50']:>8.3f}{e['p95']:>8.3f}{e['max']:>8.3f}")
+        with self.lock:
+            failures = list(self.failures)
+        if failures:
+            lines.append("")
+            lines.append(f"INCOMPLETE: {len(failures)} requests failed, the diagram misses their data:")
+            for endpoint, host, reason in failures[:20]:
+                lines.append(f"  {host} {endpoint}: {reason}")
+            if len(failures) > 20:
+                lines.append(f"  ... and {len(failures) - 20} more")
+        return "\n".join(lines)
+
+METRICS = RunMetrics()
+
+def write_metrics(json_path=None, prom_path=None, metrics=None):
+    """
+    Writes the metrics of a target, by default the run totals (METRICS).
+    Prometheus textfiles are replaced atomically for the node exporter.
+    """
+    metrics = METRICS if metrics is None else metrics
+    json_path = METRICS_JSON_FILE if json_path is None else json_path
+    prom_path = METRICS_PROM_FILE if prom_path is None else prom_path
+    for path, content in ((json_path, lambda: json.dumps(metrics.to_dict(), indent=2)),
+                          (prom_path, metrics.to_prometheus)):
+        if not path:
+            continue
+        try:
+            tmp_file = f"{path}.tmp"
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                f.write(content())
+            os.replace(tmp_file, path)
+            log(f"Metrics saved: {path}")
+        except OSError as e:
+            log(f"Metrics not saved ({e})")
+
+class TimedWriter:
+    """File wrapper that adds the time spent in write() to the 'file_write' phase."""
+    def __init__(self, f):
+        self.f = f
+        self.seconds = 0.0
+
+    def write(self, data):
+        start = time.perf_counter()
+        result = self.f.write(data)
+        self.seconds += time.perf_counter() - start
+        return result
+
+# --- CONTEXT ---
+# Run settings a Target takes over from target_settings() or its FMG parent
+TARGET_SETTINGS = ('rate_limit', 'cache_mode', 'cache_ttl', 'page_size', 'retry_attempts', 'timeout_max',
+                   'hedge_proxy', 'history_db')
+
+class Target:
+    """
+    Connection parameters, run settings and metrics of one FortiGate (DIRECT) or FortiManager (FMG).
+    Every collector function takes a Target, so several targets can run in one process.
+    """
+    def __init__(self, ip, port="", token="", mode="DIRECT", device=None, user="", password="", settings=None):
+        self.mode = mode            # 'DIRECT' or 'FMG'
+        self.ip = ip                # IP Adress (Gate or FMG)
+        self.port = str(port or "") # Port (Gate or FMG)
+        self.token = token          # API Token
+        self.user = user            # FMG user for session login (if no token)
+        self.password = password    # FMG password for session login
+        self.session = ""           # FMG JSON-RPC session
+        self.rpc_sessions = []      # Every session opened for this FMG, also by device targets
+        self.device = device or {}  # Selected FortiGate in FMG mode (name, serial, adom, oid)
+        self.rate_limit = HOST_RATE_LIMIT   # Max. requests per second to this host
+        self.cache_mode = RESPONSE_CACHE_MODE
+        self.cache_ttl = RESPONSE_CACHE_TTL
+        self.page_size = PAGE_SIZE          # Records per paged request, 0 = no paging
+        self.retry_attempts = RETRY_ATTEMPTS
+        self.timeout_max = TIMEOUT_MAX
+        self.hedge_proxy = HEDGE_PROXY
+        self.history_db = HISTORY_DB        # '' = no history
+        self.metrics = RunMetrics(METRICS)  # Counted in the run totals as well
+        self.latencies = LatencyTracker()   # Request policy state, kept over the runs of this target
+        self.breaker = CircuitBreaker()
+        self.lock = threading.Lock()
+        self.apply(settings or {})
+
+    @property
+    def host(self):
+        """Key of the host for latency tracking and circuit breaking."""
+        return f"{self.ip}:{self.port}" if self.port else self.ip
+
+    @property
+    def base_url(self):
+        if self.port:
+            return f"https://{self.ip}:{self.port}"
+        return f"https://{self.ip}"
+
+    @property
+    def failures(self):
+        """(endpoint, host, reason) of the data given up on, see record_failure()."""
+        return self.metrics.failures
+
+    def apply(self, settings):
+        """Takes over run settings {name: value}, names from TARGET_SETTINGS."""
+        for key, value in settings.items():
+            if key not in TARGET_SETTINGS:
+                raise ValueError(f"Unknown target setting: {key}")
+            setattr(self, key, value)
+        return self
+
+    def settings(self):
+        return {key: getattr(self, key) for key in TARGET_SETTINGS}
+
+    def for_device(self, device):
+        """Same FMG connection and settings, other managed FortiGate. Its metrics count for the FMG too."""
+        ctx = Target(self.ip, self.port, self.token, "FMG", device, self.user, self.password, self.settings())
+        ctx.session = self.session
+        ctx.rpc_sessions = self.rpc_sessions
+        ctx.metrics = RunMetrics(self.metrics)
+        ctx.latencies = self.latencies      # Same host
+        ctx.breaker = self.breaker
+        return ctx
+
+    def __repr__(self):
+        name = f" {self.device.get('name')}" if self.device else ""
+        return f"<Target {self.mode} {self.ip}{name}>"
+
+# --- TRANSPORT ---
+def get_http_session(ctx):
+    """
+    Returns the pooled keep-alive session for a target.
+    One session per (host, port), so TCP/TLS handshakes are only paid once per run.
+    """
+    key = (ctx.ip, ctx.port)
+
+    with HTTP_SESSIONS_LOCK:
+        session = HTTP_SESSIONS.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.headers.update({
+                'Accept-Encoding': 'gzip, deflate',
+                'Connection': 'keep-alive'
+            })
+            HTTP_SESSIONS[key] = session
+    return session
+
+def wait_for_rate_limit(ctx):
+    """Spaces requests to one host to at most ctx.rate_limit per second."""
+    if not ctx.rate_limit:
+        return
+    with HOST_RATE_LOCK:
+        now = time.monotonic()
+        slot = max(now, HOST_RATE_STATE.get(ctx.ip, 0))
+        HOST_RATE_STATE[ctx.ip] = slot + 1.0 / ctx.rate_limit
+    if slot > now:
+        time.sleep(slot - now)
+
+def http_request(ctx, method, url, label, **kwargs):
+    """
+    Rate limited request on the pooled session, recorded in ctx.metrics under label.
+    Raises the requests exceptions like the session does.
+    """
+    wait_for_rate_limit(ctx)
+    status = "error"
+    size = 0
+    start = time.perf_counter()
+    try:
+        response = get_http_session(ctx).request(method, url, verify=False, **kwargs)
+        status = response.status_code
+        size = len(response.content)
+        return response
+    except requests.Timeout:
+        status = "timeout"
+        raise
+    finally:
+        ctx.metrics.add_request(method, label, ctx.ip, status, time.perf_counter() - start, size)
+
+# --- REQUEST POLICY ---
+class CircuitOpenError(requests.ConnectionError):
+    """Request not sent, the host failed too often in a row."""
+
+class LatencyTracker:
+    """
+    Latest latencies per (host, endpoint), the base of adaptive timeouts and hedging.
+    Endpoints without enough samples on a host use the samples of all hosts.
+    """
+    def __init__(self, window=LATENCY_WINDOW):
+        self.lock = threading.Lock()
+        self.window = window
+        self.samples = {}           # (host, endpoint) -> deque of seconds
+        self.by_endpoint = {}       # endpoint -> deque of seconds, all hosts
+
+    def observe(self, host, endpoint, seconds):
+        with self.lock:
+            for store, key in ((self.samples, (host, endpoint)), (self.by_endpoint, endpoint)):
+                values = store.get(key)
+                if values is None:
+                    values = store[key] = deque(maxlen=self.window)
+                values.append(seconds)
+
+    def quantile(self, host, endpoint, q):
+        """q-percentile latency, None while there are less than LATENCY_MIN_SAMPLES."""
+        with self.lock:
+            values = self.samples.get((host, endpoint))
+            if values is None or len(values) < LATENCY_MIN_SAMPLES:
+                values = self.by_endpoint.get(endpoint)
+            if values is None or len(values) < LATENCY_MIN_SAMPLES:
+                return None
+            values = sorted(values)
+        return percentile(values, q)
+
+    def timeout(self, host, endpoint, method, limit=None):
+        """Timeout from the p99 latency, at most limit (default TIMEOUT_MAX) seconds."""
+        limit = TIMEOUT_MAX if limit is None else limit
+        p99 = self.quantile(host, endpoint, 0.99)
+        if p99 is None:
+            return min(limit, TIMEOUT_DEFAULTS.get(method, TIMEOUT_DEFAULTS['GET']))
+        return min(limit, max(TIMEOUT_MIN, TIMEOUT_FACTOR * p99))
+
+class CircuitBreaker:
+    """
+    Per host: BREAKER_FAILURES failed requests in a row open the circuit, then
+    requests fail at once. After BREAKER_COOLDOWN one trial request decides
+    whether the circuit closes again.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.failures = {}          # host -> failures in a row
+        self.opened = {}            # host -> time the circuit opened
+        self.trial = set()          # hosts with a trial request in flight
+
+    def allow(self, host):
+        with self.lock:
+            opened = self.opened.get(host)
+            if opened is None:
+                return True
+            if host in self.trial or time.monotonic() - opened < BREAKER_COOLDOWN:
+                return False
+            self.trial.add(host)
+            return True
+
+    def is_open(self, host):
+        with self.lock:
+            return host in self.opened
+
+    def success(self, host):
+        with self.lock:
+            self.failures.pop(host, None)
+            self.trial.discard(host)
+            if self.opened.pop(host, None) is not None:
+                log(f"{host}: answers again, circuit closed")
+
+    def failure(self, host):
+        with self.lock:
+            self.failures[host] = self.failures.get(host, 0) + 1
+            was_trial = host in self.trial
+            self.trial.discard(host)
+            if was_trial or (host not in self.opened and self.failures[host] >= BREAKER_FAILURES):
+                if host not in self.opened:
+                    log(f"{host}: {self.failures[host]} failed requests in a row, circuit open for {BREAKER_COOLDOWN}s")
+                self.opened[host] = time.monotonic()
+
+    def reset(self):
+        with self.lock:
+            self.failures.clear()
+            self.opened.clear()
+            self.trial.clear()
+
+def record_failure(ctx, endpoint, reason):
+    """Data given up on: the collection of the target is incomplete."""
+    ctx.metrics.add_failure(endpoint, ctx.ip, reason)
+
+HEDGE_EXECUTOR = None
+HEDGE_EXECUTOR_LOCK = threading.Lock()
+
+def hedged_request(ctx, method, url, label, delay, **kwargs):
+    """
+    Sends a duplicate if the request has no answer after delay seconds and
+    returns the first answer. The slower one runs out in the background.
+    """
+    global HEDGE_EXECUTOR
+    with HEDGE_EXECUTOR_LOCK:
+        if HEDGE_EXECUTOR is None:
+            HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=HEDGE_WORKERS)
+    pending = {HEDGE_EXECUTOR.submit(http_request, ctx, method, url, label, **kwargs)}
+    done, _ = wait(pending, timeout=delay)
+    if not done:
+        ctx.metrics.add_hedge(label)
+        pending.add(HEDGE_EXECUTOR.submit(http_request, ctx, method, url, label, **kwargs))
+
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                response = future.result()
+            except Exception as e:
+                error = error or e
+                continue
+            if response.status_code < 500 or not pending:
+                return response
+    raise error
+
+def policy_request(ctx, method, url, label, idempotent=False, hedge=False, **kwargs):
+    """
+    http_request with the request policy: timeout from the latency percentiles of
+    the endpoint, bounded retries with exponential backoff for idempotent requests,
+    an optional hedged duplicate and the circuit breaker of the host.
+    Raises like http_request, CircuitOpenError while the circuit is open.
+    """
+    attempts = max(1, ctx.retry_attempts) if idempotent else 1
+    timeout = ctx.latencies.timeout(ctx.host, label, method, ctx.timeout_max)
+    hedge_delay = None
+    if hedge:
+        p95 = ctx.latencies.quantile(ctx.host, label, 0.95)
+        if p95 is not None:
+            hedge_delay = min(max(HEDGE_MIN_DELAY, p95), timeout / 2)
+
+    for attempt in range(attempts):
+        if not ctx.breaker.allow(ctx.host):
+            ctx.metrics.add_request(method, label, ctx.ip, "circuit_open", 0.0)
+            raise CircuitOpenError(f"{ctx.host}: circuit open, request not sent")
+        if attempt:
+            ctx.metrics.add_retry(label)
+
+        # Every retry waits twice as long, a too tight timeout corrects itself
+        attempt_timeout = min(ctx.timeout_max, timeout * 2 ** attempt)
+        start = time.perf_counter()
+        try:
+            if hedge_delay is not None:
+                response = hedged_request(ctx, method, url, label, hedge_delay, timeout=attempt_timeout, **kwargs)
+            else:
+                response = http_request(ctx, method, url, label, timeout=attempt_timeout, **kwargs)
+        except Exception as e:
+            # Every failure counts, also broken bodies, so a trial request always ends the trial
+            ctx.breaker.failure(ctx.host)
+            if isinstance(e, requests.Timeout):
+                ctx.latencies.observe(ctx.host, label, attempt_timeout)
+            if attempt + 1 >= attempts or not isinstance(e, requests.RequestException):
+                raise
+            log(f"{label}: {type(e).__name__}, retry {attempt + 1} of {attempts - 1}")
+            time.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** attempt))
+            continue
+
+        ctx.latencies.observe(ctx.host, label, time.perf_counter() - start)
+        if response.status_code >= 500:
+            ctx.breaker.failure(ctx.host)
+        else:
+            ctx.breaker.success(ctx.host)
+        if response.status_code not in RETRY_STATUSES or attempt + 1 >= attempts:
+            return response
+
+        # Rate limited or busy: Retry-After if given, otherwise backoff
+        delay = random.uniform(0, RETRY_BACKOFF * 2 ** attempt)
+        retry_after = response.headers.get('Retry-After', "")
+        if retry_after.isdigit():
+            delay = min(float(retry_after), ctx.timeout_max)
+        log(f"{label}: HTTP {response.status_code}, retry {attempt + 1} of {attempts - 1}")
+        time.sleep(delay)
+
+def close_http_session(ctx):
+    with HTTP_SESSIONS_LOCK:
+        session = HTTP_SESSIONS.pop((ctx.ip, ctx.port), None)
+    if session is not None:
+        session.close()
+
+def close_http_sessions():
+    with HTTP_SESSIONS_LOCK:
+        for session in HTTP_SESSIONS.values():
+            session.close()
+        HTTP_SESSIONS.clear()
+
 # JSON communication to FMG
-def fmg_json_rpc(method, url, payload=None):
+def fmg_login(ctx):
+    """
+    Opens a JSON-RPC session with user/password. The session id is reused
+    for all following calls until it expires.
+    """
+    body = {
+        "method": "exec",
+        "params": [
+            {
+                "url": "/sys/login/user",
+                "data": {"user": ctx.user, "passwd": ctx.password}
+            }
+        ],
+        "id": 1
+    }
+
+    try:
+        response = policy_request(ctx, "POST", f"{ctx.base_url}/jsonrpc", "/sys/login/user", json=body)
+        json_resp = response.json()
+        status = json_resp['result'][0].get('status', {})
+        if status.get('code') == 0 and json_resp.get('session'):
+            ctx.session = json_resp['session']
+            ctx.rpc_sessions.append(ctx.session)
+            log("FMG session opened")
+            return True
+        log(f"FMG Login Error: {status.get('message')} (Code {status.get('code')})", error=True)
+    except Exception as e:
+        log(f"FMG Login Exception: {e}", error=True)
+
+    ctx.session = ""
+    return False
+
+def fmg_logout(ctx):
+    """Closes every JSON-RPC session opened for the FMG, also by its device targets, and the pooled HTTP session."""
+    sessions = list(dict.fromkeys(ctx.rpc_sessions + ([ctx.session] if ctx.session else [])))
+    for session in sessions:
+        body = {
+            "method": "exec",
+            "params": [{"url": "/sys/logout"}],
+            "session": session,
+            "id": 1
+        }
+        try:
+            policy_request(ctx, "POST", f"{ctx.base_url}/jsonrpc", "/sys/logout", json=body)
+        except Exception:
+            pass
+    ctx.rpc_sessions.clear()
+    ctx.session = ""
+    close_http_session(ctx)
+
+def fmg_json_rpc(ctx, method, url, payload=None):
     """
     Sendet einen JSON-RPC Request an den FortiManager.
     """
+    return fmg_json_rpc_batch(ctx, method, [(url, payload)])[0]
+
+def rpc_label(calls):
+    """Metrics label of a JSON-RPC request: its urls, proxied resources without query."""
+    labels = []
+    for url, payload in calls:
+        if url == "/sys/proxy/json" and payload:
+            url = f"{url} {str(payload.get('resource', '')).split('?')[0]}"
+        if url not in labels:
+            labels.append(url)
+    return ",".join(labels)
+
+def fmg_json_rpc_batch(ctx, method, calls, _retry=True):
+    """
+    Sends several (url, payload) calls in one JSON-RPC request.
+    Returns one data entry per call, None for failed calls.
+    """
+
+    headers = {'Content-Type': 'application/json'}
 
-    headers = {
-        'Authorization': f'Bearer {CURRENT_TOKEN}',
-        'Content-Type': 'application/json'
-    }
-    
     body = {
         "method": method,
         "params": [
@@ -58,14 +811,30 @@ def fmg_json_rpc(method, url, payload=None):
                 "url": url,
                 "data": payload if payload else {}
             }
+            for url, payload in calls
         ],
         "id": 1
     }
+    failed = [None] * len(calls)
+
+    # Token auth or reusable session from user/password login
+    if ctx.token:
+        headers['Authorization'] = f'Bearer {ctx.token}'
+    elif ctx.user:
+        with ctx.lock:
+            if not ctx.session and not fmg_login(ctx):
+                return failed
+        body['session'] = ctx.session
+
+    full_url = f"{ctx.base_url}/jsonrpc"
 
-    full_url = f"https://{CURRENT_IP}:{CURRENT_PORT}/jsonrpc"
+    # Reads may be repeated, proxied reads also hedged
+    proxy_get = all(url == "/sys/proxy/json" and (payload or {}).get('action') == "get" for url, payload in calls)
+    idempotent = method == "get" or proxy_get
 
     try:
-        response = requests.post(full_url, json=body, headers=headers, verify=False, timeout=15)
+        response = policy_request(ctx, "POST", full_url, rpc_label(calls), idempotent=idempotent,
+                                  hedge=ctx.hedge_proxy and proxy_get, json=body, headers=headers)
         
         log(f"Connecting")
 
@@ -77,71 +846,218 @@ def fmg_json_rpc(method, url, payload=None):
             
             # Error Handling for JSON Body
             if 'result' in json_resp and len(json_resp['result']) > 0:
-                result_obj = json_resp['result'][0]
-
-                status = result_obj.get('status', {})
-                
-                # Code 0 --> Success
-                if status.get('code') == 0:
-                    return result_obj.get('data')
-                else:
-                    log(f"FMG RPC Error: {status.get('message')} (Code {status.get('code')})")
-                    return None
+                results = []
+                for result_obj in json_resp['result'][:len(calls)]:
+                    status = result_obj.get('status', {})
+                    
+                    # Code 0 --> Success
+                    if status.get('code') == 0:
+                        results.append(result_obj.get('data'))
+                    # Code -11 --> Session expired, login again once
+                    elif status.get('code') == -11 and 'session' in body and _retry:
+                        log("FMG session expired, login again")
+                        with ctx.lock:
+                            logged_in = fmg_login(ctx)
+                        if logged_in:
+                            ctx.metrics.add_retry(rpc_label(calls))
+                            return fmg_json_rpc_batch(ctx, method, calls, _retry=False)
+                        return failed
+                    else:
+                        log(f"FMG RPC Error: {status.get('message')} (Code {status.get('code')})")
+                        results.append(None)
+                return results + failed[len(results):]
             else:
                 log(f"FMG Empty Response: {json_resp}")
-                return None
+                return failed
         else:
-            log(f"FMG HTTP Error: {response.status_code}")
-            return None
+            log(f"FMG HTTP Error: {response.status_code}", error=True)
+            if response.status_code >= 500 or response.status_code == 429:
+                record_failure(ctx, rpc_label(calls), f"HTTP {response.status_code}")
+            return failed
+
+    except Exception as e:
+        log(f"FMG Exception: {e}", error=True)
+        record_failure(ctx, rpc_label(calls), e)
+        return failed
+
+# --- FMG TARGET CACHE ---
+def load_fmg_target_cache():
+    global FMG_TARGET_CACHE
+    if FMG_TARGET_CACHE is None:
+        try:
+            with open(FMG_TARGET_CACHE_FILE, "r", encoding="utf-8") as f:
+                FMG_TARGET_CACHE = json.load(f)
+        except Exception:
+            FMG_TARGET_CACHE = {}
+    return FMG_TARGET_CACHE
 
+def save_fmg_target_cache():
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_file = FMG_TARGET_CACHE_FILE + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(FMG_TARGET_CACHE, f, indent=1, sort_keys=True)
+        os.replace(tmp_file, FMG_TARGET_CACHE_FILE)
     except Exception as e:
-        log(f"FMG Exception: {e}")
+        log(f"Could not save target cache: {e}")
+
+def fmg_proxy_targets(device):
+    """The /sys/proxy/json target forms of a device, in the order fetch_data probes them."""
+    dev_name = device.get('name')
+    dev_adom = device.get('adom', 'root')
+    return [
+        # 1. Path as String
+        f"adom/{dev_adom}/device/{dev_name}",
+
+        # 2. Path as List
+        [f"adom/{dev_adom}/device/{dev_name}"],
+
+        # 3. Global Path as List
+        [f"device/{dev_name}"],
+
+        # 4. Only name as List
+        [dev_name],
+
+        # 5. Only name
+        dev_name
+    ]
+
+def proxy_target_error(data):
+    """Message of a proxy answer whose entries all failed, e.g. an unknown target form. '' if any answered."""
+    if not isinstance(data, list) or not data:
+        return ""
+    codes = [entry.get('status', {}) for entry in data if isinstance(entry, dict)]
+    if len(codes) < len(data) or any(status.get('code', 0) == 0 for status in codes):
+        return ""
+    return f"{codes[0].get('message')} (Code {codes[0].get('code')})"
+
+def fmg_target_key(ctx, device):
+    return f"{ctx.ip}:{ctx.port}|{device.get('adom', 'root')}|{device.get('name')}"
+
+def get_cached_target_variant(key):
+    with FMG_TARGET_CACHE_LOCK:
+        return load_fmg_target_cache().get(key)
+
+def set_cached_target_variant(key, index):
+    """Stores the working variant for a device. index None invalidates the entry."""
+    with FMG_TARGET_CACHE_LOCK:
+        cache = load_fmg_target_cache()
+        if cache.get(key) == index:
+            return
+        if index is None:
+            cache.pop(key, None)
+        else:
+            cache[key] = index
+        save_fmg_target_cache()
+
+# --- RESPONSE CACHE ---
+def response_cache_key(ctx, resource):
+    parts = [f"{ctx.ip}:{ctx.port}", ctx.mode]
+    if ctx.mode == "FMG" and ctx.device:
+        parts += [ctx.device.get('adom', 'root'), ctx.device.get('name', '')]
+    parts.append(resource)
+    return "|".join(str(p) for p in parts)
+
+def response_cache_file(key):
+    return os.path.join(RESPONSE_CACHE_DIR, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json.gz")
+
+def load_cached_response(key):
+    """Returns (age in seconds, data) or None."""
+    try:
+        with gzip.open(response_cache_file(key), "rt", encoding="utf-8") as f:
+            entry = json.load(f)
+        return time.time() - entry['time'], entry['data']
+    except Exception:
         return None
 
-def get_data(endpoint):
+def save_cached_response(key, data):
+    try:
+        os.makedirs(RESPONSE_CACHE_DIR, exist_ok=True)
+        filename = response_cache_file(key)
+        tmp_file = f"{filename}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_file, "wt", encoding="utf-8", compresslevel=6) as f:
+            json.dump({'key': key, 'time': time.time(), 'data': data}, f, separators=(",", ":"))
+        os.replace(tmp_file, filename)
+    except Exception as e:
+        log(f"Could not save response cache: {e}")
+
+def cached_fetch(ctx, resource, fetch, empty=None):
+    """
+    Runs fetch() through the response cache according to ctx.cache_mode:
+    record (fetch and store), replay (cache only, no network) or
+    refresh-if-stale (cache if younger than ctx.cache_ttl, otherwise fetch and store).
+    Empty or failed answers are never stored.
+    """
+    mode = ctx.cache_mode
+    if mode not in RESPONSE_CACHE_MODES or mode == "off":
+        return fetch()
+
+    key = response_cache_key(ctx, resource)
+    if mode in ("replay", "refresh-if-stale"):
+        cached = load_cached_response(key)
+        if cached is not None:
+            age, data = cached
+            if mode == "replay" or age < ctx.cache_ttl:
+                return data
+        if mode == "replay":
+            log(f"Not in cache: {resource}")
+            return empty
+
+    data = fetch()
+    if data:
+        save_cached_response(key, data)
+    return data
+
+def get_data(ctx, endpoint):
+    return cached_fetch(ctx, endpoint, lambda: fetch_data(ctx, endpoint),
+                        empty=[] if ctx.mode == "DIRECT" else {})
+
+def fetch_data(ctx, endpoint):
     # Direct mode
-    if CONNECTION_MODE == "DIRECT":
-        headers = {'Authorization': f'Bearer {CURRENT_TOKEN}'}
+    if ctx.mode == "DIRECT":
+        headers = {'Authorization': f'Bearer {ctx.token}'}
         try:
-            full_url = f"https://{CURRENT_IP}:{CURRENT_PORT}/api/v2{endpoint}"
-            response = requests.get(full_url, headers=headers, verify=False, timeout=8)
+            full_url = f"{ctx.base_url}/api/v2{endpoint}"
+            response = policy_request(ctx, "GET", full_url, endpoint_path(endpoint), idempotent=True, headers=headers)
             if response.status_code == 200:
                 data = response.json()
                 return data
+            log(f"Error {endpoint}: HTTP {response.status_code}", error=True)
+            # Without switches or APs the diagram is incomplete, whatever the status
+            if response.status_code >= 500 or response.status_code == 429 or endpoint_path(endpoint) in ENDPOINT_FIELDS:
+                record_failure(ctx, endpoint_path(endpoint), f"HTTP {response.status_code}")
             return []
         except Exception as e:
-            log(f"Error {endpoint}: {e}")
+            log(f"Error {endpoint}: {e}", error=True)
+            record_failure(ctx, endpoint_path(endpoint), e)
             return []
 
     # FMG mode
-    elif CONNECTION_MODE == "FMG":
-        if not SELECTED_DEVICE_DATA:
+    elif ctx.mode == "FMG":
+        if not ctx.device:
             return {}
 
-        dev_name = SELECTED_DEVICE_DATA.get('name')
-        dev_adom = SELECTED_DEVICE_DATA.get('adom', 'root')
+        targets_to_try = fmg_proxy_targets(ctx.device)
 
-        targets_to_try = [
-            # 1. Path as String
-            f"adom/{dev_adom}/device/{dev_name}",
+        # Known variant first, probe the others only if it fails
+        cache_key = fmg_target_key(ctx, ctx.device)
+        cached_index = get_cached_target_variant(cache_key)
+        order = list(range(len(targets_to_try)))
+        if cached_index in order:
+            order.remove(cached_index)
+            order.insert(0, cached_index)
 
-            # 2. Path as List
-            [f"adom/{dev_adom}/device/{dev_name}"],
-            
-            # 3. Global Path as List
-            [f"device/{dev_name}"],
-            
-            # 4. Only name as List
-            [dev_name],            
-            
-            # 5. Only name
-            dev_name
-        ]
-        
-        for i, target_variant in enumerate(targets_to_try):
-            target_path = target_variant
+        failed_before = len(ctx.failures)
+        for attempt, i in enumerate(order):
+            # Other target forms will not help while the FMG does not answer at all
+            if attempt and ctx.breaker.is_open(ctx.host):
+                log(f"{ctx.ip}: circuit open, target probing stopped")
+                break
+            target_path = targets_to_try[i]
 
             log(f"{target_path}")
+            if attempt:
+                ctx.metrics.add_retry(f"/sys/proxy/json /api/v2{endpoint_path(endpoint)}")
 
             # Create Payload
             payload = {
@@ -150,16 +1066,26 @@ def get_data(endpoint):
                 "resource": f"/api/v2{endpoint}"
             }
             
-            result = fmg_json_rpc("exec", "/sys/proxy/json", payload)
+            result = fmg_json_rpc(ctx, "exec", "/sys/proxy/json", payload)
             
-            # Handle result
+            # Handle result, the FMG reports unknown targets per entry
             data = result
+            if data is not None and proxy_target_error(data):
+                log(f"Proxy target: {proxy_target_error(data)}")
+                data = None
             if data is not None: 
+                set_cached_target_variant(cache_key, i)
                 return data
-            
+
+            if i == cached_index:
+                log("Cached target variant failed, probing again")
+                set_cached_target_variant(cache_key, None)
+
+        if len(ctx.failures) == failed_before:
+            record_failure(ctx, endpoint_path(endpoint), "no proxy target answered")
         return {}
     
-def get_gate_details():
+def get_gate_details(ctx, license_data=None, status_data=None):
     """Holt Infos. Im FMG Modus vertrauen wir der Auswahl."""
     log("Fetching Hostname and Serial")
     
@@ -167,19 +1093,19 @@ def get_gate_details():
     hostname = "MyFortiGate"
     
     # Serial Number is known from selection
-    if CONNECTION_MODE == "FMG" and SELECTED_DEVICE_DATA:
-        serial = SELECTED_DEVICE_DATA.get('serial')
-        hostname = SELECTED_DEVICE_DATA.get('name')
+    if ctx.mode == "FMG" and ctx.device:
+        serial = ctx.device.get('serial')
+        hostname = ctx.device.get('name')
         log(f"Gateway: {hostname} ({serial})")
 
-    # Serial Number via API for Direct Mode
-    elif CONNECTION_MODE == "DIRECT":
+    # Serial Number via API for Direct Mode (prefetched by collect_endpoints)
+    elif ctx.mode == "DIRECT":
         try:
-            res = get_data("/monitor/license/status")
+            res = license_data if license_data is not None else get_data(ctx, EP_LICENSE)
             serial = res.get('serial')
         except: pass
         try:
-            res = get_data("/monitor/system/status")
+            res = status_data if status_data is not None else get_data(ctx, EP_SYSTEM)
             results = res.get('results')
             hostname = results.get('hostname')
         except: pass
@@ -189,259 +1115,2240 @@ def get_gate_details():
     log(f"Target: {hostname} ({serial})")
     return serial, hostname
 
-def fetch_fmg_devices():
+def fmg_device_cache_file(ctx):
+    key = f"{ctx.ip}:{ctx.port}"
+    return os.path.join(DEVICE_CACHE_DIR, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json.gz")
+
+def load_fmg_device_cache(ctx):
+    """Returns (age in seconds, device map) of the last device list of this FMG, or None."""
+    try:
+        with gzip.open(fmg_device_cache_file(ctx), "rt", encoding="utf-8") as f:
+            entry = json.load(f)
+        return time.time() - entry['time'], entry['devices']
+    except Exception:
+        return None
+
+def save_fmg_device_cache(ctx, device_map):
+    try:
+        os.makedirs(DEVICE_CACHE_DIR, exist_ok=True)
+        filename = fmg_device_cache_file(ctx)
+        tmp_file = f"{filename}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_file, "wt", encoding="utf-8", compresslevel=6) as f:
+            json.dump({'fmg': f"{ctx.ip}:{ctx.port}", 'time': time.time(), 'devices': device_map}, f, separators=(",", ":"))
+        os.replace(tmp_file, filename)
+    except Exception as e:
+        log(f"Could not save device list: {e}")
+
+def iter_fmg_device_pages(ctx, page_size=None):
+    """Yields the managed devices page by page, only with DEVICE_FIELDS."""
+    if page_size is None:
+        page_size = DEVICE_PAGE_SIZE
+    start = 0
+    previous_first = None
+    while True:
+        payload = {
+            "option": "1",
+            "fields": list(DEVICE_FIELDS)
+        }
+        resource = "/dvmdb/device"
+        if page_size:
+            payload["range"] = [start, page_size]
+            resource = f"/dvmdb/device?range={start},{page_size}"
+
+        page = cached_fetch(ctx, resource, lambda: fmg_json_rpc(ctx, "get", "/dvmdb/device", payload))
+        if not page or not isinstance(page, list):
+            return
+
+        # Same first device again: the FMG ignores 'range'
+        first = repr(page[0])
+        if first == previous_first:
+            return
+        previous_first = first
+
+        yield page
+        if not page_size or len(page) != page_size:
+            return
+        start += len(page)
+
+def fetch_fmg_devices(ctx):
+    """
+    Returns {display string: device data} of all FortiGates managed by the FMG.
+    The list is also stored, so the next start can show it before the refresh.
+    The refresh itself reads every page again: /dvmdb/device has no changed-since
+    filter, so added and removed devices are only counted against the stored list.
+    """
     log("Load device list")
-    global GUI_DEVICE_MAP
-    GUI_DEVICE_MAP = {}
-    
-    payload = {
-        "option": "1" 
-    }
-    
-    devices_data = fmg_json_rpc("get", "/dvmdb/device", payload)
-    
-    gui_list = []
-    
-    if devices_data and isinstance(devices_data, list):
+    device_map = {}
+
+    for devices_data in iter_fmg_device_pages(ctx):
         for d in devices_data:
-            name = d.get('hostname', 'Unknown')
+            name = d.get('hostname') or d.get('name') or 'Unknown'
             sn = d.get('sn', '')
             adom = d.get('mgt_vdom', 'root')
             oid = d.get('oid')
             conn_status = d.get('conn_status') # 1 = Up
-            
-            if sn and sn.startswith("FG"): 
+
+            if sn and sn.startswith("FG"):
 
                 display_str = f"{name} ({sn}) [{adom}]"
-                gui_list.append(display_str)
-                
+
                 # Save in Map for later use
-                GUI_DEVICE_MAP[display_str] = {
+                device_map[display_str] = {
                     'name': name,
                     'serial': sn,
                     'adom': adom,
-                    'oid': oid
+                    'mgt_vdom': d.get('mgt_vdom'),
+                    'oid': oid,
+                    'ha_members': [{'serial': m.get('sn'), 'name': m.get('name', '')}
+                                   for m in d.get('ha_slave') or [] if isinstance(m, dict) and m.get('sn')]
                 }
-                
-        log(f"{len(gui_list)} devices loaded.")
-        return sorted(gui_list)
+
+    if device_map:
+        cached = load_fmg_device_cache(ctx)
+        if cached:
+            added = len(device_map.keys() - cached[1].keys())
+            removed = len(cached[1].keys() - device_map.keys())
+            log(f"{len(device_map)} devices loaded ({added} new, {removed} removed).")
+        else:
+            log(f"{len(device_map)} devices loaded.")
+        device_map = dict(sorted(device_map.items()))
+        save_fmg_device_cache(ctx, device_map)
+        return device_map
     else:
         log("No devices found.")
-        return []
+        return {}
 
-# --- XML GENERATOR ---
-def create_drawio_xml(devices, links):
-    mxfile = ET.Element('mxfile', host="Electron", agent="PythonScript", type="device")
-    diagram = ET.SubElement(mxfile, 'diagram', id="diagram_1", name="FortiTopology")
-    mxGraphModel = ET.SubElement(diagram, 'mxGraphModel', dx="1422", dy="794", grid="1", gridSize="10", guides="1", tooltips="1", connect="1", arrows="1", fold="1", page="1", pageScale="1", pageWidth="827", pageHeight="1169", math="0", shadow="0")
-    root = ET.SubElement(mxGraphModel, 'root')
-    ET.SubElement(root, 'mxCell', id="0")
-    ET.SubElement(root, 'mxCell', id="1", parent="0")
-
-    y_gate, y_switch, y_ap = 50, 250, 450
-    x_sw, x_ap, spacing = 0, 0, 180
-    existing_ids = set()
+class DeviceIndex:
+    """
+    Type-ahead search over the FMG device list: prefix matches on name, serial
+    or ADOM via a sorted key list, then substring matches on the display string.
+    """
+    def __init__(self, device_map):
+        self.displays = list(device_map)
+        keys = []
+        for display, dev in device_map.items():
+            for value in (dev.get('name'), dev.get('serial'), dev.get('adom')):
+                if value:
+                    keys.append((str(value).lower(), display))
+        keys.sort()
+        self.keys = keys
+        self.haystack = [(display.lower(), display) for display in self.displays]
+
+    def __len__(self):
+        return len(self.displays)
+
+    def search(self, text, limit=PICKER_MAX_RESULTS):
+        text = text.strip().lower()
+        if not text:
+            return self.displays[:limit]
+
+        found = {}
+        i = bisect_left(self.keys, (text,))
+        while i < len(self.keys) and self.keys[i][0].startswith(text) and len(found) < limit:
+            found.setdefault(self.keys[i][1], None)
+            i += 1
+        if len(found) < limit:
+            for hay, display in self.haystack:
+                if text in hay and display not in found:
+                    found[display] = None
+                    if len(found) >= limit:
+                        break
+        return list(found)
+
+# --- TOPOLOGY GRAPH ---
+class Node:
+    __slots__ = ('id', 'name', 'serial', 'type', 'mac', 'model', 'link')
+
+    def __init__(self, node_id, name, serial, node_type, mac=None, model=None):
+        self.id = node_id           # clean_id(serial), also the drawio cell id
+        self.name = name
+        self.serial = serial
+        self.type = node_type       # 'fortigate', 'switch', 'ap', 'ap_group' or 'switch_group'
+        self.mac = mac
+        self.model = model          # As reported by the API, None if it reports none
+        self.link = None            # drawio link, e.g. to a detail page
+
+    @property
+    def label(self):
+        """Name and serial, one per line. Summary nodes have no serial."""
+        return "\n".join(str(part) for part in (self.name, self.serial) if part)
+
+    def __repr__(self):
+        return f"<Node {self.type} {self.name} ({self.serial})>"
+
+class Edge:
+    __slots__ = ('src', 'dst', 'src_port', 'dst_port')
+
+    def __init__(self, src, dst, src_port=None, dst_port=None):
+        self.src = src              # Node id of the parent side
+        self.dst = dst              # Node id of the child side
+        self.src_port = src_port
+        self.dst_port = dst_port
+
+    def __repr__(self):
+        return f"<Edge {self.src}:{self.src_port} - {self.dst}:{self.dst_port}>"
+
+class TopologyGraph:
+    """
+    Devices and links of one topology, shared by link inference and all exporters.
+    Nodes are indexed by id, name and MAC, edges are deduplicated on insert,
+    so every lookup during inference is O(1).
+    """
+    def __init__(self):
+        self.nodes = {}             # id -> Node, in insertion order
+        self.edges = []             # Edges in insertion order
+        self.by_name = {}           # hostname / alias -> id
+        self.by_mac = {}            # normalized MAC -> id
+        self.adjacency = {}         # id -> [Edge]
+        self.edge_index = {}        # (id, id) sorted -> Edge
+        self.page_id = None         # drawio page id, None: by page position
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add_node(self, serial, name, node_type, mac=None, model=None, node_id=None):
+        node_id = node_id or clean_id(serial)
+        node = self.nodes.get(node_id)
+        if node is None:
+            node = Node(node_id, name, serial, node_type, mac, model)
+            self.nodes[node_id] = node
+            self.adjacency[node_id] = []
+        if name:
+            self.by_name.setdefault(name, node_id)
+        if mac:
+            node.mac = node.mac or mac
+            self.by_mac.setdefault(normalize_mac(mac), node_id)
+        return node
+
+    def add_alias(self, name, node_id):
+        if name:
+            self.by_name.setdefault(name, node_id)
+
+    def resolve(self, ref):
+        """Returns the node id for a serial, name or MAC, or None."""
+        if not ref:
+            return None
+        ref = str(ref)
+        node_id = clean_id(ref)
+        if node_id in self.nodes:
+            return node_id
+        node_id = self.by_name.get(ref)
+        if node_id is not None:
+            return node_id
+        return self.by_mac.get(normalize_mac(ref))
+
+    def add_edge(self, src_ref, dst_ref, src_port=None, dst_port=None):
+        """Adds a link between two known devices. Returns the Edge, None if unresolved or duplicate."""
+        src = self.resolve(src_ref)
+        dst = self.resolve(dst_ref)
+        if src is None or dst is None:
+            return None
 
-    for dev in devices:
-        safe_id = clean_id(dev['id'])
-        existing_ids.add(safe_id)
-        style = "rounded=1;whiteSpace=wrap;html=1;fillColor=#dae8fc;strokeColor=#6c8ebf;fontColor=#000000;"
-        if dev['type'] == 'fortigate':
-            style = "shape=mxgraph.cisco.firewalls.firewall;html=1;fillColor=#f8cecc;strokeColor=#b85450;fontColor=#FF0000;"
-            x, y = 400, y_gate
-        elif dev['type'] == 'switch':
-            style = "shape=mxgraph.cisco.switches.layer_3_switch;html=1;fillColor=#d5e8d4;strokeColor=#82b366;fontColor=#0000FF;"
-            x, y = 100 + (x_sw * spacing), y_switch
-            x_sw += 1
-        elif dev['type'] == 'ap':
-            style = "shape=mxgraph.cisco.wireless.access_point;html=1;fillColor=#fff2cc;strokeColor=#d6b656;fontColor=#000000;"
-            x, y = 100 + (x_ap * spacing), y_ap
-            x_ap += 1
+        key = (src, dst) if src <= dst else (dst, src)
+        if key in self.edge_index:
+            return None
+
+        edge = Edge(src, dst, src_port, dst_port)
+        self.edge_index[key] = edge
+        self.edges.append(edge)
+        self.adjacency[src].append(edge)
+        if dst != src:
+            self.adjacency[dst].append(edge)
+        return edge
+
+    def copy_node(self, node):
+        """Adds a node of another graph with all its data."""
+        new = self.add_node(node.serial, node.name, node.type, node.mac, node.model, node.id)
+        new.link = node.link
+        return new
+
+    def neighbors(self, node_id):
+        for edge in self.adjacency.get(node_id, ()):
+            yield edge.dst if edge.src == node_id else edge.src
+
+    def count(self, node_type):
+        return sum(1 for node in self.nodes.values() if node.type == node_type)
+
+    def to_lists(self):
+        """Returns (devices, links) as plain dicts, e.g. for JSON."""
+        devices = [{'id': n.serial, 'name': n.name, 'serial': n.serial, 'type': n.type} for n in self.nodes.values()]
+        links = [{'src': self.nodes[e.src].serial, 'dst': self.nodes[e.dst].serial,
+                  'src_port': e.src_port, 'dst_port': e.dst_port} for e in self.edges]
+        return devices, links
+
+    @classmethod
+    def from_lists(cls, devices, links):
+        graph = cls()
+        for dev in devices:
+            graph.add_node(dev['id'], dev.get('name'), dev.get('type'), dev.get('mac'))
+        for link in links:
+            graph.add_edge(link['src'], link['dst'], link.get('src_port'), link.get('dst_port'))
+        return graph
+
+    @classmethod
+    def from_rows(cls, node_rows, edge_rows):
+        """
+        Builds a graph from artifact rows: (id, serial, name, type, mac, model) and
+        (src position, dst position, src_port, dst_port). The rows come from a graph,
+        ids are unique and edges deduplicated already, so nothing is resolved.
+        """
+        graph = cls()
+        ids = []
+        for node_id, serial, name, node_type, mac, model in node_rows:
+            graph.nodes[node_id] = Node(node_id, name, serial, node_type, mac, model)
+            graph.adjacency[node_id] = []
+            ids.append(node_id)
+            if name:
+                graph.by_name.setdefault(name, node_id)
+            if mac:
+                graph.by_mac.setdefault(normalize_mac(mac), node_id)
+        for src, dst, src_port, dst_port in edge_rows:
+            src, dst = ids[src], ids[dst]
+            edge = Edge(src, dst, src_port, dst_port)
+            graph.edge_index[(src, dst) if src <= dst else (dst, src)] = edge
+            graph.edges.append(edge)
+            graph.adjacency[src].append(edge)
+            if dst != src:
+                graph.adjacency[dst].append(edge)
+        return graph
+
+def normalize_mac(text):
+    return str(text).lower().replace(":", "").replace("-", "").replace(".", "")
+
+# --- AGGREGATION ---
+def diagram_id(page_index):
+    return f"diagram_{page_index + 1}"
+
+def page_link(page):
+    """Link to a page by position or by page id."""
+    return f"data:page/id,{diagram_id(page) if isinstance(page, int) else page}"
+
+def model_summary(nodes):
+    """'FAP-231F x12, FP431F x3': models by count, the serial prefix stands in for a missing model."""
+    counts = {}
+    for node in nodes:
+        model = node.model or (str(node.serial)[:6] if node.serial else "?")
+        counts[model] = counts.get(model, 0) + 1
+    return ", ".join(f"{model} x{n}" for model, n in sorted(counts.items(), key=lambda item: (-item[1], item[0])))
+
+def aggregate_graph(graph, threshold=None, include_switches=None, name="FortiTopology", page_index=0):
+    """
+    Level-of-detail stage between collection and rendering.
+    Leaf APs (optionally leaf switches) of one parent are collapsed into one summary
+    node with counts and models once there are at least threshold of them.
+    Returns pages [(name, graph)]: the overview first, then one detail page per
+    collapsed group in parent id order, linked from the summary node. threshold 0
+    returns the graph as is. page_index is the final position of the overview; detail
+    pages get ids from it and the group id, so adding or removing a device keeps
+    the ids and links of all other pages.
+    """
+    if threshold is None:
+        threshold = AGGREGATE_THRESHOLD
+    if include_switches is None:
+        include_switches = AGGREGATE_SWITCHES
+    if not threshold or threshold < 1:
+        return [(name, graph)]
+
+    leaf_types = ('ap', 'switch') if include_switches else ('ap',)
+
+    # Leaves per (parent, type). Unlinked devices have the parent None.
+    groups = {}
+    for node_id, node in graph.nodes.items():
+        if node.type not in leaf_types:
+            continue
+        edges = graph.adjacency[node_id]
+        if len(edges) > 1:
+            continue
+        parent_id = None
+        if edges:
+            parent_id = edges[0].src if edges[0].dst == node_id else edges[0].dst
+            if graph.nodes[parent_id].type == node.type and node.type == 'switch' and len(graph.adjacency[parent_id]) <= 1:
+                continue    # Two switches only linked to each other
+        groups.setdefault((parent_id, node.type), []).append(node_id)
+
+    collapsed = {}
+    pages = [(name, None)]
+    # Stable page order: by parent id, unlinked devices last
+    for parent_id, node_type in sorted(groups, key=lambda key: (key[0] is None, key[0] or "", key[1])):
+        members = groups[(parent_id, node_type)]
+        if len(members) < threshold:
+            continue
+        members_set = set(members)
+        parent = graph.nodes.get(parent_id)
+        label = "APs" if node_type == 'ap' else "Switches"
+        page_name = f"{parent.name if parent else 'Unlinked'} {label}"
+
+        # Detail page: parent + all members with their ports
+        detail = TopologyGraph()
+        if parent is not None:
+            detail.copy_node(parent).link = page_link(page_index)
+        for member_id in members:
+            detail.copy_node(graph.nodes[member_id])
+        if parent is not None:
+            for edge in graph.adjacency[parent_id]:
+                if edge.src in members_set or edge.dst in members_set:
+                    detail.add_edge(edge.src, edge.dst, edge.src_port, edge.dst_port)
+
+        group_id = f"group_{parent_id or 'unlinked'}_{node_type}"
+        detail.page_id = f"{diagram_id(page_index)}_{group_id}"
+        collapsed[group_id] = (parent_id, node_type, members, detail.page_id)
+        for member_id in members:
+            collapsed[member_id] = None
+        pages.append((page_name, detail))
+
+    if len(pages) == 1:
+        return [(name, graph)]
+
+    # Overview: everything that was not collapsed, plus the summary nodes
+    overview = TopologyGraph()
+    for node_id, node in graph.nodes.items():
+        if node_id not in collapsed:
+            overview.copy_node(node)
+    for group_id, group in collapsed.items():
+        if group is None:
+            continue
+        parent_id, node_type, members, detail_page = group
+        member_nodes = [graph.nodes[m] for m in members]
+        label = "APs" if node_type == 'ap' else "Switches"
+        summary = overview.add_node(None, f"{len(members)} {label}\n{model_summary(member_nodes)}",
+                                    f"{node_type}_group", node_id=group_id)
+        summary.link = page_link(detail_page)
+        if parent_id is not None:
+            overview.add_edge(parent_id, group_id)
+    for edge in graph.edges:
+        if edge.src in overview.nodes and edge.dst in overview.nodes:
+            overview.add_edge(edge.src, edge.dst, edge.src_port, edge.dst_port)
+
+    pages[0] = (name, overview)
+    log(f"Aggregated {sum(len(g[2]) for g in collapsed.values() if g)} devices into {len(pages) - 1} groups")
+    return pages
+
+# --- PARTITIONING ---
+def partition_assignment(graph, mode):
+    """Returns (page names, {node id: page index}) for 'stack' or 'prefix'."""
+    names = []
+    assign = {}
+
+    if mode == "stack":
+        # Page 0: FortiGate(s), one page per switch below it with everything behind it
+        fg_ids = [node_id for node_id, node in graph.nodes.items() if node.type == 'fortigate']
+        names.append(graph.nodes[fg_ids[0]].name if fg_ids else "FortiGate")
+        for fg_id in fg_ids:
+            assign[fg_id] = 0
+        for fg_id in fg_ids:
+            for root_id in graph.neighbors(fg_id):
+                if root_id in assign or graph.nodes[root_id].type != 'switch':
+                    continue
+                index = len(names)
+                names.append(f"Stack {graph.nodes[root_id].name}")
+                assign[root_id] = index
+                queue = deque([root_id])
+                while queue:
+                    for peer_id in graph.neighbors(queue.popleft()):
+                        if peer_id not in assign:
+                            assign[peer_id] = index
+                            queue.append(peer_id)
+        # Devices directly at the FortiGate stay on its page
+        for fg_id in fg_ids:
+            for peer_id in graph.neighbors(fg_id):
+                assign.setdefault(peer_id, 0)
+
+    elif mode == "prefix":
+        # Building / site prefix of the hostname, e.g. 'B12' of 'B12-SW-01'
+        index_of = {}
+        for node_id, node in graph.nodes.items():
+            if node.type == 'fortigate':
+                key = "FortiGate"
+            elif node.name and PARTITION_SEPARATOR in node.name:
+                key = node.name.split(PARTITION_SEPARATOR, 1)[0]
+            else:
+                key = "Other"
+            if key not in index_of:
+                index_of[key] = len(names)
+                names.append(key)
+            assign[node_id] = index_of[key]
+
+    # Everything left over
+    if any(node_id not in assign for node_id in graph.nodes):
+        rest = len(names)
+        names.append("Unlinked")
+        for node_id in graph.nodes:
+            assign.setdefault(node_id, rest)
+    return names, assign
+
+def add_placeholder(page, node, target_index, target_name):
+    """Stand-in on one page for a device that lives on another page."""
+    ref = page.add_node(f"→ {target_name}", node.name, 'placeholder', node_id=f"ref_{node.id}")
+    ref.link = page_link(target_index)
+    return ref.id
+
+def partition_graph(graph, mode=None):
+    """
+    Splits a topology into pages by switch stack ('stack') or hostname prefix ('prefix').
+    Links between pages end in placeholder nodes that link to the other page.
+    Returns pages [(name, graph)].
+    """
+    if mode is None:
+        mode = PARTITION_MODE
+    if mode not in ("stack", "prefix"):
+        return [("FortiTopology", graph)]
+
+    names, assign = partition_assignment(graph, mode)
+    if len(names) <= 1:
+        return [("FortiTopology", graph)]
+
+    pages = [TopologyGraph() for _ in names]
+    for node_id, node in graph.nodes.items():
+        pages[assign[node_id]].copy_node(node)
+
+    for edge in graph.edges:
+        a, b = assign[edge.src], assign[edge.dst]
+        if a == b:
+            pages[a].add_edge(edge.src, edge.dst, edge.src_port, edge.dst_port)
+            continue
+        ref_dst = add_placeholder(pages[a], graph.nodes[edge.dst], b, names[b])
+        pages[a].add_edge(edge.src, ref_dst, edge.src_port, edge.dst_port)
+        ref_src = add_placeholder(pages[b], graph.nodes[edge.src], a, names[a])
+        pages[b].add_edge(ref_src, edge.dst, edge.src_port, edge.dst_port)
+
+    log(f"Partitioned into {len(pages)} pages")
+    return list(zip(names, pages))
+
+def build_pages(topology, partition=None, aggregate=None, aggregate_switches=None):
+    """
+    Partitions a TopologyGraph (or takes given pages, e.g. one per FortiGate),
+    then aggregates every page. Page order: all partitions, then all detail pages.
+    """
+    if isinstance(topology, TopologyGraph):
+        parts = partition_graph(topology, partition)
+    else:
+        parts = list(topology)
+
+    overviews = []
+    details = []
+    for i, (name, graph) in enumerate(parts):
+        pages = aggregate_graph(graph, aggregate, aggregate_switches, name, i)
+        overviews.append(pages[0])
+        details.extend(pages[1:])
+    return overviews + details
+
+def iter_pages(topology):
+    """Normalizes a TopologyGraph or [(name, graph)] to [(page id, name, graph)]."""
+    if isinstance(topology, TopologyGraph):
+        topology = [("FortiTopology", topology)]
+    return [(graph.page_id or diagram_id(i), name, graph) for i, (name, graph) in enumerate(topology)]
+
+# --- LAYOUT ---
+TYPE_TIERS = {'fortigate': 0, 'switch': 1, 'ap': 2}
+
+def assign_tiers(graph):
+    """Tier of every node = BFS depth from the FortiGate(s). Unconnected nodes go by type."""
+    roots = [node_id for node_id, node in graph.nodes.items() if node.type == 'fortigate']
+    if not roots and graph.nodes:
+        roots = [next(iter(graph.nodes))]
+
+    depth = {node_id: 0 for node_id in roots}
+    queue = deque(roots)
+    while queue:
+        node_id = queue.popleft()
+        for peer_id in graph.neighbors(node_id):
+            if peer_id not in depth:
+                depth[peer_id] = depth[node_id] + 1
+                queue.append(peer_id)
+
+    max_depth = max(depth.values(), default=0)
+    for node_id, node in graph.nodes.items():
+        if node_id not in depth:
+            tier = TYPE_TIERS.get(node.type, max_depth + 1)
+            # Unconnected APs below everything else
+            depth[node_id] = max(tier, max_depth + 1) if node.type == 'ap' else tier
+    return depth
+
+def order_tiers(graph, depth):
+    """
+    Orders every tier by the barycenter of its neighbors in the previous tier,
+    alternating down and up sweeps. Each sweep is one sort per tier, O(E + V log V).
+    """
+    tiers = [[] for _ in range(max(depth.values(), default=0) + 1)]
+    for node_id in graph.nodes:
+        tiers[depth[node_id]].append(node_id)
+
+    # Positions normalized to 0..1 so tiers of different width are comparable
+    pos = {}
+    def place(tier):
+        scale = max(1, len(tier) - 1)
+        for i, node_id in enumerate(tier):
+            pos[node_id] = i / scale
+    for tier in tiers:
+        place(tier)
+
+    for sweep in range(LAYOUT_SWEEPS):
+        down = sweep % 2 == 0
+        indexes = range(1, len(tiers)) if down else range(len(tiers) - 2, -1, -1)
+        for t in indexes:
+            ref = t - 1 if down else t + 1
+            keys = {}
+            for node_id in tiers[t]:
+                total = count = 0
+                for peer_id in graph.neighbors(node_id):
+                    if depth[peer_id] == ref:
+                        total += pos[peer_id]
+                        count += 1
+                keys[node_id] = (total / count if count else pos[node_id], pos[node_id])
+            tiers[t].sort(key=keys.__getitem__)
+            place(tiers[t])
+    return tiers
+
+def layout_graph(graph):
+    """
+    Layered layout: tiers from graph depth, crossings reduced by barycenter
+    ordering, tiers wider than LAYOUT_MAX_ROW wrapped into several rows.
+    Returns {node id: (x, y)}.
+    """
+    if not graph.nodes:
+        return {}
+
+    depth = assign_tiers(graph)
+    tiers = order_tiers(graph, depth)
+    row_width = min(LAYOUT_MAX_ROW, max(len(tier) for tier in tiers))
+
+    coords = {}
+    y = 50
+    for tier in tiers:
+        if not tier:
+            continue
+        for start in range(0, len(tier), LAYOUT_MAX_ROW):
+            row = tier[start:start + LAYOUT_MAX_ROW]
+            offset = (row_width - len(row)) * LAYOUT_X_SPACING // 2
+            for i, node_id in enumerate(row):
+                coords[node_id] = (100 + offset + i * LAYOUT_X_SPACING, y)
+            y += LAYOUT_ROW_SPACING
+        y += LAYOUT_Y_SPACING - LAYOUT_ROW_SPACING
+    return coords
+
+# --- XML GENERATOR ---
+STYLE_DEFAULT = "rounded=1;whiteSpace=wrap;html=1;fillColor=#dae8fc;strokeColor=#6c8ebf;fontColor=#000000;"
+STYLE_FORTIGATE = "shape=mxgraph.cisco.firewalls.firewall;html=1;fillColor=#f8cecc;strokeColor=#b85450;fontColor=#FF0000;"
+STYLE_SWITCH = "shape=mxgraph.cisco.switches.layer_3_switch;html=1;fillColor=#d5e8d4;strokeColor=#82b366;fontColor=#0000FF;"
+STYLE_AP = "shape=mxgraph.cisco.wireless.access_point;html=1;fillColor=#fff2cc;strokeColor=#d6b656;fontColor=#000000;"
+STYLE_AP_GROUP = "rounded=1;whiteSpace=wrap;html=1;dashed=1;fillColor=#fff2cc;strokeColor=#d6b656;fontColor=#000000;"
+STYLE_PLACEHOLDER = "rounded=1;whiteSpace=wrap;html=1;dashed=1;fillColor=#f5f5f5;strokeColor=#666666;fontColor=#333333;"
+STYLE_SWITCH_GROUP = "rounded=1;whiteSpace=wrap;html=1;dashed=1;fillColor=#d5e8d4;strokeColor=#82b366;fontColor=#0000FF;"
+STYLE_EDGE = "endArrow=none;html=1;rounded=0;"
+STYLE_LABEL = "edgeLabel;html=1;align=center;verticalAlign=middle;resizable=0;points=[];fontSize=10;fontColor=#666666;"
+DEVICE_STYLES = (STYLE_DEFAULT, STYLE_FORTIGATE, STYLE_SWITCH, STYLE_AP, STYLE_AP_GROUP, STYLE_SWITCH_GROUP, STYLE_PLACEHOLDER)
+
+def iter_drawio_cells(graph):
+    """
+    Yields the cells of a topology as (mxCell attributes, mxGeometry attributes).
+    Shared by create_drawio_xml and update_drawio_xml.
+    """
+    coords = layout_graph(graph)
+
+    for node in graph.nodes.values():
+        style = STYLE_DEFAULT
+        if node.type == 'fortigate':
+            style = STYLE_FORTIGATE
+        elif node.type == 'switch':
+            style = STYLE_SWITCH
+        elif node.type == 'ap':
+            style = STYLE_AP
+        elif node.type == 'ap_group':
+            style = STYLE_AP_GROUP
+        elif node.type == 'switch_group':
+            style = STYLE_SWITCH_GROUP
+        elif node.type == 'placeholder':
+            style = STYLE_PLACEHOLDER
+        x, y = coords[node.id]
+
+        cell_attrs = {'id': node.id, 'value': node.label, 'style': style, 'parent': "1", 'vertex': "1"}
+        if node.link:
+            cell_attrs['link'] = node.link
+        yield (cell_attrs,
+               {'x': str(x), 'y': str(y), 'width': "80", 'height': "60", 'attribute': "geometry", 'as': "geometry"})
+
+    # Edges are already deduplicated by the graph
+    for edge in graph.edges:
+        src, dst = edge.src, edge.dst
+        edge_id = f"edge_{src}_{dst}"
+        yield ({'id': edge_id, 'value': "", 'style': STYLE_EDGE, 'parent': "1", 'source': src, 'target': dst, 'edge': "1"},
+               {'relative': "1", 'as': "geometry"})
         
-        cell = ET.SubElement(root, 'mxCell', id=safe_id, value=f"{dev['name']}\n{dev['serial']}", style=style, parent="1", vertex="1")
-        geo = ET.SubElement(cell, 'mxGeometry', x=str(x), y=str(y), width="80", height="60", attribute="geometry")
-        geo.set('as', 'geometry')
-
-    unique_links = set() 
-    for link in links:
-        src = clean_id(link['src'])
-        dst = clean_id(link['dst'])
-
-        src_label = link.get('src_port')
-        dst_label = link.get('dst_port')
-
-        if src in existing_ids and dst in existing_ids:
-            link_signature = tuple(sorted((src, dst)))
-            if link_signature not in unique_links:
-                unique_links.add(link_signature)
-                edge_id = f"edge_{src}_{dst}"
-                edge = ET.SubElement(root, 'mxCell', id=edge_id, value="", style="endArrow=none;html=1;rounded=0;", parent="1", source=src, target=dst, edge="1")
-                geo_edge = ET.SubElement(edge, 'mxGeometry', relative="1")
-                geo_edge.set('as', 'geometry')
-                
-                if src_label:
-                    lbl_s = ET.SubElement(root, 'mxCell', id=f"lbl_src_{edge_id}", value=src_label, style="edgeLabel;html=1;align=center;verticalAlign=middle;resizable=0;points=[];fontSize=10;fontColor=#666666;", parent=edge_id, vertex="1", connectable="0")
-                    geo_s = ET.SubElement(lbl_s, 'mxGeometry', x="-0.8", y="0", relative="1")
-                    geo_s.set('as', 'geometry')
-
-                if dst_label:
-                    lbl_d = ET.SubElement(root, 'mxCell', id=f"lbl_dst_{edge_id}", value=dst_label, style="edgeLabel;html=1;align=center;verticalAlign=middle;resizable=0;points=[];fontSize=10;fontColor=#666666;", parent=edge_id, vertex="1", connectable="0")
-                    geo_d = ET.SubElement(lbl_d, 'mxGeometry', x="0.8", y="0", relative="1")
-                    geo_d.set('as', 'geometry')
-
-    return ET.tostring(mxfile, encoding='utf-8', method='xml')
+        if edge.src_port:
+            yield ({'id': f"lbl_src_{edge_id}", 'value': edge.src_port, 'style': STYLE_LABEL, 'parent': edge_id, 'vertex': "1", 'connectable': "0"},
+                   {'x': "-0.8", 'y': "0", 'relative': "1", 'as': "geometry"})
+
+        if edge.dst_port:
+            yield ({'id': f"lbl_dst_{edge_id}", 'value': edge.dst_port, 'style': STYLE_LABEL, 'parent': edge_id, 'vertex': "1", 'connectable': "0"},
+                   {'x': "0.8", 'y': "0", 'relative': "1", 'as': "geometry"})
+
+def append_cell(root, cell_attrs, geo_attrs):
+    """Adds a cell to an ElementTree root. Cells with a link are wrapped in a UserObject."""
+    if 'link' in cell_attrs:
+        cell_attrs = dict(cell_attrs)
+        obj = ET.SubElement(root, 'UserObject', label=cell_attrs.pop('value'), link=cell_attrs.pop('link'), id=cell_attrs.pop('id'))
+        cell = ET.SubElement(obj, 'mxCell', cell_attrs)
+        ET.SubElement(cell, 'mxGeometry', geo_attrs)
+        return obj
+    cell = ET.SubElement(root, 'mxCell', cell_attrs)
+    ET.SubElement(cell, 'mxGeometry', geo_attrs)
+    return cell
+
+def create_drawio_xml(topology, compressed=False):
+    buffer = io.BytesIO()
+    write_drawio_stream(buffer, topology, compressed)
+    return buffer.getvalue()
+
+# --- STREAMING WRITER ---
+def xml_attr(value):
+    """Escapes an attribute value exactly like ElementTree does."""
+    value = str(value)
+    if "&" in value: value = value.replace("&", "&amp;")
+    if "<" in value: value = value.replace("<", "&lt;")
+    if ">" in value: value = value.replace(">", "&gt;")
+    if '"' in value: value = value.replace('"', "&quot;")
+    if "\r" in value: value = value.replace("\r", "&#13;")
+    if "\n" in value: value = value.replace("\n", "&#10;")
+    if "\t" in value: value = value.replace("\t", "&#09;")
+    return value
+
+def xml_tag(tag, attrs, close=True):
+    text = "".join(f' {key}="{xml_attr(value)}"' for key, value in attrs)
+    return f"<{tag}{text} />" if close else f"<{tag}{text}>"
+
+def iter_model_xml(graph):
+    """Yields the mxGraphModel of a topology as XML text chunks, one cell at a time."""
+    yield xml_tag('mxGraphModel', DRAWIO_MODEL_ATTRS, close=False)
+    yield '<root><mxCell id="0" /><mxCell id="1" parent="0" />'
+    for cell_attrs, geo_attrs in iter_drawio_cells(graph):
+        if 'link' in cell_attrs:
+            attrs = dict(cell_attrs)
+            obj = (('label', attrs.pop('value')), ('link', attrs.pop('link')), ('id', attrs.pop('id')))
+            yield (xml_tag('UserObject', obj, close=False) + xml_tag('mxCell', attrs.items(), close=False)
+                   + xml_tag('mxGeometry', geo_attrs.items()) + '</mxCell></UserObject>')
+            continue
+        yield (xml_tag('mxCell', cell_attrs.items(), close=False)
+               + xml_tag('mxGeometry', geo_attrs.items()) + '</mxCell>')
+    yield '</root></mxGraphModel>'
+
+class DeflateBase64Writer:
+    """
+    Streams text as base64(raw deflate(encodeURIComponent(text))), the compressed
+    page format of diagrams.net, without holding the whole page in memory.
+    """
+    def __init__(self, out):
+        self.out = out
+        self.deflate = zlib.compressobj(9, zlib.DEFLATED, -15)
+        self.pending = b""
+
+    def _emit(self, data, final=False):
+        data = self.pending + data
+        cut = len(data) if final else len(data) - len(data) % 3
+        self.pending = data[cut:]
+        if cut:
+            self.out.write(base64.b64encode(data[:cut]))
+
+    def write(self, text):
+        self._emit(self.deflate.compress(quote(text, safe="~()*!.'").encode('ascii')))
+
+    def close(self):
+        self._emit(self.deflate.flush(), final=True)
+
+def write_diagram_page(out, page_id, name, graph, compressed=False):
+    out.write(f'<diagram id="{xml_attr(page_id)}" name="{xml_attr(name)}">'.encode('utf-8'))
+    if compressed:
+        writer = DeflateBase64Writer(out)
+        for chunk in iter_model_xml(graph):
+            writer.write(chunk)
+        writer.close()
+    else:
+        for chunk in iter_model_xml(graph):
+            out.write(chunk.encode('utf-8'))
+    out.write(b'</diagram>')
+
+def render_diagram_page(args):
+    """Process pool worker: one <diagram> page as bytes."""
+    page_id, name, graph, compressed = args
+    buffer = io.BytesIO()
+    write_diagram_page(buffer, page_id, name, graph, compressed)
+    return buffer.getvalue()
+
+def write_drawio_stream(out, topology, compressed=False, workers=None):
+    """
+    Writes the .drawio file cell by cell to a binary file object.
+    topology is a TopologyGraph or a list of pages [(name, graph)].
+    Large multi-page diagrams are built in a process pool (workers, default
+    RENDER_WORKERS) and merged in page order.
+    The plain output is byte-identical to ElementTree serialization.
+    """
+    pages = iter_pages(topology)
+    if workers is None:
+        workers = RENDER_WORKERS
+    parallel = (workers > 1 and len(pages) > 1
+                and sum(len(graph) for page_id, name, graph in pages) >= PARALLEL_RENDER_MIN_NODES)
 
-# --- THREAD WORKER ---
-def run_process_thread(on_finish_callback, custom_path=""):
+    out.write(b'<mxfile host="Electron" agent="PythonScript" type="device">')
+
+    rendered = False
+    if parallel:
+        try:
+            with ProcessPoolExecutor(max_workers=min(workers, len(pages))) as executor:
+                jobs = [(page_id, name, graph, compressed) for page_id, name, graph in pages]
+                chunks = list(executor.map(render_diagram_page, jobs))
+            for chunk in chunks:
+                out.write(chunk)
+            rendered = True
+        except Exception as e:
+            log(f"Parallel rendering failed ({e}), rendering in-process")
+
+    if not rendered:
+        for page_id, name, graph in pages:
+            write_diagram_page(out, page_id, name, graph, compressed)
+
+    out.write(b'</mxfile>')
+
+# --- INCREMENTAL UPDATE ---
+def decode_diagram(diagram):
+    """Returns the mxGraphModel of a diagram page, also for compressed pages."""
+    model = diagram.find('mxGraphModel')
+    if model is not None:
+        return model
+    text = (diagram.text or "").strip()
+    if not text:
+        return None
+    # Compressed page: base64(deflate(urlencode(xml)))
+    raw = zlib.decompress(base64.b64decode(text), -15)
+    model = ET.fromstring(unquote(raw.decode('utf-8')))
+    diagram.text = None
+    diagram.append(model)
+    return model
+
+def cell_value(cell):
+    """Label of an mxCell or UserObject."""
+    return cell.get('label' if cell.tag == 'UserObject' else 'value') or ""
+
+def inner_cell(cell):
+    """The mxCell holding style and geometry (the UserObject child for linked cells)."""
+    if cell.tag == 'UserObject':
+        return cell.find('mxCell')
+    return cell
+
+def is_generated_cell(cell):
+    """True for cells created by iter_drawio_cells, False for manual additions."""
+    cell_id = cell.get('id', '')
+    if cell_id.startswith(("edge_", "lbl_src_edge_", "lbl_dst_edge_", "group_", "ref_")):
+        return True
+    inner = inner_cell(cell)
+    if inner is None or inner.get('vertex') != "1" or inner.get('parent') != "1":
+        return False
+    value = cell_value(cell).replace("<br>", "\n")
+    return "\n" in value and clean_id(value.split("\n")[-1]) == cell_id
+
+DIAGRAM_PAGE = re.compile(rb'<diagram\b[^>]*?(?:/>|>.*?</diagram>)', re.DOTALL)
+
+def split_diagram_pages(xml):
+    """
+    Splits .drawio bytes into (head, [(page id, page bytes)], tail) without parsing
+    the pages, so unchanged pages can be written back as they are.
+    """
+    matches = list(DIAGRAM_PAGE.finditer(xml))
+    if not matches:
+        raise ValueError("No diagram found in existing file")
+    pages = []
+    for match in matches:
+        start_tag = xml[match.start():xml.index(b'>', match.start()) + 1]
+        if not start_tag.endswith(b'/>'):
+            start_tag = start_tag[:-1] + b'/>'
+        pages.append((ET.fromstring(start_tag).get('id'), match.group()))
+    return xml[:matches[0].start()], pages, xml[matches[-1].end():]
+
+def update_drawio_xml(existing_xml, topology):
+    """
+    Applies a fresh collection to an existing .drawio file.
+    On the first page new cells are added, vanished generated cells removed,
+    changed values and default styles updated. Geometry of existing cells is never
+    touched. Further pages (partitions, detail pages) are matched by page id and
+    regenerated; only changed pages are re-serialized, the others are kept as bytes.
+    Pages added by hand are kept.
+    Returns (xml bytes, {'added': n, 'removed': n, 'updated': n}).
+    """
+    pages = iter_pages(topology)
+    graph = pages[0][2]
+    head, old_pages, tail = split_diagram_pages(existing_xml)
+
+    diagram = ET.fromstring(old_pages[0][1])
+    model = decode_diagram(diagram)
+    root = model.find('root') if model is not None else None
+    if root is None:
+        raise ValueError("No diagram found in existing file")
+
+    existing = {cell.get('id'): cell for cell in root if cell.tag in ('mxCell', 'UserObject')}
+    fresh = list(iter_drawio_cells(graph))
+    fresh_ids = {cell_attrs['id'] for cell_attrs, geo_attrs in fresh}
+    diff = {'added': 0, 'removed': 0, 'updated': 0}
+
+    # 1. Remove generated cells that are gone
+    for cell_id, cell in list(existing.items()):
+        if cell_id not in fresh_ids and is_generated_cell(cell):
+            root.remove(cell)
+            del existing[cell_id]
+            diff['removed'] += 1
+
+    # 2. Add new cells, update changed ones
+    placed_children = {}
+    for cell_attrs, geo_attrs in fresh:
+        cell = existing.get(cell_attrs['id'])
+        if cell is None:
+            if cell_attrs.get('vertex') == "1" and cell_attrs['parent'] == "1":
+                geo_attrs = place_new_vertex(cell_attrs['id'], geo_attrs, graph, existing, placed_children)
+            existing[cell_attrs['id']] = append_cell(root, cell_attrs, geo_attrs)
+            diff['added'] += 1
+            continue
+
+        changed = False
+        value = cell_value(cell)
+        if value != cell_attrs['value'] and value.replace("<br>", "\n") != cell_attrs['value']:
+            cell.set('label' if cell.tag == 'UserObject' else 'value', cell_attrs['value'])
+            changed = True
+        # Only replace our own default styles, manual styling wins
+        inner = inner_cell(cell)
+        if inner is not None and inner.get('style') != cell_attrs['style'] and inner.get('style') in DEVICE_STYLES:
+            inner.set('style', cell_attrs['style'])
+            changed = True
+        if cell.tag == 'UserObject' and 'link' in cell_attrs and cell.get('link') != cell_attrs['link']:
+            cell.set('link', cell_attrs['link'])
+            changed = True
+        if changed:
+            diff['updated'] += 1
+
+    out = [head]
+    if any(diff.values()):
+        out.append(ET.tostring(diagram, encoding='utf-8'))
+    else:
+        out.append(old_pages[0][1])
+
+    # 3. Regenerate the other pages, unchanged ones stay as they are
+    old_by_id = dict(old_pages[1:])
+    for page_id, name, g in pages[1:]:
+        old_page = old_by_id.pop(page_id, None)
+        buffer = io.BytesIO()
+        compressed = old_page is not None and b'<mxGraphModel' not in old_page
+        write_diagram_page(buffer, page_id, name, g, compressed)
+        new_page = buffer.getvalue()
+        if old_page is None:
+            diff['added'] += 1
+        elif old_page != new_page:
+            diff['updated'] += 1
+        out.append(new_page)
+    for page_id, old_page in old_by_id.items():
+        if str(page_id).startswith("diagram_"):
+            diff['removed'] += 1
+        else:
+            out.append(old_page)
+    out.append(tail)
+    return b"".join(out), diff
+
+def place_new_vertex(cell_id, geo_attrs, graph, existing, placed_children):
+    """Puts a new device below a connected device that is already in the diagram."""
+    for peer_id in graph.neighbors(cell_id):
+        peer = existing.get(peer_id)
+        peer = inner_cell(peer) if peer is not None else None
+        peer_geo = peer.find('mxGeometry') if peer is not None else None
+        if peer_geo is None or peer_geo.get('x') is None:
+            continue
+
+        n = placed_children.get(peer_id, 0)
+        placed_children[peer_id] = n + 1
+        geo_attrs = dict(geo_attrs)
+        geo_attrs['x'] = f"{float(peer_geo.get('x', 0)) + n * 100:g}"
+        geo_attrs['y'] = f"{float(peer_geo.get('y', 0)) + 200:g}"
+        return geo_attrs
+    return geo_attrs
+
+# --- TOPOLOGY ARTIFACT ---
+ARTIFACT_NODE_FIELDS = ('id', 'serial', 'name', 'type', 'mac', 'model')
+ARTIFACT_EDGE_FIELDS = ('src', 'dst', 'src_port', 'dst_port')
+
+def topology_artifact(graph, gate_serial="", gate_name="", source="", created=None):
+    """
+    The collected topology as compact, versioned dict: node rows and edge rows
+    that reference the nodes by position. Rendering needs nothing else.
+    """
+    position = {node_id: i for i, node_id in enumerate(graph.nodes)}
+    return {
+        'format': ARTIFACT_FORMAT,
+        'version': ARTIFACT_VERSION,
+        'created': time.time() if created is None else created,
+        'gate': {'serial': gate_serial, 'name': gate_name},
+        'source': source,
+        'node_fields': ARTIFACT_NODE_FIELDS,
+        'nodes': [(n.id, n.serial, n.name, n.type, n.mac, n.model) for n in graph.nodes.values()],
+        'edge_fields': ARTIFACT_EDGE_FIELDS,
+        'edges': [(position[e.src], position[e.dst], e.src_port, e.dst_port) for e in graph.edges],
+    }
+
+def artifact_file(filename):
+    """Artifact name next to a diagram: site.drawio -> site.topo.json.gz"""
+    base = filename[:-len(".drawio")] if filename.endswith(".drawio") else filename
+    return base + ARTIFACT_SUFFIX
+
+def save_artifact(filename, artifact):
+    """Writes the artifact as gzip'ed JSON, fast compression level, replaced atomically."""
+    tmp_file = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with gzip.open(tmp_file, "wt", encoding="utf-8", compresslevel=1) as f:
+        json.dump(artifact, f, separators=(",", ":"))
+    os.replace(tmp_file, filename)
+    return filename
+
+def load_artifact(filename):
+    """Returns (artifact without rows, TopologyGraph). Raises ValueError for other formats or newer versions."""
+    # Only acyclic lists and objects are created, the cyclic GC would just slow the load down
+    gc_enabled = gc.isenabled()
+    gc.disable()
     try:
-        devices = []
-        links = []
-        name_to_serial = {}
+        with gzip.open(filename, "rt", encoding="utf-8") as f:
+            artifact = json.load(f)
+        if not isinstance(artifact, dict) or artifact.get('format') != ARTIFACT_FORMAT:
+            raise ValueError(f"{filename} is not a topology artifact")
+        if artifact.get('version', 0) > ARTIFACT_VERSION:
+            raise ValueError(f"{filename} has version {artifact.get('version')}, this tool reads up to {ARTIFACT_VERSION}")
+        graph = TopologyGraph.from_rows(artifact['nodes'], artifact['edges'])
+    finally:
+        if gc_enabled:
+            gc.enable()
+    meta = {key: value for key, value in artifact.items() if key not in ('nodes', 'edges')}
+    return meta, graph
+
+# --- EXPORTERS ---
+EXPORTERS = {}              # name -> (file suffix, function(filename, graph, meta, **options))
+
+def register_exporter(name, suffix, func):
+    """
+    Adds an output format. func(filename, graph, meta, **options) writes the file
+    and returns its name, options it does not know are ignored.
+    """
+    EXPORTERS[name] = (suffix, func)
+
+def export_file(filename, name):
+    """File of an exporter next to the diagram: site.drawio -> site.graphml"""
+    base = filename[:-len(".drawio")] if filename.endswith(".drawio") else filename
+    return filename if name == "drawio" else base + EXPORTERS[name][0]
+
+def export_drawio(filename, graph, meta, **options):
+    return write_topology(filename, graph, **options)
+
+def export_json(filename, graph, meta, **options):
+    """Devices and links with all fields, for CMDB imports."""
+    document = {
+        'gate': meta.get('gate', {}),
+        'created': meta.get('created'),
+        'source': meta.get('source', ""),
+        'devices': [{'id': n.id, 'serial': n.serial, 'name': n.name, 'type': n.type, 'mac': n.mac, 'model': n.model}
+                    for n in graph.nodes.values()],
+        'links': [{'src': graph.nodes[e.src].serial, 'dst': graph.nodes[e.dst].serial,
+                   'src_port': e.src_port, 'dst_port': e.dst_port} for e in graph.edges],
+    }
+    with open(filename, "w", encoding="utf-8") as f:
+        json.dump(document, f, indent=1)
+    return filename
+
+GRAPHML_NODE_KEYS = ('name', 'serial', 'type', 'mac', 'model')
+GRAPHML_EDGE_KEYS = ('src_port', 'dst_port')
+
+def export_graphml(filename, graph, meta, **options):
+    """GraphML for yEd, Gephi or networkx, streamed like the drawio writer."""
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n')
+        for key in GRAPHML_NODE_KEYS:
+            f.write(f'  <key id="{key}" for="node" attr.name="{key}" attr.type="string" />\n')
+        for key in GRAPHML_EDGE_KEYS:
+            f.write(f'  <key id="{key}" for="edge" attr.name="{key}" attr.type="string" />\n')
+        gate = meta.get('gate', {}).get('name') or "topology"
+        f.write(f'  <graph id="{xml_attr(gate)}" edgedefault="undirected">\n')
+        for n in graph.nodes.values():
+            data = "".join(f'<data key="{key}">{xml_attr(value)}</data>'
+                           for key, value in zip(GRAPHML_NODE_KEYS, (n.name, n.serial, n.type, n.mac, n.model))
+                           if value is not None)
+            f.write(f'    <node id="{xml_attr(n.id)}">{data}</node>\n')
+        for i, e in enumerate(graph.edges):
+            data = "".join(f'<data key="{key}">{xml_attr(value)}</data>'
+                           for key, value in zip(GRAPHML_EDGE_KEYS, (e.src_port, e.dst_port)) if value)
+            f.write(f'    <edge id="e{i}" source="{xml_attr(e.src)}" target="{xml_attr(e.dst)}">{data}</edge>\n')
+        f.write('  </graph>\n</graphml>\n')
+    return filename
+
+DOT_SHAPES = {'fortigate': "box3d", 'switch': "box", 'ap': "ellipse"}
+
+def dot_quote(value):
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+
+def export_dot(filename, graph, meta, **options):
+    """Graphviz DOT, e.g. for 'dot -Tsvg' or 'sfdp' on very large sites."""
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write(f"graph {dot_quote(meta.get('gate', {}).get('name') or 'topology')} {{\n")
+        f.write('  node [fontname="Helvetica", fontsize=10];\n  edge [fontsize=8];\n')
+        for n in graph.nodes.values():
+            f.write(f"  {dot_quote(n.id)} [label={dot_quote(n.label)}, shape={DOT_SHAPES.get(n.type, 'box')}, "
+                    f"type={dot_quote(n.type)}];\n")
+        for e in graph.edges:
+            attrs = []
+            if e.src_port: attrs.append(f"taillabel={dot_quote(e.src_port)}")
+            if e.dst_port: attrs.append(f"headlabel={dot_quote(e.dst_port)}")
+            f.write(f"  {dot_quote(e.src)} -- {dot_quote(e.dst)}" + (f" [{', '.join(attrs)}]" if attrs else "") + ";\n")
+        f.write("}\n")
+    return filename
+
+register_exporter("drawio", ".drawio", export_drawio)
+register_exporter("graphml", ".graphml", export_graphml)
+register_exporter("dot", ".dot", export_dot)
+register_exporter("json", ".json", export_json)
+
+def run_export_job(args):
+    """Process pool worker: loads the artifact and runs one exporter. Returns (file, seconds)."""
+    name, source, filename = args
+    start = time.perf_counter()
+    meta, graph = load_artifact(source)
+    EXPORTERS[name][1](filename, graph, meta)
+    return filename, time.perf_counter() - start
+
+def run_exporters(filename, graph, meta, formats=None, artifact=None, export_workers=None, metrics=None, **options):
+    """
+    Runs the exporters of formats on one topology, drawio in this process.
+    For large topologies with an artifact on disk, the other formats run in
+    parallel processes that each load the artifact. options go to the exporters
+    running in this process (e.g. incremental). The phases are recorded in
+    metrics, the RunMetrics of the target (default: run totals). Returns the written files.
+    """
+    metrics = METRICS if metrics is None else metrics
+    formats = [name for name in (formats or EXPORT_FORMATS) if name in EXPORTERS]
+    workers = EXPORT_WORKERS if export_workers is None else export_workers
+    workers = min(workers, os.cpu_count() or 1)
+    others = [name for name in formats if name != "drawio"]
+
+    executor = None
+    futures = {}
+    if artifact and workers > 1 and others and len(graph) >= PARALLEL_EXPORT_MIN_NODES:
+        try:
+            executor = ProcessPoolExecutor(max_workers=min(workers, len(others)))
+            futures = {name: executor.submit(run_export_job, (name, artifact, export_file(filename, name)))
+                       for name in others}
+        except Exception as e:
+            log(f"Parallel export failed ({e}), exporting in-process")
+
+    written = {}
+    for name in formats:
+        if name in futures:
+            continue
+        start = time.perf_counter()
+        written[name] = EXPORTERS[name][1](export_file(filename, name), graph, meta, metrics=metrics, **options)
+        if name != "drawio":
+            metrics.add_phase(f"export_{name}", time.perf_counter() - start, filename)
+
+    for name, future in futures.items():
+        try:
+            written[name], seconds = future.result()
+            metrics.add_phase(f"export_{name}", seconds, filename)
+        except Exception as e:
+            log(f"Export {name} failed ({e}), exporting in-process")
+            written[name] = EXPORTERS[name][1](export_file(filename, name), graph, meta, metrics=metrics, **options)
+    if executor is not None:
+        executor.shutdown()
+
+    files = [written[name] for name in formats if name in written]
+    for name in others:
+        if name in written:
+            log(f"File saved: {written[name]}")
+    return files
+
+# --- COLLECTION ---
+def collect_endpoints(ctx, endpoints, max_workers=COLLECT_WORKERS, deadline=ENDPOINT_DEADLINE):
+    """
+    Fetches independent endpoints in parallel and joins the results.
+    deadline is either seconds for all endpoints or a dict {endpoint: seconds},
+    counted from the start of the collection. Late endpoints return [].
+    """
+    results = {}
+    if not endpoints:
+        return results
 
-        # 1. Identify Gate
-        fg_serial, fg_hostname = get_gate_details()
-        
-        devices.append({'id': fg_serial, 'name': fg_hostname, 'serial': fg_serial, 'type': 'fortigate'})
-        name_to_serial[fg_hostname] = fg_serial 
-        name_to_serial[fg_serial] = fg_serial   
-        name_to_serial['FortiGate'] = fg_serial 
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(endpoints))))
+    start = time.monotonic()
+    futures = {ep: executor.submit(fetch_endpoint, ctx, ep) for ep in endpoints}
 
-        # 2. Switches
-        log("Load switches")
-        results = get_data("/cmdb/switch-controller/managed-switch")
+    for ep, future in futures.items():
+        limit = deadline.get(ep, ENDPOINT_DEADLINE) if isinstance(deadline, dict) else deadline
+        remaining = max(0, start + limit - time.monotonic())
+        try:
+            results[ep] = future.result(timeout=remaining)
+        except FutureTimeout:
+            log(f"Timeout {ep}: no answer after {limit}s", error=True)
+            future.cancel()
+            record_failure(ctx, endpoint_path(ep), f"no answer after {limit}s")
+            results[ep] = []
+        except Exception as e:
+            log(f"Error {ep}: {e}", error=True)
+            record_failure(ctx, endpoint_path(ep), e)
+            results[ep] = []
 
-        if (CONNECTION_MODE == "FMG"):
-            data = results[0].get('response', results)
-            
-            # Check if it is a list
-            if isinstance(data, dict):
-                switches_data = data.get('results', [])
-            elif isinstance(data, list):
-                switches_data = data
+    # Do not wait for requests that missed their deadline
+    executor.shutdown(wait=False, cancel_futures=True)
+    return results
+
+# --- PAGED FETCHES ---
+def endpoint_path(endpoint):
+    return endpoint.split('?')[0]
+
+def vdom_endpoint(endpoint, vdom):
+    separator = "&" if "?" in endpoint else "?"
+    return f"{endpoint}{separator}{urlencode({'vdom': vdom})}"
+
+def endpoint_query(endpoint, start=None, count=None):
+    """
+    Endpoint with FortiOS field filter (format=) and paging (start/count) parameters.
+    Only cmdb tables know format=, monitor answers are projected after the download.
+    """
+    params = []
+    spec = ENDPOINT_FIELDS.get(endpoint_path(endpoint))
+    if spec and endpoint.startswith("/cmdb/"):
+        params.append(('format', "|".join(spec[0])))
+    if count:
+        params += [('start', start or 0), ('count', count)]
+    if not params:
+        return endpoint
+    separator = "&" if "?" in endpoint else "?"
+    return f"{endpoint}{separator}{urlencode(params, safe='|')}"
+
+def project_record(endpoint, record):
+    """Drops every field the collector does not use, also inside the sub-tables."""
+    spec = ENDPOINT_FIELDS.get(endpoint_path(endpoint))
+    if not spec or not isinstance(record, dict):
+        return record
+    fields, sub_table, sub_fields = spec
+    projected = {key: record[key] for key in fields if key in record}
+    if isinstance(projected.get(sub_table), list):
+        projected[sub_table] = [{key: row[key] for key in sub_fields if key in row}
+                                for row in projected[sub_table] if isinstance(row, dict)]
+    return projected
+
+def iter_result_pages(ctx, endpoint, page_size=None):
+    """
+    Yields the projected results of a list endpoint page by page, as they arrive.
+    Stops at a short page, or when the device ignores the paging parameters.
+    """
+    if page_size is None:
+        page_size = ctx.page_size
+    start = 0
+    previous_first = None
+    while True:
+        raw = get_data(ctx, endpoint_query(endpoint, start, page_size))
+        results = extract_results(raw)
+        received = len(results)
+        page = [project_record(endpoint, record) for record in results]
+        del raw, results
+        if not page:
+            return
+
+        # Same first record again: start is ignored. A device ignoring count as well
+        # answers everything at once, which ends the loop as a page of the wrong size.
+        first = repr(page[0])
+        if first == previous_first:
+            return
+        previous_first = first
+
+        yield page
+        if not page_size or received != page_size:
+            return
+        start += len(page)
+
+def get_paged(ctx, endpoint, page_size=None):
+    """
+    All projected records of a list endpoint. Link inference needs every switch
+    before the first AP and VDOMs are merged by serial, so the pages are joined
+    here; only one raw page is held at a time.
+    """
+    records = []
+    for page in iter_result_pages(ctx, endpoint, page_size):
+        records.extend(page)
+    return {'results': records}
+
+def fetch_endpoint(ctx, endpoint):
+    """List endpoints are fetched paged and projected, all others in one request."""
+    with ctx.metrics.phase(ENDPOINT_PHASES.get(endpoint_path(endpoint), endpoint), ctx.ip):
+        if endpoint_path(endpoint) in ENDPOINT_FIELDS:
+            return get_paged(ctx, endpoint)
+        return get_data(ctx, endpoint)
+
+def extract_results(results):
+    """Returns the 'results' list of a direct or FMG proxy response."""
+    data = results
+    if isinstance(results, list) and results and isinstance(results[0], dict):
+        # FMG proxy answer: [{'target': ..., 'response': {...}, 'status': {...}}]
+        data = results[0].get('response', results)
+
+    if isinstance(data, dict):
+        data = data.get('results', [])
+    return data if isinstance(data, list) else []
+
+def merge_records(record_lists, key):
+    """Joins the records of several VDOMs, the first record per serial wins."""
+    merged = {}
+    for records in record_lists:
+        for record in records:
+            merged.setdefault(record.get(key) or id(record), record)
+    return list(merged.values())
+
+def vdom_names(vdom_data):
+    return [v['name'] for v in extract_results(vdom_data) if isinstance(v, dict) and v.get('name')]
+
+def ha_peers(ha_data):
+    """Units of an HA cluster from /monitor/system/ha-peer as [{'serial', 'name'}]."""
+    return [{'serial': peer['serial_no'], 'name': peer.get('hostname', '')}
+            for peer in extract_results(ha_data) if isinstance(peer, dict) and peer.get('serial_no')]
+
+def fetch_fmg_vdoms(ctx):
+    """VDOM names of the selected device as known by the FMG."""
+    if not ctx.device:
+        return []
+    resource = f"/dvmdb/device/{ctx.device.get('name')}/vdom"
+    data = cached_fetch(ctx, resource, lambda: fmg_json_rpc(ctx, "get", resource, {"fields": ["name"]}))
+    return vdom_names({'results': data}) if isinstance(data, list) else []
+
+def discover_gate(ctx, collected):
+    """
+    VDOMs, the VDOM answering requests without vdom= and the HA members of a gate.
+    Direct mode reads them from the prefetched endpoints, FMG mode from its device database.
+    """
+    if ctx.mode == "FMG":
+        return fetch_fmg_vdoms(ctx), ctx.device.get('mgt_vdom') or "root", ctx.device.get('ha_members', [])
+
+    status = collected.get(EP_SYSTEM)
+    default_vdom = status.get('vdom') if isinstance(status, dict) and status.get('vdom') else "root"
+    return vdom_names(collected.get(EP_VDOMS)), default_vdom, ha_peers(collected.get(EP_HA_PEERS))
+
+def collect_vdoms(ctx, collected, vdoms, default_vdom):
+    """
+    Switches and APs of all VDOMs, deduplicated by serial. collected holds the
+    answers without vdom=, the other VDOMs are fetched in parallel.
+    """
+    switch_lists = [extract_results(collected.get(EP_SWITCHES))]
+    ap_lists = [extract_results(collected.get(EP_APS))]
+
+    others = [vdom for vdom in vdoms if vdom != default_vdom]
+    if others:
+        log(f"VDOMs: {', '.join(vdoms)}")
+        endpoints = [vdom_endpoint(ep, vdom) for vdom in others for ep in (EP_SWITCHES, EP_APS)]
+        per_vdom = collect_endpoints(ctx, endpoints, max_workers=VDOM_WORKERS)
+        for vdom in others:
+            switch_lists.append(extract_results(per_vdom.get(vdom_endpoint(EP_SWITCHES, vdom))))
+            ap_lists.append(extract_results(per_vdom.get(vdom_endpoint(EP_APS, vdom))))
+
+    return merge_records(switch_lists, 'switch-id'), merge_records(ap_lists, 'serial')
+
+# --- LINK INFERENCE ---
+def build_topology(fg_serial, fg_hostname, switches_data, aps_data, ha_members=None):
+    """
+    Builds the TopologyGraph of one FortiGate from its switch and AP data.
+    ha_members ({'serial', 'name'}) are the other units of an HA cluster.
+    """
+    graph = TopologyGraph()
+
+    fg = graph.add_node(fg_serial, fg_hostname, 'fortigate')
+    graph.add_alias('FortiGate', fg.id)
+
+    # HA cluster members, FortiLink peers may name any of them
+    for member in ha_members or []:
+        if member.get('serial') and member['serial'] != fg_serial:
+            graph.add_node(member['serial'], member.get('name') or member['serial'], 'fortigate')
+            graph.add_edge(fg_serial, member['serial'], "HA", "HA")
+
+    # Switches
+    for i, sw in enumerate(switches_data):
+        s_serial = sw.get('switch-id', f"Unknown_SW_{i}")
+        s_name = sw.get('name', s_serial)
+        graph.add_node(s_serial, s_name, 'switch', sw.get('mac'), sw.get('model'))
+        log(f"Switch: {s_serial} ({s_name})")
+
+    # APs
+    for i, ap in enumerate(aps_data):
+        ap_serial = ap.get('serial', f"Unknown_AP_{i}")
+        ap_name = ap.get('name', ap_serial)
+        graph.add_node(ap_serial, ap_name, 'ap', ap.get('board_mac') or ap.get('mac'), ap.get('model'))
+        log(f"{ap_serial} {ap_name}")
+
+    log(f"Created mappings. {len(graph)} devices found.")
+
+    # Links (Switches)
+    found_links = 0
+    for sw in switches_data:
+        my_serial = sw.get('switch-id')
+        if not my_serial: continue
+        
+        ports = sw.get('ports', [])
+        for port in ports:
+            local_port = port.get('port-name')
+            peer_name = port.get('isl-peer-device-name')
+            if peer_name:
+                parent_port = port.get('isl-peer-port-name')
+                if graph.add_edge(peer_name, my_serial, parent_port, local_port):
+                    found_links += 1
             else:
-                switches_data = []
-                log("Warning: No switches loaded.")
+                peer_name = port.get('fgt-peer-device-name')
+                if peer_name:
+                    parent_port = port.get('fgt-peer-port-name')
+                    graph.add_edge(peer_name, my_serial, parent_port, local_port)
+    
+    log(f"Connections found: {found_links}")
+
+    # Links (APs)
+    for ap in aps_data:
+        my_serial = ap.get('serial')
+        lldp_info = ap.get('lldp') or []
+        parent = None
+        if len(lldp_info) > 0:
+            parent_name = lldp_info[0].get('system_name')
+            parent_port = lldp_info[0].get('port_id')
+            local_port = lldp_info[0].get('local_port')
+            # Name first, chassis MAC if the neighbor reports an unknown name
+            parent = graph.resolve(parent_name) or graph.resolve(lldp_info[0].get('chassis_id'))
+
+        if parent:
+            graph.add_edge(parent, my_serial, parent_port, local_port)
         else:
-            switches_data = results.get('results', [])
-
-        for i, sw in enumerate(switches_data):
-            s_serial = sw.get('switch-id', f"Unknown_SW_{i}")
-            s_name = sw.get('name', s_serial)
-            devices.append({'id': s_serial, 'name': s_name, 'serial': s_serial, 'type': 'switch'})
-            log(f"Switch: {s_serial} ({s_name})")
-            name_to_serial[s_name] = s_serial
-            name_to_serial[s_serial] = s_serial 
-
-        # 3. APs
-        log("Load access points")
-        results = get_data("/monitor/wifi/managed_ap/select")
-
-        if (CONNECTION_MODE == "FMG"):
-            data = results[0].get('response', results)
-            
-            # Check if it is a list
-            if isinstance(data, dict):
-                aps_data = data.get('results', [])
-            elif isinstance(results, list):
-                aps_data = data
-            else:
-                aps_data = []
-                log("Warning: No access points loaded.")
+            parent_serial = ap.get('connected_switch_serial')
+            if parent_serial and graph.resolve(parent_serial):
+                graph.add_edge(parent_serial, my_serial, "?", "eth0")
+
+    return graph
+
+# --- HISTORY ---
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    gate_serial TEXT NOT NULL,
+    gate_name TEXT,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    polls INTEGER NOT NULL DEFAULT 1,
+    source TEXT,
+    hash TEXT NOT NULL,
+    nodes INTEGER,
+    links INTEGER
+);
+CREATE INDEX IF NOT EXISTS snapshots_gate ON snapshots (gate_serial, last_seen);
+CREATE INDEX IF NOT EXISTS snapshots_name ON snapshots (gate_name, last_seen);
+CREATE INDEX IF NOT EXISTS snapshots_time ON snapshots (last_seen);
+CREATE TABLE IF NOT EXISTS nodes (
+    snapshot_id INTEGER NOT NULL,
+    pos INTEGER NOT NULL,
+    node_id TEXT NOT NULL,
+    serial TEXT,
+    name TEXT,
+    type TEXT,
+    mac TEXT,
+    model TEXT,
+    PRIMARY KEY (snapshot_id, pos)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS nodes_serial ON nodes (serial, snapshot_id);
+CREATE INDEX IF NOT EXISTS nodes_id ON nodes (snapshot_id, node_id);
+CREATE TABLE IF NOT EXISTS links (
+    snapshot_id INTEGER NOT NULL,
+    pos INTEGER NOT NULL,
+    src TEXT NOT NULL,
+    dst TEXT NOT NULL,
+    src_port TEXT,
+    dst_port TEXT,
+    PRIMARY KEY (snapshot_id, pos)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS links_src ON links (snapshot_id, src);
+CREATE INDEX IF NOT EXISTS links_dst ON links (snapshot_id, dst);
+"""
+
+def open_history(path=None):
+    path = path or HISTORY_DB
+    folder = os.path.dirname(os.path.abspath(path))
+    os.makedirs(folder, exist_ok=True)
+    db = sqlite3.connect(path, timeout=30)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript(HISTORY_SCHEMA)
+    return db
+
+def normalized_link(src, dst, src_port, dst_port):
+    """Same key for a link regardless of its direction."""
+    if src <= dst:
+        return (src, dst, src_port or "", dst_port or "")
+    return (dst, src, dst_port or "", src_port or "")
+
+def record_snapshot(graph, gate_serial, gate_name="", source="", taken=None, path=None):
+    """
+    Stores the graph of one FortiGate. An unchanged topology only extends the
+    last snapshot (last_seen, polls), so polling adds no rows. Returns the snapshot id.
+    """
+    taken = time.time() if taken is None else taken
+    node_rows = [(n.id, n.serial, n.name, n.type, n.mac, n.model) for n in graph.nodes.values()]
+    link_rows = [(e.src, e.dst, e.src_port, e.dst_port) for e in graph.edges]
+    content = json.dumps([sorted(node_rows, key=repr), sorted(normalized_link(*l) for l in link_rows)])
+    digest = hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+    with HISTORY_LOCK, closing(open_history(path)) as db, db:
+        last = db.execute("SELECT id, hash FROM snapshots WHERE gate_serial = ? ORDER BY last_seen DESC LIMIT 1",
+                          (gate_serial,)).fetchone()
+        if last and last[1] == digest:
+            db.execute("UPDATE snapshots SET last_seen = ?, polls = polls + 1, gate_name = ? WHERE id = ?",
+                       (taken, gate_name, last[0]))
+            return last[0]
+
+        snapshot_id = db.execute(
+            "INSERT INTO snapshots (gate_serial, gate_name, first_seen, last_seen, source, hash, nodes, links) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (gate_serial, gate_name, taken, taken, source, digest, len(node_rows), len(link_rows))).lastrowid
+        db.executemany("INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       [(snapshot_id, i) + row for i, row in enumerate(node_rows)])
+        db.executemany("INSERT INTO links VALUES (?, ?, ?, ?, ?, ?)",
+                       [(snapshot_id, i) + row for i, row in enumerate(link_rows)])
+    return snapshot_id
+
+def record_history(graph, gate_serial, gate_name="", source="", path=None):
+    """record_snapshot() into path (default HISTORY_DB), if enabled. Errors are only logged."""
+    path = HISTORY_DB if path is None else path
+    if not path:
+        return None
+    try:
+        return record_snapshot(graph, gate_serial, gate_name, source, path=path)
+    except Exception as e:
+        log(f"Could not store history: {e}")
+        return None
+
+def snapshot_meta(row):
+    keys = ('id', 'gate_serial', 'gate_name', 'first_seen', 'last_seen', 'polls', 'source', 'nodes', 'links')
+    return dict(zip(keys, row))
+
+SNAPSHOT_COLUMNS = "id, gate_serial, gate_name, first_seen, last_seen, polls, source, nodes, links"
+
+def list_snapshots(gate=None, limit=50, path=None):
+    """Newest snapshots first, optionally of one gate (serial or name)."""
+    with closing(open_history(path)) as db:
+        if gate:
+            rows = db.execute(f"SELECT {SNAPSHOT_COLUMNS} FROM snapshots WHERE gate_serial = ? OR gate_name = ? "
+                              "ORDER BY last_seen DESC LIMIT ?", (gate, gate, limit)).fetchall()
         else:
-            aps_data = results.get('results', [])
-
-        for i, ap in enumerate(aps_data):
-            ap_serial = ap.get('serial', f"Unknown_AP_{i}")
-            ap_name = ap.get('name', ap_serial)
-            devices.append({'id': ap_serial, 'name': ap_name, 'serial': ap_serial, 'type': 'ap'})
-            log(f"{ap_serial} {ap_name}")
-            name_to_serial[ap_name] = ap_serial
-
-        log(f"Created mappings. {len(devices)} devices found.")
-
-        # 4. Links (Switches)
-        found_links = 0
-        for sw in switches_data:
-            my_serial = sw.get('switch-id')
-            if not my_serial: continue
-            
-            ports = sw.get('ports', [])
-            for port in ports:
-                local_port = port.get('port-name')
-                peer_name = port.get('isl-peer-device-name')
-                if peer_name:
-                    peer_serial = name_to_serial.get(peer_name)
-                    parent_port = port.get('isl-peer-port-name')
-                    if peer_serial:
-                        links.append({
-                            'src': peer_serial,
-                            'dst': my_serial,
-                            'src_port': parent_port,
-                            'dst_port': local_port})
-                        found_links += 1
-                else:
-                    peer_name = port.get('fgt-peer-device-name')
-                    if peer_name:
-                        peer_serial = peer_name
-                        parent_port = port.get('fgt-peer-port-name')
-                        if peer_serial:
-                            links.append({
-                            'src': peer_serial,
-                            'dst': my_serial,
-                            'src_port': parent_port,
-                            'dst_port': local_port})
-        
-        log(f"Connections found: {found_links}")
-
-        # 5. Links (APs)
-        for ap in aps_data:
-            my_serial = ap.get('serial')
-            lldp_info = ap.get('lldp')
-            parent_name = ""
-            if len(lldp_info) > 0:
-                parent_name = lldp_info[0].get('system_name')
-                parent_port = lldp_info[0].get('port_id')
-                local_port = lldp_info[0].get('local_port')
-
-            if parent_name:
-                parent_serial = name_to_serial.get(parent_name)
-                if parent_serial:
-                    links.append({
-                            'src': parent_serial,
-                            'dst': my_serial,
-                            'src_port': parent_port,
-                            'dst_port': local_port})
-            else:
-                parent_serial = ap.get('connected_switch_serial')
-                if parent_serial and parent_serial in name_to_serial.values():
-                    links.append({
-                            'src': parent_serial,
-                            'dst': my_serial,
-                            'src_port': "?",
-                            'dst_port': "eth0"})
-
-        if custom_path:
-            filename = custom_path
+            rows = db.execute(f"SELECT {SNAPSHOT_COLUMNS} FROM snapshots ORDER BY last_seen DESC LIMIT ?",
+                              (limit,)).fetchall()
+    return [snapshot_meta(row) for row in rows]
+
+def load_snapshot(snapshot_id, path=None):
+    """Returns (snapshot info, TopologyGraph) of a stored snapshot, None if unknown."""
+    with closing(open_history(path)) as db:
+        row = db.execute(f"SELECT {SNAPSHOT_COLUMNS} FROM snapshots WHERE id = ?", (snapshot_id,)).fetchone()
+        if row is None:
+            return None
+        graph = TopologyGraph()
+        for node_id, serial, name, node_type, mac, model in db.execute(
+                "SELECT node_id, serial, name, type, mac, model FROM nodes WHERE snapshot_id = ? ORDER BY pos",
+                (snapshot_id,)):
+            graph.add_node(serial, name, node_type, mac, model, node_id=node_id)
+        for src, dst, src_port, dst_port in db.execute(
+                "SELECT src, dst, src_port, dst_port FROM links WHERE snapshot_id = ? ORDER BY pos", (snapshot_id,)):
+            graph.add_edge(src, dst, src_port, dst_port)
+    return snapshot_meta(row), graph
+
+def topology_rows(graph):
+    """({node id: (serial, name, type, mac, model)}, {normalized links}) of a graph."""
+    nodes = {n.id: (n.serial, n.name, n.type, n.mac, n.model) for n in graph.nodes.values()}
+    links = {normalized_link(e.src, e.dst, e.src_port, e.dst_port) for e in graph.edges}
+    return nodes, links
+
+def diff_rows(old_nodes, new_nodes, old_links, new_links):
+    """Devices and links added, removed or changed between two topology_rows()."""
+    names = {node_id: row[1] for node_id, row in old_nodes.items()}
+    names.update({node_id: row[1] for node_id, row in new_nodes.items()})
+
+    def node_info(row):
+        return {'serial': row[0], 'name': row[1], 'type': row[2], 'mac': row[3], 'model': row[4]}
+
+    def link_info(link):
+        return {'src': names.get(link[0], link[0]), 'dst': names.get(link[1], link[1]),
+                'src_port': link[2], 'dst_port': link[3]}
+
+    return {
+        'devices_added': [node_info(new_nodes[n]) for n in sorted(new_nodes.keys() - old_nodes.keys())],
+        'devices_removed': [node_info(old_nodes[n]) for n in sorted(old_nodes.keys() - new_nodes.keys())],
+        'devices_changed': [{'old': node_info(old_nodes[n]), 'new': node_info(new_nodes[n])}
+                            for n in sorted(old_nodes.keys() & new_nodes.keys()) if old_nodes[n] != new_nodes[n]],
+        'links_added': [link_info(l) for l in sorted(new_links - old_links)],
+        'links_removed': [link_info(l) for l in sorted(old_links - new_links)],
+    }
+
+def diff_snapshots(old_id, new_id, path=None):
+    """Devices and links added, removed or changed between two snapshots."""
+    with closing(open_history(path)) as db:
+        def nodes(snapshot_id):
+            return {row[0]: tuple(row[1:]) for row in db.execute(
+                "SELECT node_id, serial, name, type, mac, model FROM nodes WHERE snapshot_id = ?", (snapshot_id,))}
+
+        def links(snapshot_id):
+            return {normalized_link(*row) for row in db.execute(
+                "SELECT src, dst, src_port, dst_port FROM links WHERE snapshot_id = ?", (snapshot_id,))}
+
+        diff = diff_rows(nodes(old_id), nodes(new_id), links(old_id), links(new_id))
+    return dict({'from': old_id, 'to': new_id}, **diff)
+
+def changes_since(gate, since, path=None):
+    """
+    Diff between the topology of a gate (serial or name) at time `since`
+    and its latest snapshot. None if the gate has no history.
+    """
+    with closing(open_history(path)) as db:
+        serial = db.execute("SELECT gate_serial FROM snapshots WHERE gate_serial = ? OR gate_name = ? "
+                            "ORDER BY last_seen DESC LIMIT 1", (gate, gate)).fetchone()
+        if serial is None:
+            return None
+        latest = db.execute("SELECT id FROM snapshots WHERE gate_serial = ? ORDER BY last_seen DESC LIMIT 1",
+                            serial).fetchone()[0]
+        base = db.execute("SELECT id FROM snapshots WHERE gate_serial = ? AND first_seen <= ? "
+                          "ORDER BY first_seen DESC LIMIT 1", (serial[0], since)).fetchone()
+        if base is None:
+            base = db.execute("SELECT id FROM snapshots WHERE gate_serial = ? ORDER BY first_seen LIMIT 1",
+                              serial).fetchone()
+    return diff_snapshots(base[0], latest, path)
+
+def device_history(serial, path=None):
+    """
+    Where a device (e.g. an AP) was connected over time: one entry per period
+    with gate, peer device and ports, merged while the connection stayed the same.
+    """
+    periods = []
+    with closing(open_history(path)) as db:
+        rows = db.execute(
+            "SELECT s.id, s.gate_serial, s.gate_name, s.first_seen, s.last_seen, n.node_id "
+            "FROM nodes n JOIN snapshots s ON s.id = n.snapshot_id WHERE n.serial = ? ORDER BY s.first_seen",
+            (serial,)).fetchall()
+        for snapshot_id, gate_serial, gate_name, first_seen, last_seen, node_id in rows:
+            peers = []
+            for src, dst, src_port, dst_port in db.execute(
+                    "SELECT src, dst, src_port, dst_port FROM links WHERE snapshot_id = ? AND src = ? "
+                    "UNION ALL SELECT src, dst, src_port, dst_port FROM links WHERE snapshot_id = ? AND dst = ?",
+                    (snapshot_id, node_id, snapshot_id, node_id)):
+                peer, peer_port, port = (dst, dst_port, src_port) if src == node_id else (src, src_port, dst_port)
+                name = db.execute("SELECT name FROM nodes WHERE snapshot_id = ? AND node_id = ?",
+                                  (snapshot_id, peer)).fetchone()
+                peers.append((name[0] if name else peer, peer_port or "", port or ""))
+            location = (gate_serial, tuple(sorted(peers)))
+
+            if periods and periods[-1]['location'] == location:
+                periods[-1]['to'] = max(periods[-1]['to'], last_seen)
+                continue
+            periods.append({'location': location, 'from': first_seen, 'to': last_seen,
+                            'gate_serial': gate_serial, 'gate_name': gate_name,
+                            'peers': [{'peer': p, 'peer_port': pp, 'port': lp} for p, pp, lp in sorted(peers)]})
+    for period in periods:
+        del period['location']
+    return periods
+
+def parse_since(text):
+    """'7d', '12h', '30m', an ISO date/time or epoch seconds -> epoch seconds."""
+    text = str(text).strip()
+    units = {'m': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    if text[-1:].lower() in units and text[:-1].replace(".", "", 1).isdigit():
+        return time.time() - float(text[:-1]) * units[text[-1].lower()]
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    for fmt in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return time.mktime(time.strptime(text, fmt))
+        except ValueError:
+            continue
+    raise ValueError(f"Unknown time: {text}")
+
+# --- COLLECTOR API ---
+def collect_topology(ctx):
+    """
+    Collects one FortiGate and infers its links.
+    Returns (serial, hostname, TopologyGraph).
+    """
+    # 1. Collect all independent endpoints at once
+    log("Load gate details, switches and access points")
+    endpoints = [EP_SWITCHES, EP_APS]
+    if ctx.mode == "DIRECT":
+        endpoints = [EP_LICENSE, EP_SYSTEM, EP_VDOMS, EP_HA_PEERS] + endpoints
+    collected = collect_endpoints(ctx, endpoints)
+
+    # 2. Identify Gate, its VDOMs and HA members
+    fg_serial, fg_hostname = get_gate_details(ctx, collected.get(EP_LICENSE), collected.get(EP_SYSTEM))
+    vdoms, default_vdom, members = discover_gate(ctx, collected)
+    if len(members) > 1:
+        log(f"HA cluster: {', '.join(m['name'] or m['serial'] for m in members)}")
+
+    # 3. Switches and APs of all VDOMs
+    switches_data, aps_data = collect_vdoms(ctx, collected, vdoms, default_vdom)
+    if not switches_data:
+        log("Warning: No switches loaded.")
+    if not aps_data:
+        log("Warning: No access points loaded.")
+
+    # 4. Links
+    with ctx.metrics.phase("link_inference", fg_hostname):
+        graph = build_topology(fg_serial, fg_hostname, switches_data, aps_data, members)
+    return fg_serial, fg_hostname, graph
+
+# --- RENDERER API ---
+def write_topology(filename, graph, incremental=None, compressed=None, aggregate=None, partition=None,
+                   aggregate_switches=None, render_workers=None, metrics=None, **options):
+    """
+    Writes the .drawio file. With incremental, an existing file is updated in place
+    so manual layout survives, and is not rewritten at all if nothing changed.
+    Otherwise the file is streamed cell by cell.
+    graph is a TopologyGraph or a list of pages [(name, graph)], e.g. one per FortiGate.
+    aggregate is the leaf group size for aggregate_graph (default AGGREGATE_THRESHOLD),
+    partition the page split of partition_graph (default PARTITION_MODE).
+    The phases are recorded in metrics (default: run totals), options of other
+    exporters (see output_options()) are ignored.
+    """
+    metrics = METRICS if metrics is None else metrics
+    start = time.perf_counter()
+    topology = build_pages(graph, partition, aggregate, aggregate_switches)
+    if incremental is None:
+        incremental = DRAWIO_INCREMENTAL
+    if compressed is None:
+        compressed = DRAWIO_COMPRESSED
+
+    xml_content = None
+    if incremental and os.path.exists(filename):
+        try:
+            with open(filename, "rb") as f:
+                xml_content, diff = update_drawio_xml(f.read(), topology)
+            if not any(diff.values()):
+                log(f"No changes: {filename}")
+                metrics.add_phase("xml_build", time.perf_counter() - start, filename)
+                return filename
+            log(f"Changes: {diff['added']} added, {diff['removed']} removed, {diff['updated']} updated")
+        except Exception as e:
+            log(f"Incremental update failed ({e}), writing new file")
+            xml_content = None
+
+    # The XML is streamed into the file, so the time inside write() is the file part
+    with open(filename, "wb") as f:
+        out = TimedWriter(f)
+        if xml_content is not None:
+            out.write(xml_content)
         else:
-            filename = f"topology_{fg_hostname}.drawio"
+            write_drawio_stream(out, topology, compressed, render_workers)
+    metrics.add_phase("xml_build", time.perf_counter() - start - out.seconds, filename)
+    metrics.add_phase("file_write", out.seconds, filename)
+    log(f"File saved: {filename}")
+    return filename
+
+def export_outputs(filename, graph, gate_serial="", gate_name="", source="", write_artifact=None, metrics=None,
+                   **options):
+    """
+    Renders one collection: stores the topology artifact next to filename
+    (if write_artifact, default WRITE_ARTIFACT) and runs the exporters of
+    options['formats'] (default EXPORT_FORMATS) on it. filename is the .drawio
+    name, other formats swap its suffix. metrics is the RunMetrics of the target
+    (default: run totals). Returns the written files in the order of formats.
+    """
+    metrics = METRICS if metrics is None else metrics
+    if write_artifact is None:
+        write_artifact = WRITE_ARTIFACT
+    artifact = topology_artifact(graph, gate_serial, gate_name, source)
+    meta = {key: value for key, value in artifact.items() if key not in ('nodes', 'edges')}
+    saved = None
+    if write_artifact:
+        start = time.perf_counter()
+        try:
+            saved = save_artifact(artifact_file(filename), artifact)
+        except Exception as e:
+            log(f"Could not save topology artifact: {e}")
+        metrics.add_phase("artifact_write", time.perf_counter() - start, filename)
+    del artifact
+    return run_exporters(filename, graph, meta, artifact=saved, metrics=metrics, **options)
+
+def export_topology(ctx, custom_path="", **options):
+    """Collects a target and runs the exporters (options: output_options()) on it. Returns the written files."""
+    fg_serial, fg_hostname, graph = collect_topology(ctx)
+    if fg_serial != "FG-UNKNOWN" and not ctx.failures:
+        record_history(graph, fg_serial, fg_hostname, ctx.mode, ctx.history_db)
+    filename = custom_path or f"topology_{fg_hostname}.drawio"
+    return export_outputs(filename, graph, fg_serial, fg_hostname, ctx.mode, metrics=ctx.metrics, **options)
+
+def export_artifact(source, filename="", **options):
+    """Runs exporters on a stored artifact, without touching any device. Returns the written files."""
+    meta, graph = load_artifact(source)
+    if not filename:
+        filename = source[:-len(ARTIFACT_SUFFIX)] + ".drawio" if source.endswith(ARTIFACT_SUFFIX) else source + ".drawio"
+    options.pop('write_artifact', None)
+    return run_exporters(filename, graph, meta, artifact=source, **options)
 
-        xml_content = create_drawio_xml(devices, links)
-        with open(filename, "wb") as f:
-            f.write(xml_content)
-        
-        log(f"File saved: {filename}")
-        on_finish_callback(True)
+# --- THREAD WORKER ---
+def finish_metrics(json_path=None, prom_path=None, metrics=None):
+    """Logs the summary table of a target (default: run totals) and writes the metrics files."""
+    metrics = METRICS if metrics is None else metrics
+    log("Run metrics:\n" + metrics.summary_table())
+    write_metrics(json_path, prom_path, metrics)
+
+def run_process_thread(ctx, on_finish_callback, custom_path="", incremental=None):
+    # Only this target starts over, other runs of the process keep their metrics
+    ctx.metrics.reset()
+    try:
+        export_topology(ctx, custom_path, incremental=incremental)
+        success = True
 
     except Exception as e:
-        log(f"Critical Error: {e}")
+        log(f"Critical Error: {e}", error=True)
+        success = False
+    finish_metrics(metrics=ctx.metrics)
+    on_finish_callback(success)
+
+# --- FLEET (FMG) ---
+def fmg_proxy_batch(ctx, devices, endpoints):
+    """
+    Fetches all endpoints for a batch of devices with one JSON-RPC exec call.
+    Every endpoint is one param entry whose target list covers all devices,
+    each in the target form cached for it by fetch_data (default: adom path).
+    Returns {serial: {endpoint: proxy entry}} of the devices that answered.
+    """
+    variants = []
+    for d in devices:
+        index = get_cached_target_variant(fmg_target_key(ctx, d))
+        variants.append(index if index in range(len(fmg_proxy_targets(d))) else 0)
+    targets = [fmg_proxy_targets(d)[i] for d, i in zip(devices, variants)]
+    calls = [("/sys/proxy/json", {
+        "target": targets,
+        "action": "get",
+        "resource": f"/api/v2{endpoint_query(endpoint)}"
+    }) for endpoint in endpoints]
+
+    name_to_serial = {d['name']: d['serial'] for d in devices}
+    per_device = {d['serial']: {} for d in devices}
+
+    for endpoint, data in zip(endpoints, fmg_json_rpc_batch(ctx, "exec", calls)):
+        if not isinstance(data, list):
+            log(f"Fleet: no data for {endpoint}")
+            continue
+        for i, entry in enumerate(data):
+            # 'target' is the device name, fall back to the request order if every device answered
+            target = str(entry.get('target', '')).split('/')[-1]
+            serial = name_to_serial.get(target)
+            if serial is None and len(data) == len(devices):
+                serial = devices[i]['serial']
+            if serial is None:
+                continue
+
+            status = entry.get('status', {})
+            if status.get('code', 0) != 0:
+                log(f"Fleet: {target} {endpoint}: {status.get('message')}")
+                continue
+            response = entry.get('response')
+            if isinstance(response, dict) and isinstance(response.get('results'), list):
+                response['results'] = [project_record(endpoint, record) for record in response['results']]
+            per_device[serial][endpoint] = entry
+
+    for d, index in zip(devices, variants):
+        if per_device[d['serial']]:
+            set_cached_target_variant(fmg_target_key(ctx, d), index)
+    return {serial: entries for serial, entries in per_device.items() if entries}
+
+def fetch_device_endpoints(ctx, endpoints):
+    """
+    Fallback for devices missing in the batch answer: the single-device fetches,
+    which probe the target forms and cache the working one for the next batch.
+    Returns {endpoint: records} of the endpoints fetched without a recorded failure.
+    """
+    answered = {}
+    for endpoint in endpoints:
+        failed_before = len(ctx.failures)
+        data = fetch_endpoint(ctx, endpoint)
+        if len(ctx.failures) == failed_before:
+            answered[endpoint] = extract_results(data)
+    return answered
+
+def collect_fleet(ctx, devices, endpoints=FLEET_ENDPOINTS, batch_size=FLEET_BATCH_SIZE):
+    """
+    Collects endpoints for all devices in batches. Returns {serial: {endpoint: records}}.
+    Every endpoint missing in the result has a failure recorded in ctx.
+    """
+    collected = {}
+    use_cache = ctx.cache_mode in RESPONSE_CACHE_MODES and ctx.cache_mode != "off"
+
+    # Devices answered completely from the response cache are not queried
+    pending = []
+    for dev in devices:
+        if ctx.cache_mode in ("replay", "refresh-if-stale"):
+            dev_ctx = ctx.for_device(dev)
+            cached = {}
+            for endpoint in endpoints:
+                hit = load_cached_response(response_cache_key(dev_ctx, endpoint_query(endpoint)))
+                if hit and (ctx.cache_mode == "replay" or hit[0] < ctx.cache_ttl) and hit[1]:
+                    cached[endpoint] = extract_results(hit[1])
+            if len(cached) == len(endpoints) or ctx.cache_mode == "replay":
+                for endpoint in endpoints:
+                    if endpoint not in cached:
+                        log(f"Not in cache: {dev['name']} {endpoint}", error=True)
+                        record_failure(dev_ctx, endpoint, "not in response cache")
+                collected[dev['serial']] = cached
+                continue
+        pending.append(dev)
+
+    batch_size = max(1, int(batch_size))
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        log(f"Fleet: devices {start + 1}-{start + len(batch)} of {len(pending)}")
+        with ctx.metrics.phase("fleet_batch", ctx.ip):
+            result = fmg_proxy_batch(ctx, batch, list(endpoints))
+
+        for dev in batch:
+            entries = result.get(dev['serial'], {})
+            collected[dev['serial']] = {endpoint: extract_results([entry]) for endpoint, entry in entries.items()}
+            if use_cache:
+                dev_ctx = ctx.for_device(dev)
+                for endpoint, entry in entries.items():
+                    # Key and shape of the single-device get_data of the same unpaged resource,
+                    # so fleet and '--page-size 0' runs replay each other
+                    save_cached_response(response_cache_key(dev_ctx, endpoint_query(endpoint)), [entry])
+
+    # Devices the batch did not reach, e.g. because the FMG wants another target form
+    incomplete = [dev for dev in pending if len(collected[dev['serial']]) < len(endpoints)]
+    if incomplete:
+        log(f"Fleet: {len(incomplete)} devices without batch answer, fetching them one by one")
+        with ThreadPoolExecutor(max_workers=COLLECT_WORKERS) as executor:
+            answers = executor.map(lambda dev: fetch_device_endpoints(
+                ctx.for_device(dev), [ep for ep in endpoints if ep not in collected[dev['serial']]]), incomplete)
+            for dev, answered in zip(incomplete, answers):
+                collected[dev['serial']].update(answered)
+    return collected
+
+def export_fleet(ctx, devices, out_dir="", batch_size=FLEET_BATCH_SIZE, single_file=False, **options):
+    """
+    Builds one topology per managed FortiGate, using batched proxy calls. Returns the files.
+    With single_file, all FortiGates go into one .drawio with one page each.
+    options are the output_options() of the run.
+    """
+    collected = collect_fleet(ctx, devices, batch_size=batch_size)
+
+    written = []
+    fleet_pages = []
+    built = 0
+    for dev in devices:
+        responses = collected.get(dev['serial'], {})
+        if not responses:
+            log(f"Skipped {dev['name']}: no data", error=True)
+            continue
+        built += 1
+
+        with ctx.metrics.phase("link_inference", dev['name']):
+            graph = build_topology(dev['serial'], dev['name'], responses.get(EP_SWITCHES, []),
+                                   responses.get(EP_APS, []), dev.get('ha_members'))
+        # A failed endpoint would show up in the history as removed devices
+        if len(responses) == len(FLEET_ENDPOINTS):
+            record_history(graph, dev['serial'], dev['name'], "FMG", ctx.history_db)
+        else:
+            log(f"{dev['name']}: incomplete, not stored in the history")
+
+        filename = os.path.join(out_dir, f"topology_{dev['name']}.drawio")
+        if single_file:
+            # One artifact per gate anyway, the other formats can be made from it later
+            if options.get('write_artifact', WRITE_ARTIFACT):
+                save_artifact(artifact_file(filename), topology_artifact(graph, dev['serial'], dev['name'], "FMG"))
+            fleet_pages.append((dev['name'], graph))
+            continue
+        written.extend(export_outputs(filename, graph, dev['serial'], dev['name'], "FMG", metrics=ctx.metrics, **options))
+
+    if fleet_pages:
+        written.append(write_topology(os.path.join(out_dir, "topology_fleet.drawio"), fleet_pages,
+                                      metrics=ctx.metrics, **options))
+    log(f"Fleet done: {built} of {len(devices)} topologies written.")
+    return written
+
+def run_fleet_thread(ctx, on_finish_callback, devices, out_dir="", batch_size=FLEET_BATCH_SIZE):
+    if not devices:
+        log("No devices loaded.")
         on_finish_callback(False)
+        return
+
+    ctx.metrics.reset()
+    try:
+        written = export_fleet(ctx, devices, out_dir, batch_size)
+        success = len(written) > 0
+
+    except Exception as e:
+        log(f"Critical Error: {e}", error=True)
+        success = False
+    finish_metrics(metrics=ctx.metrics)
+    on_finish_callback(success)
+
+# --- FLEET (DIRECT) ---
+def load_inventory(path, default_token="", default_port=""):
+    """
+    Reads the gate inventory for the crawler.
+    CSV with header host,port,token[,name] or JSON list of objects with the same keys.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        if path.lower().endswith(".json"):
+            rows = json.load(f)
+        else:
+            rows = list(csv.DictReader(line for line in f if line.strip() and not line.startswith("#")))
+
+    inventory = []
+    for row in rows:
+        host = (row.get('host') or "").strip()
+        if not host:
+            continue
+        inventory.append({
+            'host': host,
+            'port': str(row.get('port') or default_port).strip(),
+            'token': (row.get('token') or default_token).strip(),
+            'name': (row.get('name') or "").strip()
+        })
+    return inventory
+
+def crawl_gate(entry, out_dir, settings=None, output=None):
+    """
+    Collects and writes one gate of the inventory with the target settings and
+    output_options() of the run. Returns its summary entry.
+    """
+    ctx = Target(entry['host'], entry['port'], entry['token'], mode="DIRECT", settings=settings)
+    summary = {'host': entry['host'], 'name': entry.get('name', ''), 'status': "error"}
+    start = time.monotonic()
+    try:
+        fg_serial, fg_hostname, graph = collect_topology(ctx)
+        summary['failed_endpoints'] = sorted({failure[0] for failure in ctx.failures})
+        # Without gate details nothing is written, so the last good diagram stays
+        if fg_serial == "FG-UNKNOWN":
+            raise ValueError("no gate details")
+        # A gate with other failed endpoints is written, but not counted as ok nor kept in the history
+        complete = not ctx.failures
+        if complete:
+            record_history(graph, fg_serial, fg_hostname, "DIRECT", ctx.history_db)
+        name = entry.get('name') or fg_hostname
+        filename = os.path.join(out_dir, f"topology_{clean_id(name)}_{clean_id(entry['host'])}.drawio")
+        files = export_outputs(filename, graph, fg_serial, fg_hostname, "DIRECT", metrics=ctx.metrics, **(output or {}))
+        summary.update({
+            'name': name,
+            'serial': fg_serial,
+            'status': "ok" if complete else "incomplete",
+            'file': files[0] if files else None,
+            'files': files,
+            'switches': graph.count('switch'),
+            'aps': graph.count('ap'),
+            'links': len(graph.edges)
+        })
+    except Exception as e:
+        log(f"Error {entry['host']}: {e}", error=True)
+        summary['error'] = str(e)
+    summary['seconds'] = round(time.monotonic() - start, 3)
+    with ctx.metrics.lock:
+        summary['requests'] = len(ctx.metrics.requests)
+        summary['retries'] = sum(ctx.metrics.retries.values())
+    return summary
+
+def crawl_gates(inventory, out_dir=".", max_workers=CRAWL_WORKERS, settings=None, output=None):
+    """
+    Collects many FortiGates in direct mode at the same time.
+    max_workers limits the gates in flight, settings['rate_limit'] the requests per second per host.
+    Writes one .drawio per gate plus crawl_summary.json and returns the summary.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    start = time.monotonic()
+    results = []
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = [executor.submit(crawl_gate, entry, out_dir, settings, output) for entry in inventory]
+        for future in futures:
+            result = future.result()
+            log(f"[{len(results) + 1}/{len(inventory)}] {result['host']}: {result['status']}")
+            results.append(result)
+
+    summary = {
+        'gates': len(results),
+        'ok': sum(1 for r in results if r['status'] == "ok"),
+        'incomplete': sum(1 for r in results if r['status'] == "incomplete"),
+        'failed': sum(1 for r in results if r['status'] == "error"),
+        'seconds': round(time.monotonic() - start, 3),
+        'results': results
+    }
+    with open(os.path.join(out_dir, "crawl_summary.json"), "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
+    log(f"Crawl done: {summary['ok']} of {summary['gates']} gates in {summary['seconds']}s"
+        f" ({summary['incomplete']} incomplete, {summary['failed']} failed)")
+    return summary
+
+# --- WATCH ---
+def normalized_records(records, key, sub_table):
+    """Records sorted by key, their sub-table rows sorted too, so the order of the answer does not matter."""
+    result = []
+    for record in records:
+        if isinstance(record, dict) and isinstance(record.get(sub_table), list):
+            record = dict(record)
+            record[sub_table] = sorted(record[sub_table], key=lambda row: json.dumps(row, sort_keys=True))
+        result.append(record)
+    return sorted(result, key=lambda record: str(record.get(key, "")) if isinstance(record, dict) else "")
+
+def topology_fingerprint(fg_serial, fg_hostname, switches_data, aps_data, ha_members=None):
+    """Hash of everything the link inference uses. Equal hash, equal diagram."""
+    content = json.dumps([fg_serial, fg_hostname,
+                          normalized_records(switches_data, 'switch-id', 'ports'),
+                          normalized_records(aps_data, 'serial', 'lldp'),
+                          sorted((m['serial'], m.get('name', '')) for m in ha_members or [])],
+                         sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+class WatchState:
+    """One watched gate: connection, output options, last fingerprint and last topology."""
+    def __init__(self, entry, out_dir, settings=None, output=None):
+        self.entry = entry
+        self.out_dir = out_dir
+        self.output = output or {}  # output_options() of the run
+        self.ctx = Target(entry['host'], entry['port'], entry['token'], mode="DIRECT", settings=settings)
+        self.serial = None
+        self.hostname = None
+        self.vdoms = []
+        self.default_vdom = "root"
+        self.ha_members = []
+        self.polls = 0
+        self.fingerprint = None
+        self.nodes = None           # topology_rows() of the last diagram
+        self.links = None
+
+def make_event_writer(stream):
+    """Returns emit(event) that writes thread safe JSON lines with time to stream."""
+    lock = threading.Lock()
+
+    def emit(event):
+        event = dict({'time': time.strftime("%Y-%m-%dT%H:%M:%S%z")}, **event)
+        with lock:
+            stream.write(json.dumps(event) + "\n")
+            stream.flush()
+    return emit
+
+DIFF_EVENTS = {'devices_added': "device_added", 'devices_removed': "device_removed", 'devices_changed': "device_changed",
+               'links_added': "link_added", 'links_removed': "link_removed"}
+
+def poll_gate(state, emit):
+    """
+    One poll of a watched gate. Inference, rendering and history are skipped
+    if the fingerprint did not change. Returns True if the diagram was rewritten.
+    A poll with failed endpoints is dropped with one error event, since the
+    missing data would read as removed devices.
+    """
+    ctx = state.ctx
+    state.polls += 1
+    # Metrics of the target cover one poll, so the failures are those of this poll
+    ctx.metrics.reset()
+
+    # Hostname, serial, VDOMs and HA members only now and then, switches and APs every time
+    refresh_details = state.serial is None or state.polls % WATCH_DETAILS_EVERY == 0
+    endpoints = [EP_SWITCHES, EP_APS]
+    if refresh_details:
+        endpoints = [EP_LICENSE, EP_SYSTEM, EP_VDOMS, EP_HA_PEERS] + endpoints
+    collected = collect_endpoints(ctx, endpoints)
+    if refresh_details:
+        fg_serial, fg_hostname = get_gate_details(ctx, collected.get(EP_LICENSE), collected.get(EP_SYSTEM))
+        if fg_serial == "FG-UNKNOWN":
+            state.serial = None
+            emit({'event': "error", 'host': ctx.ip, 'message': "Gate did not answer"})
+            return False
+        state.serial, state.hostname = fg_serial, fg_hostname
+        state.vdoms, state.default_vdom, state.ha_members = discover_gate(ctx, collected)
+
+    switches_data, aps_data = collect_vdoms(ctx, collected, state.vdoms, state.default_vdom)
+    if ctx.failures:
+        endpoints = sorted({failure[0] for failure in ctx.failures})
+        emit({'event': "error", 'host': ctx.ip, 'gate': state.hostname, 'gate_serial': state.serial,
+              'message': f"Poll skipped, endpoints failed: {', '.join(endpoints)}"})
+        if refresh_details:
+            # VDOMs or HA members of a broken poll are not trusted either, fetch them again next time
+            state.serial = None
+        return False
+    fingerprint = topology_fingerprint(state.serial, state.hostname, switches_data, aps_data, state.ha_members)
+    if fingerprint == state.fingerprint:
+        return False
+
+    with ctx.metrics.phase("link_inference", state.hostname):
+        graph = build_topology(state.serial, state.hostname, switches_data, aps_data, state.ha_members)
+    nodes, links = topology_rows(graph)
+
+    gate = {'host': ctx.ip, 'gate': state.hostname, 'gate_serial': state.serial}
+    if state.nodes is None:
+        emit(dict(gate, event="initial", devices=len(nodes), links=len(links)))
+    else:
+        for key, changes in diff_rows(state.nodes, nodes, state.links, links).items():
+            for change in changes:
+                emit(dict(gate, event=DIFF_EVENTS[key], **change))
+    state.fingerprint = fingerprint
+    state.nodes, state.links = nodes, links
+
+    name = state.entry.get('name') or state.hostname
+    filename = os.path.join(state.out_dir, f"topology_{clean_id(name)}_{clean_id(ctx.ip)}.drawio")
+    files = export_outputs(filename, graph, state.serial, state.hostname, "WATCH", metrics=state.ctx.metrics,
+                           **state.output)
+    record_history(graph, state.serial, state.hostname, "WATCH", ctx.history_db)
+    emit(dict(gate, event="written", file=files[0] if files else None, files=files))
+    return True
+
+async def watch_gate(state, emit, semaphore, executor, interval, jitter, cycles=0):
+    """Polls one gate every interval (+- jitter) seconds, at most `cycles` times (0 = forever)."""
+    loop = asyncio.get_running_loop()
+    await asyncio.sleep(random.uniform(0, interval * jitter))
+    polls = 0
+    while True:
+        started = loop.time()
+        async with semaphore:
+            try:
+                await loop.run_in_executor(executor, poll_gate, state, emit)
+            except Exception as e:
+                emit({'event': "error", 'host': state.ctx.ip, 'message': str(e)})
+        polls += 1
+        if cycles and polls >= cycles:
+            return
+        delay = interval * (1 + random.uniform(-jitter, jitter)) - (loop.time() - started)
+        await asyncio.sleep(max(0, delay))
+
+async def watch_metrics(interval, json_path=None, prom_path=None):
+    """
+    Writes and resets the run totals once per interval, so a daemon does not pile them up.
+    Latencies and circuit states stay on the targets of the gates.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        write_metrics(json_path, prom_path)
+        METRICS.reset()
+
+async def watch_gates(inventory, emit, out_dir=".", interval=WATCH_INTERVAL, jitter=WATCH_JITTER,
+                      concurrency=WATCH_CONCURRENCY, cycles=0, settings=None, output=None, metrics_files=(None, None)):
+    """
+    Watches all gates of the inventory on one event loop, at most `concurrency` polls at a time.
+    settings and output are the target settings and output_options() of the run,
+    metrics_files the (JSON, Prometheus) files written once per interval.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    jitter = min(max(jitter, 0.0), 0.9)
+    concurrency = max(1, concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    states = [WatchState(entry, out_dir, settings, output) for entry in inventory]
+    log(f"Watching {len(states)} gates every {interval}s")
+
+    metrics_task = asyncio.create_task(watch_metrics(interval, *metrics_files))
+    try:
+        await asyncio.gather(*(watch_gate(state, emit, semaphore, executor, interval, jitter, cycles)
+                               for state in states))
+    finally:
+        metrics_task.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
 
 # --- GUI ---
 class FortiMapperApp:
     def __init__(self, root):
         self.root = root
+        self.mode = "DIRECT"        # 'DIRECT' or 'FMG', follows the selected tab
+        self.device_map = {}        # Display string of the device list -> device data
+        self.device_index = DeviceIndex({})
+        self.search_job = None      # Pending type-ahead refresh
         self.root.title("FortiTopology")
-        self.root.geometry("600x650")
+        self.root.geometry("600x760")
 
         # TAB SYSTEM
         self.notebook = ttk.Notebook(root)
@@ -492,9 +3399,27 @@ class FortiMapperApp:
         self.btn_load = ttk.Button(frame_f, text="Load Devices", command=self.load_devices)
         self.btn_load.grid(row=2, column=1, sticky="e", pady=10)
 
-        ttk.Label(frame_f, text="Selected firewall:").grid(row=3, column=0, sticky="w")
-        self.combo_devices = ttk.Combobox(frame_f, width=32, state="readonly")
-        self.combo_devices.grid(row=3, column=1, padx=5, pady=5)
+        # Device picker: type-ahead by name, serial or ADOM
+        ttk.Label(frame_f, text="Search firewall:").grid(row=3, column=0, sticky="w")
+        self.var_search = tk.StringVar()
+        self.var_search.trace_add("write", self.on_search)
+        self.entry_search = ttk.Entry(frame_f, width=35, textvariable=self.var_search)
+        self.entry_search.grid(row=3, column=1, padx=5, pady=5)
+
+        ttk.Label(frame_f, text="Selected firewall:").grid(row=4, column=0, sticky="nw")
+        frame_list = ttk.Frame(frame_f)
+        frame_list.grid(row=4, column=1, padx=5, pady=5)
+        self.list_devices = tk.Listbox(frame_list, width=35, height=6, exportselection=False)
+        scroll_devices = ttk.Scrollbar(frame_list, orient="vertical", command=self.list_devices.yview)
+        self.list_devices.config(yscrollcommand=scroll_devices.set)
+        self.list_devices.pack(side="left")
+        scroll_devices.pack(side="left", fill="y")
+
+        self.lbl_devices = ttk.Label(frame_f, text="")
+        self.lbl_devices.grid(row=5, column=0, sticky="w")
+
+        self.btn_fleet = ttk.Button(frame_f, text="Map all devices", command=self.start_fleet_process)
+        self.btn_fleet.grid(row=5, column=1, sticky="e", pady=10)
 
         # --- MAIN BUTTON ---
         self.btn_start = ttk.Button(root, text="Create topology", command=self.start_process)
@@ -512,49 +3437,146 @@ class FortiMapperApp:
         self.btn_browse = ttk.Button(frame_save, text="...", width=5, command=self.choose_save_path)
         self.btn_browse.pack(side="left")
 
+        self.var_incremental = tk.BooleanVar(value=DRAWIO_INCREMENTAL)
+        ttk.Checkbutton(root, text="Keep layout of existing file", variable=self.var_incremental).pack(padx=10, anchor="w")
+
         # Log
         self.log_area = scrolledtext.ScrolledText(root, width=70, height=20, state='disabled', font=("Consolas", 9))
         self.log_area.pack(padx=10, pady=5)
 
+        # Worker threads never touch widgets, log lines and callbacks go through queues
+        self.log_queue = queue.Queue(maxsize=GUI_LOG_QUEUE_SIZE)
+        self.call_queue = queue.Queue()
+        self.log_lock = threading.Lock()
+        self.log_dropped = 0
+        self.root.after(GUI_LOG_INTERVAL_MS, self.pump_log)
+
+    def queue_log(self, text):
+        """Thread safe log callback, the lines are written by pump_log() in the main loop."""
+        try:
+            self.log_queue.put_nowait(text)
+        except queue.Full:
+            with self.log_lock:
+                self.log_dropped += 1
+
+    def call_in_main(self, func, *args):
+        """Thread safe: runs func(*args) in the Tk main loop."""
+        self.call_queue.put((func, args))
+
+    def pump_log(self):
+        """
+        Writes queued log lines in one batch and runs queued calls, then reschedules itself.
+        A failing call is only logged, so log and finish callbacks keep working.
+        """
+        try:
+            lines = []
+            try:
+                while len(lines) < GUI_LOG_BATCH:
+                    lines.append(self.log_queue.get_nowait())
+            except queue.Empty:
+                pass
+            with self.log_lock:
+                dropped, self.log_dropped = self.log_dropped, 0
+            if dropped:
+                lines.append(f"[{dropped} log lines skipped]")
+            if lines:
+                self.append_log("\n".join(coalesce_lines(lines)))
+
+            while True:
+                try:
+                    func, args = self.call_queue.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    func(*args)
+                except Exception as e:
+                    log(f"GUI error in {getattr(func, '__name__', func)}: {e}")
+        finally:
+            self.root.after(GUI_LOG_INTERVAL_MS, self.pump_log)
+
     def append_log(self, text):
+        """Main thread only. Keeps the last GUI_LOG_MAX_LINES lines."""
         self.log_area.config(state='normal')
         self.log_area.insert(tk.END, text + "\n")
+        excess = int(self.log_area.index('end-1c').split('.')[0]) - 1 - GUI_LOG_MAX_LINES
+        if excess > 0:
+            self.log_area.delete("1.0", f"{excess + 1}.0")
         self.log_area.see(tk.END)
         self.log_area.config(state='disabled')
 
     def on_tab_change(self, event):
         # Change mode according to Tab
         tab_id = self.notebook.index(self.notebook.select())
-        global CONNECTION_MODE
         if tab_id == 0:
-            CONNECTION_MODE = "DIRECT"
+            self.mode = "DIRECT"
         else:
-            CONNECTION_MODE = "FMG"
+            self.mode = "FMG"
+
+    def fmg_target(self):
+        return Target(self.entry_ip_f.get().strip(), self.entry_port_f.get().strip(),
+                      self.entry_token_f.get().strip(), mode="FMG")
 
     def load_devices(self):
         # Get data from Inputs
-        global CURRENT_IP, CURRENT_PORT, CURRENT_TOKEN, gui_log_callback
-        CURRENT_IP = self.entry_ip_f.get().strip()
-        CURRENT_PORT = self.entry_port_f.get().strip()
-        CURRENT_TOKEN = self.entry_token_f.get().strip()
-        gui_log_callback = self.append_log
+        global gui_log_callback
+        ctx = self.fmg_target()
+        gui_log_callback = self.queue_log
 
-        if not CURRENT_IP or not CURRENT_TOKEN:
+        if not ctx.ip or not ctx.token:
             messagebox.showwarning("Error: Please enter IP and API Token.")
             return
 
+        # Last known list first, the refresh replaces it when done
+        cached = load_fmg_device_cache(ctx)
+        if cached and cached[1]:
+            self.append_log(f"{len(cached[1])} devices from cache ({int(cached[0] // 60)} min old), refreshing...")
+            self.show_devices(cached[1])
+
         # Start Thread
         self.btn_load.config(state="disabled", text="Lade...")
-        threading.Thread(target=self._thread_load).start()
+        threading.Thread(target=self._thread_load, args=(ctx,)).start()
 
-    def _thread_load(self):
+    def _thread_load(self, ctx):
+        device_map = None
         try:
-            dev_list = fetch_fmg_devices()
-            self.combo_devices['values'] = dev_list
-            if dev_list:
-                self.combo_devices.current(0)
+            device_map = fetch_fmg_devices(ctx)
         finally:
-            self.btn_load.config(state="normal", text="Load devices")
+            self.call_in_main(self.on_devices_loaded, device_map)
+
+    def on_devices_loaded(self, device_map):
+        # Keep the cached list if the refresh failed
+        if device_map or not self.device_map:
+            self.show_devices(device_map or {})
+        self.btn_load.config(state="normal", text="Load devices")
+
+    def show_devices(self, device_map):
+        self.device_map = device_map
+        self.device_index = DeviceIndex(device_map)
+        self.refresh_device_list()
+
+    def on_search(self, *args):
+        if self.search_job:
+            self.root.after_cancel(self.search_job)
+        self.search_job = self.root.after(PICKER_DELAY_MS, self.refresh_device_list)
+
+    def refresh_device_list(self):
+        self.search_job = None
+        selected = self.selected_device()
+        matches = self.device_index.search(self.var_search.get())
+
+        self.list_devices.delete(0, tk.END)
+        if matches:
+            self.list_devices.insert(tk.END, *matches)
+            index = matches.index(selected) if selected in matches else 0
+            self.list_devices.selection_set(index)
+            self.list_devices.see(index)
+
+        more = "+" if len(matches) >= PICKER_MAX_RESULTS else ""
+        self.lbl_devices.config(text=f"{len(matches)}{more} of {len(self.device_index)}")
+
+    def selected_device(self):
+        selection = self.list_devices.curselection()
+        return self.list_devices.get(selection[0]) if selection else ""
 
     def choose_save_path(self):
         filename = filedialog.asksaveasfilename(
@@ -567,34 +3589,30 @@ class FortiMapperApp:
             self.entry_path.insert(0, filename)
 
     def start_process(self):
-        global CURRENT_IP, CURRENT_PORT, CURRENT_TOKEN, SELECTED_DEVICE_DATA, gui_log_callback
-        gui_log_callback = self.append_log
+        global gui_log_callback
+        gui_log_callback = self.queue_log
         
         # Read inputs depending on mode
-        if CONNECTION_MODE == "DIRECT":
-            CURRENT_IP = self.entry_ip_d.get().strip()
-            CURRENT_PORT = self.entry_port_d.get().strip()
-            CURRENT_TOKEN = self.entry_token_d.get().strip()
-            SELECTED_DEVICE_DATA = {'serial': 'DIRECT', 'name': 'DIRECT'}
+        if self.mode == "DIRECT":
+            ctx = Target(self.entry_ip_d.get().strip(), self.entry_port_d.get().strip(),
+                         self.entry_token_d.get().strip(), mode="DIRECT")
         else:
-            CURRENT_IP = self.entry_ip_f.get().strip()
-            CURRENT_PORT = self.entry_port_f.get().strip()
-            CURRENT_TOKEN = self.entry_token_f.get().strip()
+            ctx = self.fmg_target()
             
-            selection = self.combo_devices.get()
+            selection = self.selected_device()
             if not selection:
                 messagebox.showwarning("Error: Please select a firewall")
                 return
             
             # Get data from map
-            if selection in GUI_DEVICE_MAP:
-                SELECTED_DEVICE_DATA = GUI_DEVICE_MAP[selection]
-                self.append_log(f"Ziel: {SELECTED_DEVICE_DATA['name']} (ADOM: {SELECTED_DEVICE_DATA['adom']})")
+            if selection in self.device_map:
+                ctx.device = self.device_map[selection]
+                self.append_log(f"Ziel: {ctx.device['name']} (ADOM: {ctx.device['adom']})")
             else:
                 self.append_log("Error: Mapping not found")
                 return
 
-        if not CURRENT_IP or not CURRENT_TOKEN:
+        if not ctx.ip or not ctx.token:
             messagebox.showwarning("Error: Please enter a IP and API Token")
             return
         
@@ -606,14 +3624,426 @@ class FortiMapperApp:
         self.log_area.delete(1.0, tk.END)
         self.log_area.config(state='disabled')
         
-        threading.Thread(target=run_process_thread, args=(self.on_process_finish, user_path)).start()
+        on_finish = lambda success: self.call_in_main(self.on_process_finish, success)
+        threading.Thread(target=run_process_thread, args=(ctx, on_finish, user_path, self.var_incremental.get())).start()
+
+    def start_fleet_process(self):
+        global gui_log_callback
+        gui_log_callback = self.queue_log
+
+        ctx = self.fmg_target()
+
+        if not ctx.ip or not ctx.token:
+            messagebox.showwarning("Error: Please enter a IP and API Token")
+            return
+        if not self.device_map:
+            messagebox.showwarning("Error: Please load devices first")
+            return
+
+        out_dir = filedialog.askdirectory(title="Choose output folder")
+        if not out_dir:
+            return
+
+        self.btn_fleet.config(state="disabled")
+        self.btn_start.config(state="disabled", text="Verarbeite...")
+        devices = list(self.device_map.values())
+        on_finish = lambda success: self.call_in_main(self.on_fleet_finish, success)
+        threading.Thread(target=run_fleet_thread, args=(ctx, on_finish, devices, out_dir)).start()
+
+    def on_fleet_finish(self, success):
+        self.btn_fleet.config(state="normal")
+        self.on_process_finish(success)
 
     def on_process_finish(self, success):
         self.btn_start.config(state="normal", text="Topologie erstellen")
         if success:
             messagebox.showinfo("Success")
 
-if __name__ == "__main__":
+def coalesce_lines(lines):
+    """Joins runs of identical log lines into one line with a repeat count."""
+    result = []
+    previous, count = None, 0
+    for line in lines + [None]:
+        if line == previous:
+            count += 1
+            continue
+        if previous is not None:
+            result.append(previous if count == 1 else f"{previous} (x{count})")
+        previous, count = line, 1
+    return result
+
+def run_gui():
+    global tk, ttk, scrolledtext, messagebox, filedialog
+    import tkinter as tk
+    from tkinter import ttk, scrolledtext, messagebox, filedialog
+
     root = tk.Tk()
     app = FortiMapperApp(root)
     root.mainloop()
+
+# --- CLI ---
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        prog="fortitopology",
+        description="Creates .drawio topologies of FortiGates, FortiSwitches and FortiAPs. Starts the GUI without arguments."
+    )
+    sub = parser.add_subparsers(dest="command")
+
+    sub.add_parser("gui", help="Start the GUI")
+
+    def add_connection(p):
+        p.add_argument("--host", required=True, help="IP/DNS of the FortiGate or FortiManager")
+        p.add_argument("--port", default="", help="HTTPS port")
+        p.add_argument("--token", default=os.environ.get("FORTITOPOLOGY_TOKEN", ""),
+                       help="API token (default: $FORTITOPOLOGY_TOKEN)")
+        p.add_argument("-q", "--quiet", action="store_true", help="Only print errors and results")
+        add_cache(p)
+        add_output(p)
+        add_collection(p)
+        add_metrics(p)
+        add_history(p)
+
+    def add_history(p):
+        p.add_argument("--history", default=HISTORY_DB, metavar="FILE",
+                       help="SQLite file that keeps a snapshot of every collection")
+        p.add_argument("--no-history", action="store_true", help="Do not store the collection")
+
+    def add_metrics(p):
+        p.add_argument("--metrics-json", default="", metavar="FILE", help="Write phase and request metrics as JSON")
+        p.add_argument("--metrics-prom", default="", metavar="FILE",
+                       help="Write the metrics as Prometheus textfile (node exporter textfile collector)")
+
+    def add_collection(p):
+        p.add_argument("--page-size", type=int, default=PAGE_SIZE,
+                       help="Switches/APs per paged request (0 = no paging)")
+        p.add_argument("--retries", type=int, default=RETRY_ATTEMPTS - 1,
+                       help="Retries of failed reads, with exponential backoff")
+        p.add_argument("--timeout-max", type=float, default=TIMEOUT_MAX,
+                       help="Upper bound of the adaptive request timeout in seconds")
+        p.add_argument("--hedge", action="store_true",
+                       help="Send a duplicate of FMG proxy calls slower than their p95 latency")
+
+    def add_output(p):
+        p.add_argument("--incremental", action="store_true",
+                       help="Update existing .drawio files and keep their manual layout")
+        p.add_argument("--compressed", action="store_true",
+                       help="Write the diagram compressed (deflate + base64)")
+        p.add_argument("--aggregate", type=int, default=AGGREGATE_THRESHOLD, metavar="N",
+                       help="Collapse N or more leaf APs of one parent into a summary node (0 = off)")
+        p.add_argument("--aggregate-switches", action="store_true",
+                       help="Also collapse leaf switches")
+        p.add_argument("--partition", choices=PARTITION_MODES, default=PARTITION_MODE,
+                       help="One page per switch stack or per hostname prefix")
+        p.add_argument("--render-workers", type=int, default=RENDER_WORKERS,
+                       help="Processes building pages in parallel")
+        p.add_argument("--format", action="append", choices=sorted(EXPORTERS), default=[], dest="formats",
+                       help="Output format (repeatable, default: drawio)")
+        p.add_argument("--export-workers", type=int, default=EXPORT_WORKERS,
+                       help="Processes running the other formats while drawio renders")
+        p.add_argument("--no-artifact", action="store_true",
+                       help=f"Do not store the collected topology ({ARTIFACT_SUFFIX}) next to the diagram")
+
+    def add_cache(p):
+        p.add_argument("--cache", choices=RESPONSE_CACHE_MODES, default=RESPONSE_CACHE_MODE,
+                       help="Response cache: record, replay (no network) or refresh-if-stale")
+        p.add_argument("--cache-ttl", type=float, default=RESPONSE_CACHE_TTL,
+                       help="Seconds until a cached response is stale")
+
+    p_direct = sub.add_parser("direct", help="Map one FortiGate directly")
+    add_connection(p_direct)
+    p_direct.add_argument("-o", "--output", default="", help="Output .drawio file")
+
+    p_fmg = sub.add_parser("fmg", help="Map FortiGates through a FortiManager")
+    add_connection(p_fmg)
+    p_fmg.add_argument("--user", default="", help="FMG user (session login instead of token)")
+    p_fmg.add_argument("--password", default=os.environ.get("FORTITOPOLOGY_PASSWORD", ""),
+                       help="FMG password (default: $FORTITOPOLOGY_PASSWORD)")
+    p_fmg.add_argument("--device", action="append", default=[],
+                       help="Name or serial of a managed FortiGate (repeatable)")
+    p_fmg.add_argument("--all", action="store_true", help="Map all managed FortiGates (fleet mode)")
+    p_fmg.add_argument("--list", action="store_true", help="Only list the managed FortiGates")
+    p_fmg.add_argument("--batch-size", type=int, default=FLEET_BATCH_SIZE, help="Devices per proxy call")
+    p_fmg.add_argument("--single-file", action="store_true", help="Fleet: one .drawio with one page per FortiGate")
+    p_fmg.add_argument("-o", "--output", default="", help="Output file (one device) or folder")
+
+    p_crawl = sub.add_parser("crawl", help="Map many FortiGates directly from an inventory file")
+    p_crawl.add_argument("inventory", help="CSV (host,port,token[,name]) or JSON inventory")
+    p_crawl.add_argument("--token", default=os.environ.get("FORTITOPOLOGY_TOKEN", ""),
+                         help="Token for entries without one (default: $FORTITOPOLOGY_TOKEN)")
+    p_crawl.add_argument("--port", default="", help="Port for entries without one")
+    p_crawl.add_argument("--workers", type=int, default=CRAWL_WORKERS, help="Gates collected at the same time")
+    p_crawl.add_argument("--rate", type=float, default=HOST_RATE_LIMIT, help="Max. requests per second per host")
+    p_crawl.add_argument("-o", "--output", default=".", help="Output folder")
+    p_crawl.add_argument("-q", "--quiet", action="store_true", help="Only print errors and results")
+    add_cache(p_crawl)
+    add_output(p_crawl)
+    add_collection(p_crawl)
+    add_metrics(p_crawl)
+    add_history(p_crawl)
+
+    p_watch = sub.add_parser("watch", help="Keep the diagrams of one or many FortiGates up to date")
+    p_watch.add_argument("inventory", nargs="?", help="CSV/JSON inventory like 'crawl' (or --host)")
+    p_watch.add_argument("--host", default="", help="IP/DNS of a single FortiGate")
+    p_watch.add_argument("--token", default=os.environ.get("FORTITOPOLOGY_TOKEN", ""),
+                         help="API token (default: $FORTITOPOLOGY_TOKEN)")
+    p_watch.add_argument("--port", default="", help="HTTPS port")
+    p_watch.add_argument("--interval", type=float, default=WATCH_INTERVAL, help="Seconds between polls of one gate")
+    p_watch.add_argument("--jitter", type=float, default=WATCH_JITTER, help="Random share of the interval (0..0.9)")
+    p_watch.add_argument("--concurrency", type=int, default=WATCH_CONCURRENCY, help="Gates polled at the same time")
+    p_watch.add_argument("--rate", type=float, default=HOST_RATE_LIMIT, help="Max. requests per second per host")
+    p_watch.add_argument("--cycles", type=int, default=0, help="Polls per gate before exiting (0 = forever)")
+    p_watch.add_argument("--events", default="", help="Append the change events (JSON lines) here instead of stdout")
+    p_watch.add_argument("-o", "--output", default=".", help="Output folder")
+    p_watch.add_argument("-q", "--quiet", action="store_true", help="Only print events")
+    add_cache(p_watch)
+    add_output(p_watch)
+    add_collection(p_watch)
+    add_metrics(p_watch)
+    add_history(p_watch)
+
+    def add_history_query(p):
+        p.add_argument("--db", default=HISTORY_DB, help="History file")
+        p.add_argument("--json", action="store_true", help="Print JSON instead of text")
+
+    p_hist = sub.add_parser("history", help="Query and render stored snapshots")
+    hist = p_hist.add_subparsers(dest="history_command", required=True)
+    p_list = hist.add_parser("list", help="List snapshots, newest first")
+    p_list.add_argument("gate", nargs="?", help="Serial or name of a FortiGate")
+    p_list.add_argument("--limit", type=int, default=50)
+    p_diff = hist.add_parser("diff", help="What changed on a FortiGate since a point in time")
+    p_diff.add_argument("gate", help="Serial or name of the FortiGate")
+    p_diff.add_argument("--since", default="7d", help="7d, 12h, 30m or a date (default: 7d)")
+    p_where = hist.add_parser("where", help="Where a device (e.g. AP serial) was connected over time")
+    p_where.add_argument("serial")
+    p_render = hist.add_parser("render", help="Write the .drawio of a stored snapshot")
+    p_render.add_argument("snapshot", type=int, help="Snapshot id (see 'history list')")
+    p_render.add_argument("-o", "--output", default="", help="Output .drawio file")
+    add_output(p_render)
+    for p in (p_list, p_diff, p_where, p_render):
+        add_history_query(p)
+
+    p_export = sub.add_parser("export", help=f"Write other formats of a stored topology ({ARTIFACT_SUFFIX})")
+    p_export.add_argument("artifact", nargs="+", help="Artifact file(s) of earlier runs")
+    p_export.add_argument("-o", "--output", default="",
+                          help="Output .drawio file, the other formats swap its suffix (one artifact only)")
+    add_output(p_export)
+
+    return parser
+
+def format_time(epoch):
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(epoch))
+
+def cli_history(args):
+    if args.history_command == "list":
+        result = list_snapshots(args.gate, args.limit, path=args.db)
+        lines = [f"{s['id']:>6}  {format_time(s['first_seen'])} .. {format_time(s['last_seen'])}  "
+                 f"{s['gate_name']} ({s['gate_serial']})  {s['nodes']} devices, {s['links']} links, {s['polls']} polls"
+                 for s in result]
+
+    elif args.history_command == "diff":
+        result = changes_since(args.gate, parse_since(args.since), path=args.db)
+        if result is None:
+            log(f"Error: No history for {args.gate}")
+            return 2
+        lines = [f"Snapshot {result['from']} -> {result['to']}"]
+        lines += [f"+ {d['type']} {d['name']} ({d['serial']})" for d in result['devices_added']]
+        lines += [f"- {d['type']} {d['name']} ({d['serial']})" for d in result['devices_removed']]
+        lines += [f"~ {c['new']['type']} {c['old']['name']} -> {c['new']['name']} ({c['new']['serial']})"
+                  for c in result['devices_changed']]
+        lines += [f"+ link {l['src']}:{l['src_port']} <-> {l['dst']}:{l['dst_port']}" for l in result['links_added']]
+        lines += [f"- link {l['src']}:{l['src_port']} <-> {l['dst']}:{l['dst_port']}" for l in result['links_removed']]
+
+    elif args.history_command == "where":
+        result = device_history(args.serial, path=args.db)
+        lines = []
+        for period in result:
+            peers = ", ".join(f"{p['peer']}:{p['peer_port']} (local {p['port']})" for p in period['peers']) or "not connected"
+            lines.append(f"{format_time(period['from'])} .. {format_time(period['to'])}  {period['gate_name']}: {peers}")
+
+    else:
+        loaded = load_snapshot(args.snapshot, path=args.db)
+        if loaded is None:
+            log(f"Error: Unknown snapshot {args.snapshot}")
+            return 2
+        meta, graph = loaded
+        filename = args.output or f"topology_{meta['gate_name']}_{time.strftime('%Y%m%d_%H%M', time.localtime(meta['first_seen']))}.drawio"
+        info = {'gate': {'serial': meta['gate_serial'], 'name': meta['gate_name']},
+                'created': meta['first_seen'], 'source': meta['source']}
+        options = output_options(args)
+        options.pop('write_artifact')
+        for written in run_exporters(filename, graph, info, **options):
+            print(written)
+        return 0
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        for line in lines:
+            print(line)
+    return 0
+
+def cli_crawl(args):
+    inventory = load_inventory(args.inventory, args.token, args.port)
+    if not inventory:
+        log("Error: Inventory is empty.", error=True)
+        return 2
+    summary = crawl_gates(inventory, args.output, args.workers, target_settings(args), output_options(args))
+    for result in summary['results']:
+        for filename in result.get('files', []):
+            print(filename)
+    return 0 if summary['ok'] == summary['gates'] else 1
+
+def cli_watch(args):
+    if args.inventory:
+        inventory = load_inventory(args.inventory, args.token, args.port)
+    elif args.host:
+        inventory = [{'host': args.host, 'port': args.port, 'token': args.token, 'name': ""}]
+    else:
+        log("Error: Please give an inventory file or --host.", error=True)
+        return 2
+    if not inventory:
+        log("Error: Inventory is empty.", error=True)
+        return 2
+
+    events = open(args.events, "a", encoding="utf-8") if args.events else sys.stdout
+    try:
+        asyncio.run(watch_gates(inventory, make_event_writer(events), args.output, args.interval,
+                                args.jitter, args.concurrency, args.cycles, target_settings(args),
+                                output_options(args), (args.metrics_json, args.metrics_prom)))
+    except KeyboardInterrupt:
+        log("Watch stopped")
+    finally:
+        if events is not sys.stdout:
+            events.close()
+    return 0
+
+def cli_direct(args):
+    ctx = Target(args.host, args.port, args.token, mode="DIRECT", settings=target_settings(args))
+    for filename in export_topology(ctx, args.output, **output_options(args)):
+        print(filename)
+    return 1 if ctx.failures else 0
+
+def cli_fmg(args):
+    ctx = Target(args.host, args.port, args.token, mode="FMG", user=args.user, password=args.password,
+                 settings=target_settings(args))
+    output = output_options(args)
+    try:
+        device_map = fetch_fmg_devices(ctx)
+        devices = list(device_map.values())
+
+        if args.list:
+            for display_str in device_map:
+                print(display_str)
+            return 0
+
+        if not args.all:
+            wanted = set(args.device)
+            devices = [d for d in devices if d['name'] in wanted or d['serial'] in wanted]
+            if not devices:
+                log("Error: No matching device. Use --device NAME or --all.", error=True)
+                return 2
+
+        if len(devices) == 1 and not args.all:
+            out = args.output
+            if out and os.path.isdir(out):
+                out = os.path.join(out, f"topology_{devices[0]['name']}.drawio")
+            for filename in export_topology(ctx.for_device(devices[0]), out, **output):
+                print(filename)
+        else:
+            out_dir = args.output or "."
+            os.makedirs(out_dir, exist_ok=True)
+            for filename in export_fleet(ctx, devices, out_dir, args.batch_size, args.single_file, **output):
+                print(filename)
+        return 1 if ctx.failures else 0
+    finally:
+        fmg_logout(ctx)
+
+def cli_export(args):
+    if args.output and len(args.artifact) > 1:
+        log("Error: -o only works with a single artifact.")
+        return 2
+    for source in args.artifact:
+        for filename in export_artifact(source, args.output, **output_options(args)):
+            print(filename)
+    return 0
+
+def output_options(args):
+    """Renderer and exporter options of a run, passed down to export_outputs() and write_topology()."""
+    return {
+        'formats': tuple(dict.fromkeys(args.formats)) or ("drawio",),
+        'export_workers': max(1, args.export_workers),
+        'write_artifact': not args.no_artifact,
+        'incremental': args.incremental,
+        'compressed': args.compressed,
+        'aggregate': args.aggregate,
+        'aggregate_switches': args.aggregate_switches,
+        'partition': args.partition,
+        'render_workers': max(1, args.render_workers),
+    }
+
+def target_settings(args):
+    """Collection settings of a run for every Target it creates, see TARGET_SETTINGS."""
+    return {
+        'rate_limit': getattr(args, "rate", HOST_RATE_LIMIT),
+        'cache_mode': args.cache,
+        'cache_ttl': args.cache_ttl,
+        'page_size': max(0, args.page_size),
+        'retry_attempts': max(0, args.retries) + 1,
+        'timeout_max': max(TIMEOUT_MIN, args.timeout_max),
+        'hedge_proxy': args.hedge,
+        'history_db': "" if args.no_history else args.history,
+    }
+
+def main(argv=None):
+    global LOG_STREAM, ERROR_STREAM
+    args = build_arg_parser().parse_args(argv)
+
+    if args.command in (None, "gui"):
+        run_gui()
+        return 0
+
+    if args.command == "history":
+        LOG_STREAM = sys.stderr
+        try:
+            return cli_history(args)
+        except Exception as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return 1
+
+    if args.command == "export":
+        LOG_STREAM = sys.stderr
+        try:
+            return cli_export(args)
+        except Exception as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return 1
+
+    # Progress and errors go to stderr, stdout only lists the written files. -q keeps the errors.
+    LOG_STREAM = None if args.quiet else sys.stderr
+    ERROR_STREAM = sys.stderr
+
+    needs_token = args.command in ("direct", "fmg") or (args.command == "watch" and args.host)
+    if needs_token and args.cache != "replay" and not args.token and not getattr(args, "user", ""):
+        print("Error: Please enter an API Token (--token or $FORTITOPOLOGY_TOKEN)", file=sys.stderr)
+        return 2
+
+    METRICS.reset()
+    try:
+        if args.command == "direct":
+            return cli_direct(args)
+        if args.command == "crawl":
+            return cli_crawl(args)
+        if args.command == "watch":
+            return cli_watch(args)
+        return cli_fmg(args)
+    except Exception as e:
+        print(f"Critical Error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        close_http_sessions()
+        if not (args.command == "fmg" and args.list):
+            finish_metrics(args.metrics_json, args.metrics_prom)
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
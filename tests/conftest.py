@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import fortitopology as ft
+
+
+def pytest_configure(config):
+    # The mock server has a self-signed certificate, like most gates
+    config.addinivalue_line("filterwarnings", "ignore::urllib3.exceptions.InsecureRequestWarning")
+
+
+@pytest.fixture(autouse=True)
+def quiet_run(tmp_path, monkeypatch):
+    """No console output, no files in the home folder, fresh run totals."""
+    monkeypatch.setattr(ft, "LOG_STREAM", None)
+    monkeypatch.setattr(ft, "ERROR_STREAM", None)
+    monkeypatch.setattr(ft, "HISTORY_DB", "")
+    monkeypatch.setattr(ft, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(ft, "RESPONSE_CACHE_DIR", str(tmp_path / "cache" / "responses"))
+    monkeypatch.setattr(ft, "FMG_TARGET_CACHE_FILE", str(tmp_path / "cache" / "fmg_targets.json"))
+    monkeypatch.setattr(ft, "FMG_TARGET_CACHE", {})
+    monkeypatch.setattr(ft, "DEVICE_CACHE_DIR", str(tmp_path / "cache" / "devices"))
+    monkeypatch.setattr(ft, "RETRY_BACKOFF", 0)
+    ft.METRICS.reset()
+
+
+@pytest.fixture(scope="session")
+def mock_cert():
+    """Self-signed certificate of the mock server, made once per test run."""
+    from mock_server import self_signed_cert
+    certfile, keyfile = self_signed_cert()
+    if not certfile:
+        pytest.skip("openssl is needed for the HTTPS mock server")
+    return certfile, keyfile
+
+
+@pytest.fixture
+def mock_gate(mock_cert):
+    """Mock FortiGate/FortiManager on a free port, yields its MockState and a DIRECT Target."""
+    from mock_server import MockState, start_server
+    state = MockState(devices=40, gates=3)
+    server = start_server(state, certfile=mock_cert[0], keyfile=mock_cert[1])
+    ctx = ft.Target("127.0.0.1", server.server_port, state.token)
+    yield state, ctx
+    server.shutdown()
+    server.server_close()
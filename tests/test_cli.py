@@ -0,0 +1,69 @@
+import pytest
+
+import fortitopology as ft
+
+
+def test_missing_token_is_reported_on_stderr(capsys, monkeypatch):
+    monkeypatch.delenv("FORTITOPOLOGY_TOKEN", raising=False)
+    assert ft.main(["direct", "--host", "127.0.0.1", "--token", ""]) == 2
+    out, err = capsys.readouterr()
+    assert out == ""
+    assert "API Token" in err
+
+
+
+def test_quiet_run_still_reports_errors(capsys, tmp_path):
+    argv = ["direct", "--host", "127.0.0.1", "--port", "1", "--token", "t", "--retries", "0", "--no-history",
+            "-q", "-o", str(tmp_path / "down.drawio")]
+    assert ft.main(argv) == 1
+    _, err = capsys.readouterr()
+    assert "Error /monitor/system/status" in err
+    assert "Load gate details" not in err
+
+def test_run_settings_stay_on_the_targets():
+    args = ft.build_arg_parser().parse_args(
+        ["direct", "--host", "gate", "--token", "t", "--page-size", "50", "--retries", "0", "--no-history",
+         "--cache", "record", "--compressed", "--format", "json"])
+    page_size, history = ft.PAGE_SIZE, ft.HISTORY_DB
+
+    ctx = ft.Target("gate", settings=ft.target_settings(args))
+    assert (ctx.page_size, ctx.retry_attempts, ctx.history_db, ctx.cache_mode) == (50, 1, "", "record")
+    assert (ft.PAGE_SIZE, ft.HISTORY_DB) == (page_size, history)
+
+    output = ft.output_options(args)
+    assert output['compressed'] and output['formats'] == ("json",)
+    assert not ft.DRAWIO_COMPRESSED
+
+
+def test_unknown_target_setting():
+    with pytest.raises(ValueError):
+        ft.Target("gate", settings={'page_sise': 10})
+
+
+def test_device_targets_share_settings_and_count_for_the_fmg():
+    fmg = ft.Target("fmg", mode="FMG", settings={'page_size': 25})
+    device = fmg.for_device({'name': "gate", 'serial': "FG1"})
+    assert device.page_size == 25
+
+    device.metrics.add_retry("/api")
+    assert device.metrics.retries == fmg.metrics.retries == ft.METRICS.retries == {"/api": 1}
+
+
+def test_targets_keep_their_own_metrics(mock_gate, tmp_path):
+    mock, ctx = mock_gate
+    entries = [{'host': ctx.ip, 'port': ctx.port, 'token': ctx.token, 'name': name} for name in ("a", "b")]
+    summary = ft.crawl_gates(entries, str(tmp_path))
+
+    per_gate = [result['requests'] for result in summary['results']]
+    assert all(per_gate)
+    assert sum(per_gate) == len(ft.METRICS.requests)
+
+
+def test_phases_are_recorded_on_the_target(mock_gate, tmp_path):
+    _, ctx = mock_gate
+    other = ft.Target("other")
+    ft.export_topology(ctx, str(tmp_path / "gate.drawio"))
+    phases = ctx.metrics.phase_summary()
+    assert {'switches', 'link_inference', 'artifact_write', 'xml_build', 'file_write'} <= set(phases)
+    assert other.metrics.phase_summary() == {}
+    assert ft.METRICS.phase_summary()['xml_build']['count'] == 1
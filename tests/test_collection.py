@@ -0,0 +1,143 @@
+import pytest
+
+import fortitopology as ft
+
+
+def paged_source(monkeypatch, records, ignore_paging=False):
+    """get_data answers list endpoints from records, honoring start/count unless ignore_paging."""
+    requests_seen = []
+
+    def fake_get_data(ctx, endpoint):
+        requests_seen.append(endpoint)
+        query = dict(part.split("=", 1) for part in endpoint.split("?", 1)[1].split("&"))
+        if ignore_paging or 'count' not in query:
+            return {'results': records}
+        start, count = int(query['start']), int(query['count'])
+        return {'results': records[start:start + count]}
+
+    monkeypatch.setattr(ft, "get_data", fake_get_data)
+    return requests_seen
+
+
+def switch_records(n):
+    return [{'switch-id': f"SW{i:04d}", 'name': f"sw{i}", 'poe-detection-type': 1, 'ports': [
+        {'port-name': "port1", 'vlan': "default"}]} for i in range(n)]
+
+
+def test_pages_until_a_short_page(monkeypatch):
+    requests_seen = paged_source(monkeypatch, switch_records(25))
+    pages = list(ft.iter_result_pages(ft.Target("gate"), ft.EP_SWITCHES, page_size=10))
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert len(requests_seen) == 3
+    assert "start=20&count=10" in requests_seen[-1]
+
+
+def test_pages_are_projected(monkeypatch):
+    paged_source(monkeypatch, switch_records(1))
+    [[record]] = ft.iter_result_pages(ft.Target("gate"), ft.EP_SWITCHES, page_size=10)
+    assert record == {'switch-id': "SW0000", 'name': "sw0", 'ports': [{'port-name': "port1"}]}
+
+
+def test_device_ignoring_paging_is_read_once(monkeypatch):
+    requests_seen = paged_source(monkeypatch, switch_records(10), ignore_paging=True)
+    pages = list(ft.iter_result_pages(ft.Target("gate"), ft.EP_SWITCHES, page_size=10))
+    assert [len(page) for page in pages] == [10]
+    assert len(requests_seen) == 2
+
+
+def test_exact_multiple_of_the_page_size(monkeypatch):
+    requests_seen = paged_source(monkeypatch, switch_records(20))
+    pages = list(ft.iter_result_pages(ft.Target("gate"), ft.EP_SWITCHES, page_size=10))
+    assert [len(page) for page in pages] == [10, 10]
+    assert len(requests_seen) == 3
+
+
+def test_device_index_prefix_then_substring():
+    devices = {f"{name} ({serial}) [{adom}]": {'name': name, 'serial': serial, 'adom': adom}
+               for name, serial, adom in (("branch-berlin", "FG100F0001", "EMEA"),
+                                          ("branch-boston", "FG100F0002", "AMER"),
+                                          ("hq-berlin", "FG600F0003", "EMEA"))}
+    index = ft.DeviceIndex(devices)
+    assert len(index) == 3
+    assert index.search("") == list(devices)
+    assert index.search("BRANCH-B") == ["branch-berlin (FG100F0001) [EMEA]", "branch-boston (FG100F0002) [AMER]"]
+    assert index.search("fg600") == ["hq-berlin (FG600F0003) [EMEA]"]
+    # Prefix matches first, then the display strings that only contain the text
+    assert index.search("berlin") == ["branch-berlin (FG100F0001) [EMEA]", "hq-berlin (FG600F0003) [EMEA]"]
+    assert index.search("emea", limit=1) == ["branch-berlin (FG100F0001) [EMEA]"]
+
+
+def expected_rows(mock, gate):
+    site = mock.site(gate)
+    members = [m for m in mock.ha_members(gate) if m['serial'] != gate['serial']]
+    graph = ft.build_topology(gate['serial'], gate['name'], site['switches']['results'],
+                              site['aps']['results'], members)
+    return ft.topology_rows(graph)
+
+
+def test_direct_collection_of_the_mock_gate(mock_gate):
+    mock, ctx = mock_gate
+    mock.vdoms = ["root", "guest", "iot"]
+    mock.ha = True
+    mock.sites.clear()
+
+    serial, hostname, graph = ft.collect_topology(ctx)
+    gate = mock.gate(0)
+    assert (serial, hostname) == (gate['serial'], gate['name'])
+    assert ft.topology_rows(graph) == expected_rows(mock, gate)
+    assert not ctx.failures
+
+
+def test_fmg_collection_through_the_proxy(mock_gate):
+    mock, direct = mock_gate
+    ctx = ft.Target(direct.ip, direct.port, direct.token, mode="FMG")
+    device_map = ft.fetch_fmg_devices(ctx)
+    assert len(device_map) == mock.gates
+
+    device = next(d for d in device_map.values() if d['name'] == "FGT-0002")
+    assert device['mgt_vdom'] == mock.dvmdb_devices()[2]['mgt_vdom']
+    serial, hostname, graph = ft.collect_topology(ctx.for_device(device))
+    assert (serial, hostname) == ("FG100FTK00000002", "FGT-0002")
+    assert ft.topology_rows(graph) == expected_rows(mock, mock.gate(2))
+
+
+@pytest.mark.parametrize("device, default_vdom", [
+    ({'name': "gate", 'serial': "FG1", 'mgt_vdom': "mgmt"}, "mgmt"),
+    ({'name': "gate", 'serial': "FG1"}, "root"),    # Device cache of an older version
+])
+def test_fmg_default_vdom_is_the_management_vdom(monkeypatch, device, default_vdom):
+    monkeypatch.setattr(ft, "fetch_fmg_vdoms", lambda ctx: ["root", "mgmt"])
+    ctx = ft.Target("fmg", mode="FMG").for_device(device)
+    assert ft.discover_gate(ctx, {}) == (["root", "mgmt"], default_vdom, [])
+
+
+def test_recorded_responses_replay_without_network(mock_gate):
+    mock, ctx = mock_gate
+    ctx.cache_mode = "record"
+    recorded = ft.topology_rows(ft.collect_topology(ctx)[2])
+    requests_recorded = mock.stats['requests']
+
+    replay = ft.Target(ctx.ip, ctx.port, ctx.token)
+    replay.cache_mode = "replay"
+    assert ft.topology_rows(ft.collect_topology(replay)[2]) == recorded
+    assert mock.stats['requests'] == requests_recorded
+
+
+def test_field_filter_only_for_cmdb_tables():
+    switches = ft.endpoint_query(ft.EP_SWITCHES, 0, 100)
+    assert "format=switch-id|name|mac|ports" in switches
+    assert "start=0&count=100" in switches
+    aps = ft.endpoint_query(ft.EP_APS, 0, 100)
+    assert "format=" not in aps and "count=100" in aps
+
+
+def test_device_answering_everything_at_once(monkeypatch):
+    def fake_get_data(ctx, endpoint):
+        requests_seen.append(endpoint)
+        return {'results': switch_records(25)}
+
+    requests_seen = []
+    monkeypatch.setattr(ft, "get_data", fake_get_data)
+    pages = list(ft.iter_result_pages(ft.Target("gate"), ft.EP_SWITCHES, page_size=10))
+    assert [len(page) for page in pages] == [25]
+    assert len(requests_seen) == 1
@@ -0,0 +1,54 @@
+import json
+import os
+
+import fortitopology as ft
+
+
+def inventory(ctx):
+    return [{'host': ctx.ip, 'port': ctx.port, 'token': ctx.token, 'name': "site"}]
+
+
+def test_crawl_of_a_complete_gate(mock_gate, tmp_path):
+    _, ctx = mock_gate
+    history = str(tmp_path / "history.db")
+    summary = ft.crawl_gates(inventory(ctx), str(tmp_path), settings={'history_db': history})
+
+    [result] = summary['results']
+    assert (summary['ok'], summary['failed']) == (1, 0)
+    assert result['status'] == "ok" and result['failed_endpoints'] == []
+    assert os.path.exists(result['file'])
+    assert len(ft.list_snapshots(path=history)) == 1
+
+
+def test_gate_with_failed_endpoint_is_incomplete(mock_gate, tmp_path, monkeypatch):
+    _, ctx = mock_gate
+    history = str(tmp_path / "history.db")
+    fetch_endpoint = ft.fetch_endpoint
+
+    def no_aps(ctx, endpoint):
+        if ft.endpoint_path(endpoint) == ft.EP_APS:
+            raise ft.requests.ConnectionError("connection reset")
+        return fetch_endpoint(ctx, endpoint)
+
+    monkeypatch.setattr(ft, "fetch_endpoint", no_aps)
+    summary = ft.crawl_gates(inventory(ctx), str(tmp_path), settings={'history_db': history})
+
+    [result] = summary['results']
+    assert (summary['ok'], summary['incomplete'], summary['failed']) == (0, 1, 0)
+    assert result['status'] == "incomplete"
+    assert result['failed_endpoints'] == [ft.EP_APS]
+    assert result['switches'] and not result['aps']
+    assert ft.list_snapshots(path=history) == []
+    with open(tmp_path / "crawl_summary.json", encoding="utf-8") as f:
+        assert json.load(f)['incomplete'] == 1
+
+
+def test_unreachable_gate_is_an_error_and_writes_nothing(mock_gate, tmp_path):
+    _, ctx = mock_gate
+    gates = inventory(ctx) + [{'host': "127.0.0.1", 'port': "1", 'token': "t", 'name': "down"}]
+    summary = ft.crawl_gates(gates, str(tmp_path), settings={'history_db': "", 'retry_attempts': 1})
+
+    assert (summary['gates'], summary['ok'], summary['incomplete'], summary['failed']) == (2, 1, 0, 1)
+    down = summary['results'][1]
+    assert down['status'] == "error" and down['failed_endpoints']
+    assert not any("down" in name for name in os.listdir(tmp_path))
@@ -0,0 +1,89 @@
+import os
+
+import fortitopology as ft
+
+
+def fmg_args(ctx, out_dir, *extra):
+    return ["fmg", "--host", ctx.ip, "--port", ctx.port, "--token", ctx.token, "--no-history",
+            "-o", str(out_dir), *extra]
+
+
+def test_fleet_uses_the_target_form_the_fmg_accepts(mock_gate, tmp_path):
+    mock, ctx = mock_gate
+    mock.target_variant = "name"
+    out_dir = tmp_path / "out"
+    assert ft.main(fmg_args(ctx, out_dir, "--all")) == 0
+    assert sorted(os.listdir(out_dir)) == sorted(f"topology_{mock.gate(i)['name']}{suffix}"
+                                                  for i in range(mock.gates)
+                                                  for suffix in (".drawio", ft.ARTIFACT_SUFFIX))
+
+    # The probed form is cached, the next run gets every device in one batch
+    fmg = ft.Target(ctx.ip, ctx.port, ctx.token, mode="FMG")
+    devices = list(ft.fetch_fmg_devices(fmg).values())
+    requests_before = mock.stats['requests']
+    collected = ft.collect_fleet(fmg, devices)
+    assert mock.stats['requests'] == requests_before + 1
+    assert all(len(collected[d['serial']][ft.EP_SWITCHES]) for d in devices)
+
+
+def test_fleet_records_devices_without_data(mock_gate):
+    mock, direct = mock_gate
+    fmg = ft.Target(direct.ip, direct.port, direct.token, mode="FMG")
+    devices = list(ft.fetch_fmg_devices(fmg).values())
+    gone = {'name': "FGT-GONE", 'serial': "FG100FTK99999999", 'adom': "root"}
+
+    collected = ft.collect_fleet(fmg, devices + [gone])
+    assert collected[gone['serial']] == {}
+    assert {endpoint for endpoint, _, _ in fmg.failures} == {ft.EP_SWITCHES, ft.EP_APS}
+    assert all(len(collected[d['serial']]) == 2 for d in devices)
+
+
+def test_fleet_keeps_ha_members_and_skips_history_of_incomplete_devices(mock_gate, tmp_path, monkeypatch):
+    mock, direct = mock_gate
+    mock.ha = True
+    fmg = ft.Target(direct.ip, direct.port, direct.token, mode="FMG", settings={'history_db': str(tmp_path / "h.db")})
+    devices = list(ft.fetch_fmg_devices(fmg).values())
+
+    collect_fleet = ft.collect_fleet
+    def without_aps_of_the_first(ctx, devices, **kwargs):
+        collected = collect_fleet(ctx, devices, **kwargs)
+        del collected[devices[0]['serial']][ft.EP_APS]
+        return collected
+    monkeypatch.setattr(ft, "collect_fleet", without_aps_of_the_first)
+
+    ft.export_fleet(fmg, devices, str(tmp_path), write_artifact=False)
+    stored = {s['gate_serial'] for s in ft.list_snapshots(path=fmg.history_db)}
+    assert stored == {d['serial'] for d in devices[1:]}
+
+    _, graph = ft.load_snapshot(ft.list_snapshots(devices[1]['serial'], path=fmg.history_db)[0]['id'],
+                                path=fmg.history_db)
+    assert graph.count('fortigate') == 2
+
+
+def test_fleet_recordings_replay_in_single_device_runs(mock_gate):
+    mock, direct = mock_gate
+    fmg = ft.Target(direct.ip, direct.port, direct.token, mode="FMG", settings={'cache_mode': "record"})
+    devices = list(ft.fetch_fmg_devices(fmg).values())
+    collected = ft.collect_fleet(fmg, devices)
+    requests_recorded = mock.stats['requests']
+
+    replay = ft.Target(direct.ip, direct.port, direct.token, mode="FMG",
+                       settings={'cache_mode': "replay", 'page_size': 0}).for_device(devices[1])
+    for endpoint in ft.FLEET_ENDPOINTS:
+        assert ft.get_paged(replay, endpoint)['results'] == collected[devices[1]['serial']][endpoint]
+    assert not replay.failures
+    assert mock.stats['requests'] == requests_recorded
+
+
+def test_logout_closes_the_sessions_of_device_targets(mock_gate):
+    mock, direct = mock_gate
+    fmg = ft.Target(direct.ip, direct.port, user=mock.user, password=mock.password, mode="FMG")
+    devices = list(ft.fetch_fmg_devices(fmg).values())
+    device = fmg.for_device(devices[0])
+    device.session = ""     # e.g. expired, the device target logs in on its own
+    assert ft.get_paged(device, ft.EP_SWITCHES)['results']
+    assert len(mock.sessions) == 2
+
+    ft.fmg_logout(fmg)
+    assert mock.sessions == {}
+    assert (fmg.ip, fmg.port) not in ft.HTTP_SESSIONS
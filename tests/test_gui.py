@@ -0,0 +1,58 @@
+import queue
+import threading
+from types import SimpleNamespace
+
+import fortitopology as ft
+
+
+class FakeRoot:
+    def __init__(self):
+        self.scheduled = []
+
+    def after(self, ms, func):
+        self.scheduled.append(func)
+
+
+def fake_app():
+    """The attributes pump_log uses, without a Tk window."""
+    app = SimpleNamespace(log_queue=queue.Queue(), call_queue=queue.Queue(), log_lock=threading.Lock(),
+                          log_dropped=0, root=FakeRoot(), shown=[])
+    app.append_log = app.shown.append
+    app.pump_log = lambda: ft.FortiMapperApp.pump_log(app)
+    return app
+
+
+def test_failing_call_does_not_stop_the_pump(monkeypatch):
+    app = fake_app()
+    monkeypatch.setattr(ft, "gui_log_callback", app.log_queue.put)
+    finished = []
+
+    def broken():
+        raise RuntimeError("widget gone")
+
+    app.call_queue.put((broken, ()))
+    app.call_queue.put((finished.append, ("done",)))
+    ft.FortiMapperApp.pump_log(app)
+
+    assert finished == ["done"]
+    assert len(app.root.scheduled) == 1
+
+    # The error shows up with the next batch of log lines
+    ft.FortiMapperApp.pump_log(app)
+    assert "widget gone" in app.shown[-1]
+    assert len(app.root.scheduled) == 2
+
+
+def test_pump_reschedules_when_the_log_fails():
+    app = fake_app()
+
+    def broken_log(text):
+        raise RuntimeError("no log area")
+
+    app.append_log = broken_log
+    app.log_queue.put("line")
+    try:
+        ft.FortiMapperApp.pump_log(app)
+    except RuntimeError:
+        pass
+    assert len(app.root.scheduled) == 1
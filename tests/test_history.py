@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+import fortitopology as ft
+
+
+def gate_graph(aps):
+    """FortiGate, one switch and the given APs (serial -> switch port)."""
+    switches = [{'switch-id': "SW1", 'name': "access", 'ports': [
+        {'port-name': "port49", 'fgt-peer-device-name': "gate", 'fgt-peer-port-name': "fortilink"}]}]
+    aps = [{'serial': serial, 'name': serial.lower(), 'lldp': [{'system_name': "access", 'port_id': port}]}
+           for serial, port in aps.items()]
+    return ft.build_topology("FGT0001", "gate", switches, aps)
+
+
+@pytest.fixture
+def history(tmp_path):
+    return str(tmp_path / "history.db")
+
+
+def test_unchanged_topology_extends_the_last_snapshot(history):
+    first = ft.record_snapshot(gate_graph({'AP1': "port1"}), "FGT0001", "gate", taken=100, path=history)
+    again = ft.record_snapshot(gate_graph({'AP1': "port1"}), "FGT0001", "gate", taken=200, path=history)
+    assert again == first
+
+    [snapshot] = ft.list_snapshots("FGT0001", path=history)
+    assert (snapshot['first_seen'], snapshot['last_seen'], snapshot['polls']) == (100, 200, 2)
+
+
+def test_diff_snapshots(history):
+    old = ft.record_snapshot(gate_graph({'AP1': "port1", 'AP2': "port2"}), "FGT0001", "gate", taken=100, path=history)
+    new = ft.record_snapshot(gate_graph({'AP1': "port5", 'AP3': "port3"}), "FGT0001", "gate", taken=200, path=history)
+    assert new != old
+
+    diff = ft.diff_snapshots(old, new, path=history)
+    assert [d['serial'] for d in diff['devices_added']] == ["AP3"]
+    assert [d['serial'] for d in diff['devices_removed']] == ["AP2"]
+    assert diff['devices_changed'] == []
+    # Links are compared regardless of direction, the smaller id comes first
+    def links(key):
+        return {(l['src'], l['dst'], l['dst_port']) for l in diff[key]}
+    assert links('links_added') == {("ap1", "access", "port5"), ("ap3", "access", "port3")}
+    assert links('links_removed') == {("ap1", "access", "port1"), ("ap2", "access", "port2")}
+
+    assert ft.changes_since("gate", 150, path=history)['devices_added'] == diff['devices_added']
+
+
+def test_device_history_merges_periods(history):
+    for taken, port in ((100, "port1"), (200, "port2"), (300, "port1")):
+        ft.record_snapshot(gate_graph({'AP1': port, 'AP2': f"port{taken}"}), "FGT0001", "gate",
+                           taken=taken, path=history)
+    periods = ft.device_history("AP1", path=history)
+    assert [(p['from'], p['peers'][0]['peer_port']) for p in periods] == [(100, "port1"), (200, "port2"), (300, "port1")]
+
+
+def test_snapshot_round_trip(history):
+    graph = gate_graph({'AP1': "port1"})
+    snapshot_id = ft.record_snapshot(graph, "FGT0001", "gate", path=history)
+    meta, loaded = ft.load_snapshot(snapshot_id, path=history)
+    assert meta['nodes'] == len(graph)
+    assert ft.topology_rows(loaded) == ft.topology_rows(graph)
+
+
+def test_parse_since():
+    now = time.time()
+    assert ft.parse_since("2d") == pytest.approx(now - 2 * 86400, abs=5)
+    assert ft.parse_since("1.5h") == pytest.approx(now - 5400, abs=5)
+    assert ft.parse_since("1700000000") == 1700000000
+    assert ft.parse_since("2026-01-02") == time.mktime((2026, 1, 2, 0, 0, 0, 0, 0, -1))
+    assert ft.parse_since("2026-01-02T03:04") == time.mktime((2026, 1, 2, 3, 4, 0, 0, 0, -1))
+    with pytest.raises(ValueError):
+        ft.parse_since("yesterday")
@@ -0,0 +1,30 @@
+import fortitopology as ft
+
+
+def metric_families(text):
+    """{metric name: type} from the # TYPE lines, and the sample lines."""
+    types = {}
+    samples = []
+    for line in text.splitlines():
+        if line.startswith("# TYPE "):
+            _, _, name, kind = line.split()
+            types[name] = kind
+        elif line and not line.startswith("#"):
+            samples.append(line)
+    return types, samples
+
+
+def test_request_latency_is_a_summary():
+    metrics = ft.RunMetrics()
+    for seconds in (0.1, 0.2, 0.3):
+        metrics.add_request("GET", "/api", "gate", 200, seconds, 100)
+    types, samples = metric_families(metrics.to_prometheus())
+
+    assert types['fortitopology_request_seconds'] == "summary"
+    assert 'fortitopology_request_seconds{endpoint="/api",quantile="0.5"} 0.200000' in samples
+    assert 'fortitopology_request_seconds_sum{endpoint="/api"} 0.600000' in samples
+    assert 'fortitopology_request_seconds_count{endpoint="/api"} 3' in samples
+    # quantile is only used by summaries
+    for sample in samples:
+        if 'quantile="' in sample:
+            assert types[sample.split("{")[0]] == "summary"
@@ -0,0 +1,128 @@
+import pytest
+import requests
+
+import fortitopology as ft
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = b"{}"
+
+
+def scripted_transport(monkeypatch, outcomes):
+    """http_request answers with the outcomes in order: exception classes/instances or status codes."""
+    outcomes = list(outcomes)
+    calls = []
+
+    def fake_http_request(ctx, method, url, label, **kwargs):
+        calls.append(kwargs.get('timeout'))
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, int):
+            return FakeResponse(outcome)
+        raise outcome("scripted")
+
+    monkeypatch.setattr(ft, "http_request", fake_http_request)
+    return calls
+
+
+def test_breaker_opens_after_failures_in_a_row(monkeypatch):
+    monkeypatch.setattr(ft, "BREAKER_FAILURES", 3)
+    breaker = ft.CircuitBreaker()
+    for _ in range(3):
+        assert breaker.allow("gate")
+        breaker.failure("gate")
+    assert not breaker.allow("gate")
+    assert breaker.is_open("gate")
+
+
+def test_breaker_half_open_trial_closes_on_success(monkeypatch):
+    monkeypatch.setattr(ft, "BREAKER_FAILURES", 1)
+    monkeypatch.setattr(ft, "BREAKER_COOLDOWN", 0)
+    breaker = ft.CircuitBreaker()
+    breaker.failure("gate")
+    assert breaker.allow("gate")        # trial
+    assert not breaker.allow("gate")    # only one trial at a time
+    breaker.success("gate")
+    assert not breaker.is_open("gate")
+    assert breaker.allow("gate")
+
+
+def test_trial_ending_in_other_request_exception_releases_host(monkeypatch):
+    """Regression: a ChunkedEncodingError in the trial request left the host blocked forever."""
+    monkeypatch.setattr(ft, "BREAKER_COOLDOWN", 0)
+    ctx = ft.Target("10.0.0.1", settings={'retry_attempts': 1})
+    scripted_transport(monkeypatch, [requests.ConnectionError] * ft.BREAKER_FAILURES
+                       + [requests.exceptions.ChunkedEncodingError, 200])
+
+    for _ in range(ft.BREAKER_FAILURES):
+        with pytest.raises(requests.ConnectionError):
+            ft.policy_request(ctx, "GET", "https://x/api", "/api", idempotent=True)
+    assert ctx.breaker.is_open(ctx.host)
+
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        ft.policy_request(ctx, "GET", "https://x/api", "/api", idempotent=True)
+    assert ctx.host not in ctx.breaker.trial
+
+    # The next trial goes out and closes the circuit
+    assert ft.policy_request(ctx, "GET", "https://x/api", "/api", idempotent=True).status_code == 200
+    assert not ctx.breaker.is_open(ctx.host)
+
+
+def test_open_circuit_fails_without_request(monkeypatch):
+    monkeypatch.setattr(ft, "BREAKER_FAILURES", 1)
+    ctx = ft.Target("10.0.0.2")
+    calls = scripted_transport(monkeypatch, [requests.ConnectionError])
+    with pytest.raises(requests.ConnectionError):
+        ft.policy_request(ctx, "GET", "https://x/api", "/api")
+    with pytest.raises(ft.CircuitOpenError):
+        ft.policy_request(ctx, "GET", "https://x/api", "/api")
+    assert len(calls) == 1
+
+
+def test_idempotent_requests_are_retried_with_growing_timeout(monkeypatch):
+    ctx = ft.Target("10.0.0.3", settings={'retry_attempts': 3, 'timeout_max': 30})
+    calls = scripted_transport(monkeypatch, [requests.Timeout, 503, 200])
+    response = ft.policy_request(ctx, "GET", "https://x/api", "/api", idempotent=True)
+    assert response.status_code == 200
+    assert calls == [8, 16, 30]
+    # Counted for the target and in the run totals
+    assert ctx.metrics.retries["/api"] == 2
+    assert ft.METRICS.retries["/api"] == 2
+
+
+def test_non_idempotent_requests_are_not_retried(monkeypatch):
+    ctx = ft.Target("10.0.0.4")
+    calls = scripted_transport(monkeypatch, [requests.Timeout, 200])
+    with pytest.raises(requests.Timeout):
+        ft.policy_request(ctx, "POST", "https://x/jsonrpc", "/sys/login/user")
+    assert len(calls) == 1
+
+
+def test_timeout_adapts_to_observed_latency(monkeypatch):
+    tracker = ft.LatencyTracker()
+    assert tracker.timeout("gate", "/api", "GET") == ft.TIMEOUT_DEFAULTS['GET']
+    for _ in range(ft.LATENCY_MIN_SAMPLES):
+        tracker.observe("gate", "/api", 1.0)
+    assert tracker.timeout("gate", "/api", "GET") == pytest.approx(ft.TIMEOUT_FACTOR * 1.0)
+    # Other hosts fall back to the samples of all hosts
+    assert tracker.timeout("other", "/api", "GET") == pytest.approx(ft.TIMEOUT_FACTOR * 1.0)
+    for _ in range(ft.LATENCY_MIN_SAMPLES):
+        tracker.observe("gate", "/slow", 100.0)
+    assert tracker.timeout("gate", "/slow", "GET") == ft.TIMEOUT_MAX
+
+
+def test_targets_keep_their_own_request_policy(monkeypatch):
+    monkeypatch.setattr(ft, "BREAKER_FAILURES", 1)
+    first, second = ft.Target("10.0.0.5"), ft.Target("10.0.0.5")
+    scripted_transport(monkeypatch, [requests.ConnectionError, 200])
+    with pytest.raises(requests.ConnectionError):
+        ft.policy_request(first, "GET", "https://x/api", "/api")
+    assert first.breaker.is_open(first.host)
+    assert ft.policy_request(second, "GET", "https://x/api", "/api").status_code == 200
+    assert first.latencies.quantile(first.host, "/api", 0.5) is None
+
+    # Device targets of an FMG share its host and so its state
+    device = first.for_device({'name': "gate", 'serial': "FG1"})
+    assert device.breaker is first.breaker and device.latencies is first.latencies
@@ -0,0 +1,141 @@
+import gzip
+import json
+
+import pytest
+
+import fortitopology as ft
+from synth import FG_HOSTNAME, FG_SERIAL, SWITCH_MODELS, generate_site
+
+
+def site_graph(devices=200, **kwargs):
+    site = generate_site(devices, **kwargs)
+    return site, ft.build_topology(FG_SERIAL, FG_HOSTNAME, site['switches']['results'], site['aps']['results'])
+
+
+def test_synthetic_site_is_linked():
+    site, graph = site_graph()
+    switches, aps = site['switches']['results'], site['aps']['results']
+    assert len(graph) == 1 + len(switches) + len(aps)
+    assert graph.count('switch') == len(switches)
+
+    # Every switch hangs on the FortiGate or another switch, ISL links of both sides count once
+    for sw in switches:
+        assert list(graph.neighbors(ft.clean_id(sw['switch-id'])))
+    switch_links = [e for e in graph.edges if graph.nodes[e.dst].type == 'switch']
+    assert len(switch_links) == len(switches)
+
+    # APs without LLDP and without connected_switch_serial stay unlinked
+    linked_aps = [ap for ap in aps if ap['lldp'] or ap.get('connected_switch_serial')]
+    assert len(graph.edges) == len(switches) + len(linked_aps)
+
+
+def test_fortilink_peer_resolved_by_hostname():
+    switches = [{'switch-id': "S124FP0000000001", 'name': "core", 'ports': [
+        {'port-name': "port49", 'fgt-peer-device-name': "gate-a", 'fgt-peer-port-name': "fortilink"}]}]
+    graph = ft.build_topology("FGT0001", "gate-a", switches, [])
+    [edge] = graph.edges
+    assert (edge.src, edge.dst, edge.src_port, edge.dst_port) == ("FGT0001", "S124FP0000000001", "fortilink", "port49")
+
+
+def test_fortilink_peer_may_be_an_ha_member():
+    switches = [{'switch-id': "SW1", 'name': "core", 'ports': [
+        {'port-name': "port50", 'fgt-peer-device-name': "gate-b", 'fgt-peer-port-name': "fortilink"}]}]
+    graph = ft.build_topology("FGT0001", "gate-a", switches, [], [{'serial': "FGT0002", 'name': "gate-b"}])
+    links = {(e.src, e.dst) for e in graph.edges}
+    assert links == {("FGT0001", "FGT0002"), ("FGT0002", "SW1")}
+
+
+def test_ap_parent_by_lldp_name_chassis_mac_or_connected_switch():
+    switches = [{'switch-id': "SW1", 'name': "access", 'mac': "e8:1c:ba:00:00:01", 'ports': []}]
+    aps = [
+        {'serial': "AP1", 'lldp': [{'system_name': "access", 'port_id': "port1", 'local_port': "lan1"}]},
+        {'serial': "AP2", 'lldp': [{'system_name': "other", 'chassis_id': "E8-1C-BA-00-00-01",
+                                    'port_id': "port2", 'local_port': "lan1"}]},
+        {'serial': "AP3", 'lldp': [], 'connected_switch_serial': "SW1"},
+        {'serial': "AP4", 'lldp': [], 'connected_switch_serial': "SW-UNKNOWN"},
+    ]
+    graph = ft.build_topology("FGT0001", "gate", switches, aps)
+    ports = {e.dst: (e.src, e.src_port, e.dst_port) for e in graph.edges}
+    assert ports == {"AP1": ("SW1", "port1", "lan1"), "AP2": ("SW1", "port2", "lan1"), "AP3": ("SW1", "?", "eth0")}
+    assert not list(graph.neighbors("AP4"))
+
+
+def test_model_is_left_empty_when_the_api_reports_none():
+    _, graph = site_graph(50)
+    switches = [n for n in graph.nodes.values() if n.type == 'switch']
+    assert switches and all(n.model is None for n in switches)
+    assert all(n.model.startswith("FAP-") for n in graph.nodes.values() if n.type == 'ap')
+
+
+def test_summary_node_lists_models_in_its_name():
+    _, graph = site_graph(400)
+    (_, overview), *details = ft.aggregate_graph(graph, threshold=5, include_switches=True)
+    summaries = [n for n in overview.nodes.values() if n.type.endswith("_group")]
+    assert summaries and details
+    for node in summaries:
+        assert node.serial is None
+        count, models = node.name.split("\n")
+        assert count.split()[0].isdigit() and " x" in models
+        assert node.label == node.name
+    # Switches have no model, the serial prefix stands in
+    switches = [n for n in graph.nodes.values() if n.type == 'switch'][:len(SWITCH_MODELS)]
+    assert ft.model_summary(switches) == ", ".join(f"{model} x1" for model in sorted(SWITCH_MODELS))
+
+
+def test_artifact_round_trip(tmp_path):
+    _, graph = site_graph(100)
+    filename = str(tmp_path / "site.topo.json.gz")
+    ft.save_artifact(filename, ft.topology_artifact(graph, FG_SERIAL, FG_HOSTNAME, "TEST", created=1.0))
+
+    meta, loaded = ft.load_artifact(filename)
+    assert meta['gate'] == {'serial': FG_SERIAL, 'name': FG_HOSTNAME}
+    assert 'nodes' not in meta
+    assert ft.topology_rows(loaded) == ft.topology_rows(graph)
+    assert loaded.resolve(FG_HOSTNAME) == FG_SERIAL
+
+
+@pytest.mark.parametrize("content, message", [
+    ({'format': "other"}, "not a topology artifact"),
+    ({'format': ft.ARTIFACT_FORMAT, 'version': ft.ARTIFACT_VERSION + 1, 'nodes': [], 'edges': []}, "version"),
+])
+def test_load_artifact_rejects_other_files(tmp_path, content, message):
+    filename = str(tmp_path / "bad.topo.json.gz")
+    with gzip.open(filename, "wt", encoding="utf-8") as f:
+        json.dump(content, f)
+    with pytest.raises(ValueError, match=message):
+        ft.load_artifact(filename)
+
+
+def test_incremental_update_only_rewrites_changed_aggregate_pages(tmp_path):
+    site, graph = site_graph(400)
+    filename = str(tmp_path / "site.drawio")
+    ft.write_topology(filename, graph, incremental=True, aggregate=5, partition="none")
+    with open(filename, "rb") as f:
+        _, before, _ = ft.split_diagram_pages(f.read())
+
+    # One AP less in the largest AP group: its summary and its detail page change
+    (_, overview), *details = ft.aggregate_graph(graph, threshold=5)
+    page = max((d for _, d in details if d.count('ap')), key=lambda d: d.count('ap'))
+    gone = next(n.serial for n in page.nodes.values() if n.type == 'ap')
+    site['aps']['results'] = [ap for ap in site['aps']['results'] if ap['serial'] != gone]
+    graph = ft.build_topology(FG_SERIAL, FG_HOSTNAME, site['switches']['results'], site['aps']['results'])
+
+    with open(filename, "rb") as f:
+        xml, diff = ft.update_drawio_xml(f.read(), ft.build_pages(graph, "none", 5))
+    assert diff == {'added': 0, 'removed': 0, 'updated': 2}
+    _, after, _ = ft.split_diagram_pages(xml)
+    assert [page_id for page_id, _ in after] == [page_id for page_id, _ in before]
+    changed = [page_id for (page_id, old), (_, new) in zip(before, after) if old != new]
+    assert changed == [before[0][0], page.page_id]
+
+    # A group below the threshold loses its page, the other pages keep their ids and bytes
+    (_, overview), *details = ft.aggregate_graph(graph, threshold=5)
+    page = min((d for _, d in details if d.count('ap')), key=lambda d: d.count('ap'))
+    gone = {n.serial for n in page.nodes.values() if n.type == 'ap'}
+    site['aps']['results'] = [ap for ap in site['aps']['results'] if ap['serial'] not in gone]
+    graph = ft.build_topology(FG_SERIAL, FG_HOSTNAME, site['switches']['results'], site['aps']['results'])
+
+    xml, diff = ft.update_drawio_xml(xml, ft.build_pages(graph, "none", 5))
+    assert diff['added'] == diff['updated'] == 0
+    _, final, _ = ft.split_diagram_pages(xml)
+    assert final[1:] == [(page_id, content) for page_id, content in after[1:] if page_id != page.page_id]
@@ -0,0 +1,58 @@
+import os
+
+import fortitopology as ft
+
+
+def watch_state(ctx, out_dir):
+    entry = {'host': ctx.ip, 'port': ctx.port, 'token': ctx.token, 'name': "gate"}
+    return ft.WatchState(entry, str(out_dir))
+
+
+def test_unchanged_topology_is_not_rewritten(mock_gate, tmp_path):
+    _, ctx = mock_gate
+    state = watch_state(ctx, tmp_path)
+    events = []
+
+    assert ft.poll_gate(state, events.append)
+    assert not ft.poll_gate(state, events.append)
+    assert [e['event'] for e in events] == ["initial", "written"]
+
+
+def test_failed_poll_is_skipped_with_one_error_event(mock_gate, tmp_path, monkeypatch):
+    # Regression: failed switch/AP fetches came back as [] and read as removed devices
+    monkeypatch.setattr(ft, "BREAKER_COOLDOWN", 0)
+    mock, ctx = mock_gate
+    state = watch_state(ctx, tmp_path)
+    events = []
+
+    assert ft.poll_gate(state, events.append)
+    written = [e['file'] for e in events if e['event'] == "written"]
+    mtime = os.path.getmtime(written[0])
+    fingerprint = state.fingerprint
+    events.clear()
+
+    mock.error_rate = 1.0
+    for _ in range(3):
+        assert not ft.poll_gate(state, events.append)
+    assert [e['event'] for e in events] == ["error"] * 3
+    assert "endpoints failed" in events[0]['message']
+    assert state.fingerprint == fingerprint
+    assert os.path.getmtime(written[0]) == mtime
+
+    # The circuit of the gate stays open over the polls. The first poll after the
+    # recovery closes it, requests running next to its trial request still fail fast.
+    mock.error_rate = 0.0
+    ft.poll_gate(state, events.append)
+    assert not state.ctx.breaker.is_open(state.ctx.host)
+    events.clear()
+    assert not ft.poll_gate(state, events.append)
+    assert events == []
+
+
+def test_failed_endpoint_is_recorded_on_the_target(mock_gate):
+    mock, ctx = mock_gate
+    mock.error_rate = 1.0
+    collected = ft.collect_endpoints(ctx, [ft.EP_SWITCHES])
+    assert ft.extract_results(collected[ft.EP_SWITCHES]) == []
+    assert [failure[0] for failure in ctx.failures] == [ft.EP_SWITCHES]
+    assert ft.METRICS.failures